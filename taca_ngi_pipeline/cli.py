@@ -1,23 +1,159 @@
 """ CLI for the deliver subcommand
 """
 import click
+import contextlib
+import datetime
+import importlib
 import logging
 import os
-import subprocess
+import Queue
+import threading
+import time
 
-from ngi_pipeline.database.classes import CharonSession
 from taca.utils.config import CONFIG
 
 import taca.utils.misc
-from deliver import deliver as _deliver
-from deliver import deliver_mosler as _deliver_mosler
-from deliver import deliver_castor as _deliver_castor
-from deliver import deliver_grus as _deliver_grus
-
-from deliver.deliver_grus import GrusProjectDeliverer
 
 logger = logging.getLogger(__name__)
 
+# the delivery module for each cluster. They are imported when a cluster is selected,
+# so that the CLI starts without loading the heavy dependencies of all backends
+_BACKENDS = {
+    'milou': 'deliver',
+    'mosler': 'deliver_mosler',
+    'bianca': 'deliver_castor',
+    'grus': 'deliver_grus'}
+
+
+def _backend(cluster):
+    """ Import the delivery module for a cluster
+        :param string cluster: the cluster to deliver to
+        :returns: the delivery module
+    """
+    return importlib.import_module("taca_ngi_pipeline.deliver.{}".format(_BACKENDS[cluster]))
+
+
+# the project delivered by the current thread, when delivering projects concurrently
+_log_context = threading.local()
+
+
+class _ProjectLogFilter(logging.Filter):
+    """ Prefixes log messages with the project delivered by the thread logging them """
+
+    def filter(self, record):
+        project = getattr(_log_context, 'project', None)
+        # a record passes all handlers, but should only be tagged once
+        if project is not None and not getattr(record, 'project_tagged', False):
+            record.msg = "[{}] {}".format(project, record.msg)
+            record.project_tagged = True
+        return True
+
+
+@contextlib.contextmanager
+def _project_log_tags():
+    """ Context manager tagging the log messages with the project delivered by the thread """
+    log_filter = _ProjectLogFilter()
+    log_handlers = list(logging.getLogger().handlers)
+    for handler in log_handlers:
+        handler.addFilter(log_filter)
+    try:
+        yield
+    finally:
+        for handler in log_handlers:
+            handler.removeFilter(log_filter)
+
+# profiling of the deliveries, set with the --profile and --trace-memory options
+_profiling = {'profile': False, 'trace_memory': False}
+# the number of deliveries tracing memory allocations, which is done process-wide
+_traced = {'count': 0, 'lock': threading.Lock()}
+
+
+def _profile_prefix(obj):
+    """ :returns: the path prefix of the profiling output for a delivery, in its log path """
+    logpath = getattr(obj, 'logpath', None)
+    logdir = obj.expand_path(logpath) if logpath else os.getcwd()
+    if not os.path.exists(logdir):
+        os.makedirs(logdir)
+    return os.path.join(logdir, "{}_{}".format(
+        str(obj).replace(':', '_'), datetime.datetime.now().strftime("%Y%m%dT%H%M%S")))
+
+
+@contextlib.contextmanager
+def _profiled(obj):
+    """ Context manager profiling a delivery, if requested with the --profile and
+        --trace-memory options. A cProfile dump and a summary of the top allocation
+        sites are written to the log path of the delivery.
+    """
+    if not _profiling['profile'] and not _profiling['trace_memory']:
+        yield
+        return
+    try:
+        prefix = _profile_prefix(obj)
+    except Exception as e:
+        # profiling should never stop a delivery
+        logger.warning("{} will not be profiled, the log path could not be used: {}".format(str(obj), e))
+        yield
+        return
+    profiler = None
+    tracemalloc = None
+    if _profiling['profile']:
+        # a profiler only sees the thread it was enabled in, so concurrent deliveries are profiled separately
+        cProfile = importlib.import_module('cProfile')
+        profiler = cProfile.Profile()
+    if _profiling['trace_memory']:
+        try:
+            # part of the standard library from python 3.4, available as pytracemalloc before that
+            tracemalloc = importlib.import_module('tracemalloc')
+        except ImportError:
+            logger.warning("tracemalloc is not available (on python 2 it needs the pytracemalloc backport), "
+                           "only the peak memory use of {} will be reported".format(str(obj)))
+        else:
+            with _traced['lock']:
+                if not tracemalloc.is_tracing():
+                    tracemalloc.start(_profiling.get('trace_memory_frames', 1))
+                _traced['count'] += 1
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        try:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats("{}.prof".format(prefix))
+                logger.info("profile of {} written to {}.prof".format(str(obj), prefix))
+            if _profiling['trace_memory']:
+                _write_memory_summary(obj, "{}_memory.txt".format(prefix), tracemalloc)
+        except (IOError, OSError) as e:
+            logger.warning("could not write the profile of {}: {}".format(str(obj), e))
+
+
+def _write_memory_summary(obj, path, tracemalloc=None):
+    """ Write the top allocation sites from tracemalloc, and the peak memory use of the process """
+    resource = importlib.import_module('resource')
+    top = _profiling.get('trace_memory_top', 25)
+    snapshot = None
+    if tracemalloc is not None:
+        with _traced['lock']:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            _traced['count'] -= 1
+            others = _traced['count']
+            if others == 0:
+                tracemalloc.stop()
+    with open(path, 'w') as fh:
+        # ru_maxrss is in kilobytes on linux
+        fh.write("Peak resident memory of the process: {} kB\n".format(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+        if snapshot is not None:
+            fh.write("Traced memory: {} bytes current, {} bytes peak\n".format(current, peak))
+            if others > 0:
+                fh.write("Other deliveries were running, their allocations are included\n")
+            fh.write("\nTop {} allocation sites:\n".format(top))
+            for stat in snapshot.statistics('lineno')[:top]:
+                fh.write("{}\n".format(stat))
+    logger.info("memory summary of {} written to {}".format(str(obj), path))
+
 #######################################
 # deliver
 #######################################
@@ -38,12 +174,27 @@ logger = logging.getLogger(__name__)
               help="Force delivery, even if e.g. analysis has not finished or sample has already been delivered")
 @click.option('--cluster', default="milou",  type=click.Choice(['milou', 'mosler', 'bianca', 'grus']),
               help="Specify to which cluster one wants to deliver")
+@click.option('--verify-delivery', is_flag=True, default=False,
+              help="Hash the delivered files again after the transfer and mark samples with mismatches as FAILED. "
+                   "Ignored for the sftp deliveries to castor and mosler")
+@click.option('--profile', is_flag=True, default=False,
+              help="Write a cProfile dump of each project or sample delivery to the log path")
+@click.option('--trace-memory', is_flag=True, default=False,
+              help="Write a summary of the top memory allocation sites of each project or sample delivery "
+                   "to the log path. On python 2 the allocation sites need the pytracemalloc backport, which "
+                   "needs a patched python, without it only the peak resident memory is written")
 
 
 
-def deliver(ctx, deliverypath, stagingpath, uppnexid, operator, stage_only, force, cluster, ignore_analysis_status):
+def deliver(ctx, deliverypath, stagingpath, uppnexid, operator, stage_only, force, cluster, ignore_analysis_status,
+            verify_delivery=False, profile=False, trace_memory=False):
     """ Deliver methods entry point
     """
+    # the profiling options apply to the runs and are not passed on to the deliverers
+    _profiling['profile'] = ctx.params.pop('profile', False)
+    _profiling['trace_memory'] = ctx.params.pop('trace_memory', False)
+    _profiling['trace_memory_top'] = CONFIG.get('deliver', {}).get('trace_memory_top', 25)
+    _profiling['trace_memory_frames'] = CONFIG.get('deliver', {}).get('trace_memory_frames', 1)
     if deliverypath is None:
         del ctx.params['deliverypath']
     if stagingpath is None:
@@ -52,6 +203,9 @@ def deliver(ctx, deliverypath, stagingpath, uppnexid, operator, stage_only, forc
         del ctx.params['uppnexid']
     if operator is None or len(operator) == 0:
         del ctx.params['operator']
+    # the verification can also be enabled in the config
+    if not verify_delivery:
+        del ctx.params['verify_delivery']
 
 # deliver subcommands
 # project delivery
@@ -84,25 +238,42 @@ def deliver(ctx, deliverypath, stagingpath, uppnexid, operator, stage_only, forc
             is_flag=True,
             default = False,
             help='Perform all the delivery actions but does not run to_mover (to be used for semi-manual deliveries)')
+@click.option('--refresh-cache',
+            is_flag=True,
+            default = False,
+            help='Ignore cached PI e-mail and SUPR PI-id lookups and fetch them again')
+@click.option('--jobs',
+            default=1,
+            type=click.IntRange(min=1),
+            help='Number of projects to deliver concurrently (milou and mosler only)')
+@click.option('--io-budget',
+            default=None,
+            type=click.IntRange(min=1),
+            help='Maximum number of staging and transfer operations running at the same time when '
+                 'delivering projects concurrently, defaults to the number of jobs')
 
-def project(ctx, projectid, snic_api_credentials=None, statusdb_config=None, order_portal=None, pi_email=None, sensitive=True, hard_stage_only=False):
+def project(ctx, projectid, snic_api_credentials=None, statusdb_config=None, order_portal=None, pi_email=None, sensitive=True, hard_stage_only=False, refresh_cache=False, jobs=1, io_budget=None):
     """ Deliver the specified projects to the specified destination
     """
     if ctx.parent.params['cluster'] == 'bianca':
         if len(projectid) > 1:
             logger.error("Only one project can be specified when delivering to Bianca. Specficied {} projects".format(len(projectid)))
             return 1
+    if jobs > 1 and ctx.parent.params['cluster'] not in ['milou', 'mosler']:
+        logger.error("Projects can only be delivered concurrently to milou or mosler")
+        return 1
+    concurrent_deliverers = []
     for pid in projectid:
         if ctx.parent.params['cluster'] == 'milou':
-            d = _deliver.ProjectDeliverer(
+            d = _backend('milou').ProjectDeliverer(
                 pid,
                 **ctx.parent.params)
         elif ctx.parent.params['cluster'] == 'mosler':
-            d = _deliver_mosler.MoslerProjectDeliverer(
+            d = _backend('mosler').MoslerProjectDeliverer(
                 pid,
                 **ctx.parent.params)
         elif ctx.parent.params['cluster'] == 'bianca':
-            d = _deliver_castor.CastorProjectDeliverer(
+            d = _backend('bianca').CastorProjectDeliverer(
                 pid,
                 **ctx.parent.params)
         elif ctx.parent.params['cluster'] == 'grus':
@@ -118,13 +289,20 @@ def project(ctx, projectid, snic_api_credentials=None, statusdb_config=None, ord
                 logger.error("--order-portal or env variable $ORDER_PORTAL need to be set to perform GRUS delivery")
                 return 1
             taca.utils.config.load_yaml_config(order_portal)
-            d = _deliver_grus.GrusProjectDeliverer(
+            d = _backend('grus').GrusProjectDeliverer(
                 projectid=pid,
                 pi_email=pi_email,
                 sensitive=sensitive,
                 hard_stage_only=hard_stage_only,
+                refresh_cache=refresh_cache,
+                prefetch=True,
                 **ctx.parent.params)
-        _exec_fn(d, d.deliver_project)
+        if jobs > 1:
+            concurrent_deliverers.append(d)
+        else:
+            _exec_fn(d, d.deliver_project)
+    if concurrent_deliverers:
+        _exec_concurrently(concurrent_deliverers, jobs, io_budget or jobs)
 
 # sample delivery
 @deliver.command()
@@ -136,7 +314,7 @@ def sample(ctx, projectid, sampleid):
     """
     if ctx.parent.params['cluster'] == 'bianca':
         #in this case I need to open a sftp connection in order to avoid to insert password everytime
-        projectObj = _deliver_castor.CastorProjectDeliverer(projectid, **ctx.parent.params)
+        projectObj = _backend('bianca').CastorProjectDeliverer(projectid, **ctx.parent.params)
         projectObj.create_sftp_connnection()
         #create the project folder in the remote server
         #move to delivery folder
@@ -146,17 +324,17 @@ def sample(ctx, projectid, sampleid):
         projectObj.sftp_client.chdir(projectid)
     for sid in sampleid:
         if ctx.parent.params['cluster'] == 'milou':
-            d = _deliver.SampleDeliverer(
+            d = _backend('milou').SampleDeliverer(
                 projectid,
                 sid,
                 **ctx.parent.params)
         elif ctx.parent.params['cluster'] == 'mosler':
-            d = _deliver_mosler.MoslerSampleDeliverer(
+            d = _backend('mosler').MoslerSampleDeliverer(
                 projectid,
                 sid,
                 **ctx.parent.params)
         elif ctx.parent.params['cluster'] == 'bianca':
-            d = _deliver_castor.CastorSampleDeliverer(
+            d = _backend('bianca').CastorSampleDeliverer(
                 projectid,
                 sid,
                 sftp_client=projectObj.sftp_client,
@@ -169,12 +347,148 @@ def sample(ctx, projectid, sampleid):
         projectObj.close_sftp_connnection()
 
 
+# continuous sample delivery
+@deliver.command()
+@click.pass_context
+@click.argument('projectid', type=click.STRING, nargs=-1)
+@click.option('--state-file',
+            default=None,
+            type=click.Path(dir_okay=False),
+            help='File to keep the watcher state in between runs, defaults to ~/.taca/deliver_watch.json')
+@click.option('--interval',
+            default=300,
+            type=click.IntRange(min=1),
+            help='Number of seconds between polls of the database')
+@click.option('--jobs',
+            default=2,
+            type=click.IntRange(min=1),
+            help='Number of samples to deliver concurrently')
+@click.option('--jobs-per-project',
+            default=1,
+            type=click.IntRange(min=1),
+            help='Number of samples from the same project to deliver concurrently')
+@click.option('--queue-size',
+            default=100,
+            type=click.IntRange(min=1),
+            help='Maximum number of samples waiting for delivery')
+@click.option('--once',
+            is_flag=True,
+            default=False,
+            help='Poll the database once, deliver the ready samples and exit')
+@click.option('--file-index',
+            default='none',
+            type=click.Choice(['none', 'inotify', 'rescan']),
+            help='Keep an index of the files to deliver in memory, updated with inotify where possible '
+                 'or by rescanning modified folders, instead of searching for them for each sample')
+
+def watch(ctx, projectid, state_file=None, interval=300, jobs=2, jobs_per_project=1, queue_size=100, once=False,
+          file_index='none'):
+    """ Watch the specified projects, or all open projects, and deliver samples as
+        they finish analysis
+    """
+    if ctx.parent.params['cluster'] != 'milou':
+        logger.error("Samples can only be delivered continuously to milou")
+        return 1
+    backend = _backend('milou')
+    watcher = importlib.import_module("taca_ngi_pipeline.deliver.watcher")
+    path_index = None
+    if file_index != 'none':
+        path_index = importlib.import_module("taca_ngi_pipeline.utils.fswatch").PathIndex(
+            use_inotify=(file_index == 'inotify'))
+
+    def _deliver_sample(d):
+        _log_context.project = str(d)
+        try:
+            return _exec_fn(d, d.deliver_sample)
+        finally:
+            _log_context.project = None
+
+    delivery_watcher = watcher.DeliveryWatcher(
+        lambda pid, sid: backend.SampleDeliverer(pid, sid, **ctx.parent.params),
+        state_file or os.path.expanduser(
+            CONFIG.get('deliver', {}).get('watch_state_file', '~/.taca/deliver_watch.json')),
+        projectids=projectid,
+        interval=interval,
+        jobs=jobs,
+        jobs_per_project=jobs_per_project,
+        queue_size=queue_size,
+        deliver_fn=_deliver_sample,
+        path_index=path_index)
+    try:
+        with _project_log_tags():
+            results = delivery_watcher.run(once=once)
+    finally:
+        if path_index is not None:
+            path_index.close()
+    for (pid, sid), result in sorted(results.items()):
+        logger.info("{}:{} {}".format(pid, sid, "delivered" if result else "not delivered"))
+
+# helper function to deliver projects in a pool of threads
+def _exec_concurrently(deliverers, jobs, io_budget):
+    """ Deliver projects concurrently. The staging and transfer operations of all
+        projects share an I/O budget and the log messages are tagged with the project.
+        Errors are reported for each project by _exec_fn. If the delivery is
+        interrupted (e.g. by SIGINT or SIGTERM), no more projects are started and
+        the projects being delivered are allowed to finish before the interruption
+        is raised. A second interruption while waiting for them is raised at once.
+
+        :param list deliverers: the project deliverers, created in the main thread
+        :param int jobs: the number of projects to deliver at the same time
+        :param int io_budget: the number of staging and transfer operations to run
+            at the same time
+    """
+    _backend('milou').set_io_budget(io_budget)
+    pending = Queue.Queue()
+    for d in deliverers:
+        pending.put(d)
+    stop = threading.Event()
+
+    def _worker():
+        while not stop.is_set():
+            try:
+                d = pending.get_nowait()
+            except Queue.Empty:
+                return
+            _log_context.project = d.projectid
+            try:
+                _exec_fn(d, d.deliver_project)
+            finally:
+                _log_context.project = None
+
+    workers = [threading.Thread(target=_worker, name="deliver-project-{}".format(i))
+               for i in xrange(min(jobs, len(deliverers)))]
+    try:
+        with _project_log_tags():
+            try:
+                for worker in workers:
+                    worker.daemon = True
+                    worker.start()
+                _join_all(workers)
+            except BaseException:
+                stop.set()
+                logger.warning("Delivery interrupted, waiting for the projects being delivered to finish, "
+                               "{} projects will not be started".format(pending.qsize()))
+                _join_all(workers)
+                raise
+    finally:
+        _backend('milou').set_io_budget(None)
+
+# helper function to wait for threads to finish
+def _join_all(threads):
+    # poll instead of joining, so that signals are still handled while waiting, and since
+    # a join interrupted by a signal can leave the lock of the thread held on python 2
+    while any([thread.is_alive() for thread in threads]):
+        time.sleep(0.1)
+
 # helper function to handle error reporting
 def _exec_fn(obj, fn):
     try:
-        if fn():
+        with _profiled(obj):
+            result = fn()
+        if result:
             logger.info(
                 "{} processed successfully".format(str(obj)))
+            return True
         else:
             logger.info(
                 "{} processed with some errors, check log".format(
@@ -194,6 +508,7 @@ def _exec_fn(obj, fn):
         else:
             logger.error("processing {} failed - reason: {}, operator {} has been notified".format(
                 str(obj), str(e), obj.config.get('operator')))
+    return False
 
 
 
@@ -211,10 +526,25 @@ def _exec_fn(obj, fn):
 			  envvar='STATUS_DB_CONFIG',
 			  type=click.File('r'),
 			  help='Path to statusdb-configuration')
+@click.option('--monitor',
+			  is_flag=True,
+			  default=False,
+			  help='Monitor all the specified projects concurrently until their deliveries are over')
 
-def check_status(ctx, projectid, snic_api_credentials=None, statusdb_config=None):
+def check_status(ctx, projectid, snic_api_credentials=None, statusdb_config=None, monitor=False):
     """In grus delivery mode checks the status of an onggoing delivery
     """
+    if monitor:
+        #first thing check that we are using mover 1.0.0
+        if not _backend('grus').check_mover_version():
+            logger.error("Not monitoring becouse wrong mover version detected")
+            return 1
+        monitor_cfg = CONFIG.get('deliver', {})
+        mover_monitor = _backend('grus').MoverMonitor(
+            min_interval=monitor_cfg.get('mover_poll_min_interval', 60),
+            max_interval=monitor_cfg.get('mover_poll_max_interval', 900),
+            timeout=monitor_cfg.get('mover_poll_timeout', 120),
+            max_concurrent=monitor_cfg.get('mover_poll_concurrency', 8))
     for pid in projectid:
         if statusdb_config == None:
             logger.error("--statusdb-config or env variable $STATUS_DB_CONFIG need to be set to perform GRUS delivery")
@@ -225,10 +555,13 @@ def check_status(ctx, projectid, snic_api_credentials=None, statusdb_config=None
             return 1
         taca.utils.config.load_yaml_config(snic_api_credentials)
 
-        d = _deliver_grus.GrusProjectDeliverer(
+        d = _backend('grus').GrusProjectDeliverer(
                 pid,
                 **ctx.parent.params)
-        d.check_mover_delivery_status()
-
-
-
+        if monitor:
+            mover_monitor.add(d)
+        else:
+            d.check_mover_delivery_status()
+    if monitor:
+        for pid, delivery_status in mover_monitor.run().items():
+            logger.info("Delivery of project {} is over with status {}".format(pid, delivery_status))
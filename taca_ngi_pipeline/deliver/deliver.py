@@ -1,13 +1,18 @@
 """
     Module for controlling deliveries of samples and projects
 """
+import contextlib
 import datetime
+import functools
+import glob
 import json
 import logging
 import os
 import re
 import signal
 import shutil
+import threading
+import time
 
 from taca.utils.config import CONFIG
 from taca.utils.filesystem import create_folder, chdir
@@ -15,6 +20,10 @@ from taca.utils.misc import call_external_command
 from taca.utils import transfer
 from ..utils import database as db
 from ..utils import filesystem as fs
+from ..utils import manifest
+from ..utils import metrics
+from ..utils import verify
+from ..utils.timing import SpanRecorder
 
 logger = logging.getLogger(__name__)
 
@@ -35,6 +44,10 @@ class DelivererRsyncError(DelivererError):
     pass
 
 
+class DelivererVerificationError(DelivererError):
+    pass
+
+
 def _signal_handler(sgnal, frame):
     """ A custom signal handler which will raise a DelivererInterruptedError
         :raises DelivererInterruptedError: 
@@ -44,6 +57,91 @@ def _signal_handler(sgnal, frame):
         "interrupt signal {} received while delivering".format(sgnal))
 
 
+# limits the number of staging and transfer operations running at the same time when
+# several deliveries run concurrently in the same process, see set_io_budget
+_io_budget = None
+
+
+def set_io_budget(slots):
+    """ Set the number of staging and transfer operations that are allowed to run
+        at the same time in this process
+        :param int slots: the number of concurrent operations, or None for no limit
+    """
+    global _io_budget
+    _io_budget = threading.BoundedSemaphore(slots) if slots else None
+
+
+@contextlib.contextmanager
+def io_slot():
+    """ Context manager holding one slot of the I/O budget, if a budget has been set """
+    budget = _io_budget
+    if budget is None:
+        yield
+        return
+    budget.acquire()
+    try:
+        yield
+    finally:
+        budget.release()
+
+
+def delivery_metrics(level):
+    """ Decorator recording the duration and outcome of a delivery in the metrics,
+        and writing the metrics when the delivery is over
+
+        :param string level: 'project' or 'sample'
+    """
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(self, *args, **kwargs):
+            started = time.time()
+            outcome = 'failed'
+            try:
+                result = fn(self, *args, **kwargs)
+                outcome = 'success' if result else 'incomplete'
+                return result
+            except DelivererInterruptedError:
+                outcome = 'interrupted'
+                raise
+            finally:
+                metrics.observe(
+                    'taca_deliver_delivery_seconds', time.time() - started,
+                    cluster=self.cluster, level=level, outcome=outcome)
+                metrics.flush()
+        return wrapper
+    return decorator
+
+
+# the fields of the rsync --stats summary, the older rsync versions name some of them differently
+_RSYNC_STATS = [
+    (re.compile(r'^Number of files: ([\d,]+)'), 'files'),
+    (re.compile(r'^Number of (?:regular )?files transferred: ([\d,]+)'), 'files_transferred'),
+    (re.compile(r'^Total file size: ([\d,]+)'), 'total_file_size'),
+    (re.compile(r'^Total transferred file size: ([\d,]+)'), 'transferred_file_size'),
+    (re.compile(r'^Literal data: ([\d,]+)'), 'literal_data'),
+    (re.compile(r'^Matched data: ([\d,]+)'), 'matched_data'),
+    (re.compile(r'^Total bytes sent: ([\d,]+)'), 'bytes_sent'),
+    (re.compile(r'^Total bytes received: ([\d,]+)'), 'bytes_received')]
+
+
+def parse_rsync_stats(lines):
+    """ Parse the summary printed by rsync --stats
+
+        :param lines: the lines of the rsync output
+        :returns: a dict with the number of files and files transferred, the total
+            and transferred file size, the literal and matched data and the bytes
+            sent and received, for the fields found in the output
+    """
+    stats = {}
+    for line in lines:
+        for pattern, key in _RSYNC_STATS:
+            m = pattern.match(line.strip())
+            if m is not None:
+                stats[key] = int(m.group(1).replace(',', ''))
+                break
+    return stats
+
+
 def _timestamp(days=None):
     """Current date and time (UTC) in ISO format, with millisecond precision.
     Add the specified offset in days, if given.
@@ -61,6 +159,10 @@ class Deliverer(object):
         A (abstract) superclass with functionality for handling deliveries
     """
 
+    # whether the delivered files can be hashed again against the delivered digest file
+    # after the transfer, which needs an rsync or local delivery of the staged files
+    supports_verification = True
+
     def __init__(self, projectid, sampleid, **kwargs):
         """
             :param string projectid: id of project to deliver
@@ -88,9 +190,30 @@ class Deliverer(object):
         self.force = getattr(self, 'force', False)
         self.stage_only = getattr(self, 'stage_only', False)
         self.ignore_analysis_status = getattr(self, 'ignore_analysis_status', False)
+        self.record_timing = getattr(self, 'record_timing', False)
+        # the cluster backend, used to label the metrics
+        self.cluster = getattr(self, 'cluster', 'milou')
+        self.metrics_textfile = getattr(self, 'metrics_textfile', None)
+        # an optional fswatch.PathIndex to locate the files to deliver from, instead of globbing
+        self.path_index = None
+        # the number of bytes staged, only counted when the metrics or the manifest are enabled
+        self.staged_bytes = 0
+        # the statistics of the last transfer, written with the delivery acknowledgement
+        self.transfer_stats = None
+        # re-hash the delivered files against the delivered digest file after the transfer
+        self.verify_delivery = getattr(self, 'verify_delivery', False)
+        if self.verify_delivery and not self.supports_verification:
+            logger.warning("the delivered files of {} cannot be verified, verify_delivery is ignored".format(
+                self.__class__.__name__))
+            self.verify_delivery = False
+        self.verify_workers = int(getattr(self, 'verify_workers', 4))
+        # on a forced redelivery, only send the files which differ from the last delivery (opt-in)
+        self.redeliver_changed_only = getattr(self, 'redeliver_changed_only', False)
+        # the project entry is fetched once for both the project name and the uppnexid
+        projectentry = db.project_entry(db.dbcon(), projectid)
         #Fetches a project name, should always be availble; but is not a requirement
         try:
-            self.projectname = db.project_entry(db.dbcon(), projectid)['name']
+            self.projectname = projectentry['name']
         except KeyError:
             pass
         # only set an attribute for uppnexid if it's actually given or in the db
@@ -98,12 +221,21 @@ class Deliverer(object):
             getattr(self, 'uppnexid')
         except AttributeError:
             try:
-                self.uppnexid = db.project_entry(db.dbcon(), projectid)['uppnex_id']
+                self.uppnexid = projectentry['uppnex_id']
             except KeyError:
                 pass
-        # set a custom signal handler to intercept interruptions
-        signal.signal(signal.SIGINT, _signal_handler)
-        signal.signal(signal.SIGTERM, _signal_handler)
+        # the metrics are written to a .prom file for the node_exporter textfile collector
+        if self.metrics_textfile:
+            metrics.configure(self.expand_path(self.metrics_textfile))
+        # timing spans for the phases of the delivery, only written if record_timing is set
+        self.spans = SpanRecorder(
+            self.timing_log() if self.record_timing and self.logpath else None,
+            deliverer=self.__class__.__name__, projectid=projectid, sampleid=sampleid)
+        # set a custom signal handler to intercept interruptions, this can only be done
+        # from the main thread
+        if isinstance(threading.current_thread(), threading._MainThread):
+            signal.signal(signal.SIGINT, _signal_handler)
+            signal.signal(signal.SIGTERM, _signal_handler)
 
     def __str__(self):
         return "{}:{}".format(
@@ -118,6 +250,9 @@ class Deliverer(object):
             create_folder(os.path.dirname(ackfile))
             with open(ackfile, 'w') as fh:
                 fh.write("{}\n".format(tstamp))
+                # the transfer statistics follow the timestamp as a JSON object
+                if self.transfer_stats:
+                    fh.write("{}\n".format(json.dumps(self.transfer_stats, sort_keys=True)))
         except (AttributeError, IOError) as e:
             logger.warning(
                 "could not write delivery acknowledgement, reason: {}".format(
@@ -164,7 +299,7 @@ class Deliverer(object):
         dbentry = dbentry or self.db_entry()
         return dbentry.get('delivery_status', 'NOT_DELIVERED')
 
-    def gather_files(self):
+    def gather_files(self, stats=None):
         """ This method will locate files matching the patterns specified in 
             the config and compute the checksum and construct the staging path
             according to the config.
@@ -175,76 +310,273 @@ class Deliverer(object):
             folder or file. File globs will be expanded and folders will be
             traversed to include everything beneath.
              
+            :param dict stats: an optional dict, which will be updated with the
+                time spent hashing and the number of files and bytes hashed
             :returns: A generator of tuples with source path, 
                 destination path and the checksum of the source file 
                 (or None if source is a folder)
         """
         return fs.gather_files([map(self.expand_path, file_pattern) for file_pattern in self.files_to_deliver],
                                no_checksum=self.no_checksum,
-                               hash_algorithm=self.hash_algorithm)
+                               hash_algorithm=self.hash_algorithm,
+                               index=self.path_index,
+                               stats=stats)
 
     def stage_delivery(self):
         """ Stage a delivery by symlinking source paths to destination paths 
             according to the returned tuples from the gather_files function. 
-            Checksums will be written to a digest file in the staging path. 
-            Failure to stage individual files will be logged as warnings but will
-            not terminate the staging. 
+            Checksums will be written to a digest file in the staging path,
+            together with a manifest of the staged folder tree, see
+            utils/manifest.py. Failure to stage individual files will be logged
+            as warnings but will not terminate the staging. 
             
             :raises DelivererError: if an unexpected error occurred
         """
         digestpath = self.staging_digestfile()
         filelistpath = self.staging_filelist()
+        manifestpath = self.staging_manifestfile()
         create_folder(os.path.dirname(digestpath))
+        # the time spent in gather_files is split into hashing and finding the files
+        stats = {}
+        # (path, digest, size) of the staged files for the manifest, which needs the checksums
+        entries = [] if not self.no_checksum else None
+        nfiles = 0
+        nbytes = 0
+        symlink_seconds = 0.0
+        started = time.time()
         try:
             with open(digestpath, 'w') as dh, open(filelistpath, 'w') as fh:
                 agent = transfer.SymlinkAgent(None, None, relative=True)
-                for src, dst, digest in self.gather_files():
+                for src, dst, digest in self.gather_files(stats=stats):
                     agent.src_path = src
                     agent.dest_path = dst
+                    nfiles += 1
+                    symlink_started = time.time()
                     try:
                         agent.transfer()
                     except (transfer.TransferError, transfer.SymlinkError) as e:
                         logger.warning("failed to stage file '{}' when "
                                        "delivering {} - reason: {}".format(src, str(self), e))
-
+                    symlink_seconds += time.time() - symlink_started
                     fpath = os.path.relpath(dst, self.expand_path(self.stagingpath))
+                    if (metrics.enabled() or entries is not None) and not os.path.isdir(src):
+                        try:
+                            st = os.stat(src)
+                        except OSError:
+                            st = None
+                        if st is not None:
+                            nbytes += st.st_size
+                            if entries is not None:
+                                # files excluded from the digest file are not hashed, they are
+                                # compared by their modification time and size instead
+                                entries.append(
+                                    (fpath, digest or manifest.mtime_digest(st.st_mtime), st.st_size))
+
                     fh.write("{}\n".format(fpath))
                     if digest is not None:
                         dh.write("{}  {}\n".format(digest, fpath))
-                # finally, include the digestfile in the list of files to deliver
+                # finally, include the digestfile and the manifest in the list of files to deliver
                 fh.write("{}\n".format(os.path.basename(digestpath)))
+                if entries is not None:
+                    manifest.write(manifest.build(entries, self.hash_algorithm), manifestpath)
+                    fh.write("{}\n".format(os.path.basename(manifestpath)))
         except (IOError, fs.FileNotFoundException, fs.PatternNotMatchedException) as e:
             raise DelivererError(
                 "failed to stage delivery - reason: {}".format(e))
+        finally:
+            hash_seconds = stats.get('hash_seconds', 0.0)
+            self.spans.record(
+                'gather_files', time.time() - started - hash_seconds - symlink_seconds, started=started, files=nfiles)
+            self.spans.record(
+                'hashing', hash_seconds, files=stats.get('hashed_files', 0), bytes=stats.get('hashed_bytes', 0))
+            self.spans.record('symlinking', symlink_seconds, files=nfiles)
+            metrics.inc('taca_deliver_staged_files_total', nfiles, cluster=self.cluster)
+            metrics.inc('taca_deliver_staged_bytes_total', nbytes, cluster=self.cluster)
+            metrics.inc('taca_deliver_hashed_bytes_total', stats.get('hashed_bytes', 0), cluster=self.cluster)
+            metrics.inc('taca_deliver_hashing_seconds_total', hash_seconds, cluster=self.cluster)
+            if self.sampleid is not None:
+                metrics.observe('taca_deliver_sample_files', nfiles, cluster=self.cluster)
+        self.staged_bytes = nbytes
         return True
 
+    def changed_filelist(self):
+        """ Compare the staged manifest with the manifest recorded at the last
+            successful delivery and write a list of only the files which were
+            added or changed since then, together with the digest file and the
+            manifest. Only the folders whose digests differ are compared, so the
+            cost depends on the changes rather than on the size of the delivery.
+            Files which have been removed since the last delivery are logged but
+            left at the destination.
+
+            :returns: path to the file list, or None if there is nothing to
+                compare with
+        """
+        try:
+            previous = manifest.read(self.delivered_manifestfile())
+            current = manifest.read(self.staging_manifestfile())
+        except (IOError, ValueError) as e:
+            logger.debug("{}: no manifests to compare with the last delivery: {}".format(str(self), e))
+            return None
+        # the paths read from the manifests are unicode, the file list holds them as they are on disk
+        changed, removed = [[fpath.encode('utf-8') if isinstance(fpath, unicode) else fpath for fpath in fpaths]
+                            for fpaths in manifest.diff(previous, current)]
+        if removed:
+            logger.warning("{}: {} files delivered previously are no longer staged and will be left at the "
+                           "destination: {}".format(str(self), len(removed), ", ".join(removed[:10])))
+        filelistpath = "{}.changed.lst".format(os.path.splitext(self.staging_filelist())[0])
+        with open(filelistpath, 'w') as fh:
+            for fpath in changed + [os.path.basename(self.staging_digestfile()),
+                                    os.path.basename(self.staging_manifestfile())]:
+                fh.write("{}\n".format(fpath))
+        logger.info("{}: {} of {} staged files differ from the last delivery".format(
+            str(self), len(changed), len(list(manifest.iter_files(current)))))
+        return filelistpath
+
+    def record_delivered_manifest(self):
+        """ Keep a copy of the staged manifest next to the delivery acknowledgement,
+            for the comparison with the next delivery. The local copy is used
+            rather than the delivered one, so that it works for remote
+            deliveries too.
+        """
+        if not self.deliverystatuspath or not os.path.exists(self.staging_manifestfile()):
+            return
+        try:
+            recorded = self.delivered_manifestfile()
+            create_folder(os.path.dirname(recorded))
+            shutil.copyfile(self.staging_manifestfile(), recorded)
+        except (IOError, OSError) as e:
+            logger.warning("could not record the delivered manifest of {}: {}".format(str(self), e))
+
     def do_delivery(self):
         """ Deliver the staged delivery folder using rsync
             :returns: True if delivery was successful, False if unsuccessful
             :raises DelivererRsyncError: if an exception occurred during
                 transfer
         """
+        filelist = None
+        if self.force and self.redeliver_changed_only:
+            filelist = self.changed_filelist()
         agent = transfer.RsyncAgent(
             self.expand_path(self.stagingpath),
             dest_path=self.expand_path(self.deliverypath),
             digestfile=self.delivered_digestfile(),
             remote_host=getattr(self, 'remote_host', None),
             remote_user=getattr(self, 'remote_user', None),
+            # the serial validation is replaced by verify_delivered_files
+            validate=not self.verify_delivery,
             log=logger,
             opts={
-                '--files-from': [self.staging_filelist()],
+                '--files-from': [filelist or self.staging_filelist()],
                 '--copy-links': None,
                 '--recursive': None,
                 '--perms': None,
                 '--chmod': 'ug+rwX,o-rwx',
                 '--verbose': None,
+                '--stats': None,
                 '--exclude': ["*rsync.out", "*rsync.err"]
             })
-        create_folder(os.path.dirname(self.transfer_log()))
+        # the log name has a timestamp, so only construct it once
+        transfer_log = self.transfer_log()
+        create_folder(os.path.dirname(transfer_log))
+        started = time.time()
         try:
-            return agent.transfer(transfer_log=self.transfer_log())
+            transferred = agent.transfer(transfer_log=transfer_log)
         except transfer.TransferError as e:
             raise DelivererRsyncError(e)
+        self.transfer_stats = self.rsync_stats(transfer_log, started)
+        self.spans.record(
+            'rsync', self.transfer_stats.get('elapsed_seconds', time.time() - started), started=started,
+            bytes=self.transfer_stats.get('bytes_sent', 0), files=self.transfer_stats.get('files_transferred', 0))
+        # if the statistics could not be read, count the bytes that were staged
+        self.record_transfer(
+            'rsync',
+            self.transfer_stats.get('bytes_sent', self.staged_bytes),
+            self.transfer_stats.get('elapsed_seconds', time.time() - started))
+        return transferred
+
+    def rsync_stats(self, transfer_log, started):
+        """ Read the statistics of a transfer from the rsync output
+
+            :param string transfer_log: the path prefix of the transfer log files
+            :param float started: the time the transfer started, as a unix timestamp
+            :returns: a dict with the fields from parse_rsync_stats, the elapsed
+                time of the transfer and the resulting throughput, or an empty
+                dict if the output could not be read
+        """
+        outfile = "{}_rsync.out".format(transfer_log)
+        try:
+            with open(outfile, 'r') as fh:
+                stats = parse_rsync_stats(fh)
+            # the output is closed when rsync exits, the transfer is validated after that
+            elapsed = max(os.path.getmtime(outfile) - started, 0.0)
+        except (IOError, OSError) as e:
+            logger.warning("could not read the rsync statistics for {}: {}".format(str(self), e))
+            return {}
+        stats['elapsed_seconds'] = round(elapsed, 3)
+        if 'bytes_sent' in stats and elapsed > 0:
+            stats['bytes_per_second'] = int(stats['bytes_sent'] / elapsed)
+        logger.info("{}: rsync sent {} bytes ({} literal, {} matched) for {} of {} files in {:.1f} s".format(
+            str(self), stats.get('bytes_sent'), stats.get('literal_data'), stats.get('matched_data'),
+            stats.get('files_transferred'), stats.get('files'), elapsed))
+        return stats
+
+    def verify_delivered_files(self):
+        """ Hash the delivered files again, in parallel, and compare them with the
+            delivered digest file. If remote_host is set, the files are hashed on
+            the remote host by a helper run over ssh. The files which do not match
+            are written to a file next to the transfer logs.
+
+            :returns: the verify.VerificationResult
+            :raises DelivererVerificationError: if any file is missing or does not
+                match its digest, or if the verification could not be done
+        """
+        digestfile = self.delivered_digestfile()
+        remote_host = getattr(self, 'remote_host', None)
+        try:
+            if remote_host:
+                result = verify.verify_remote(
+                    digestfile, remote_host, remote_user=getattr(self, 'remote_user', None),
+                    hash_algorithm=self.hash_algorithm, workers=self.verify_workers,
+                    python=getattr(self, 'verify_remote_python', 'python'))
+            else:
+                result = verify.verify_digestfile(
+                    digestfile, hash_algorithm=self.hash_algorithm, workers=self.verify_workers)
+        except verify.VerificationError as e:
+            raise DelivererVerificationError(e)
+        logger.info("{}: verified {} files, {} bytes in {:.1f} s ({:.2f} MB/s), {} mismatches".format(
+            str(self), result.files, result.bytes, result.seconds, result.bytes_per_second / 1e6,
+            len(result.mismatches)))
+        metrics.inc('taca_deliver_verified_bytes_total', result.bytes, cluster=self.cluster)
+        metrics.inc('taca_deliver_verification_seconds_total', result.seconds, cluster=self.cluster)
+        if self.transfer_stats is not None:
+            self.transfer_stats.update({
+                'verified_bytes': result.bytes,
+                'verified_bytes_per_second': result.bytes_per_second})
+        if not result.ok:
+            mismatchfile = self.expand_path(
+                os.path.join(self.logpath, "{}_mismatches.txt".format(self.sampleid or self.projectid)))
+            try:
+                create_folder(os.path.dirname(mismatchfile))
+                with open(mismatchfile, 'w') as fh:
+                    for fpath, expected, actual in result.mismatches:
+                        fh.write("{}\t{}\t{}\n".format(fpath, expected, actual or "MISSING"))
+            except (IOError, OSError) as e:
+                logger.warning("could not write the verification mismatches to {}: {}".format(mismatchfile, e))
+            raise DelivererVerificationError(
+                "{} delivered files are missing or do not match {} (listed in {}): {}".format(
+                    len(result.mismatches), digestfile, mismatchfile,
+                    ", ".join([m[0] for m in result.mismatches[:10]])))
+        return result
+
+    def record_transfer(self, protocol, nbytes, seconds):
+        """ Add a transfer to the throughput metrics
+
+            :param string protocol: the transfer protocol, e.g. 'rsync' or 'sftp'
+            :param int nbytes: the number of bytes transferred
+            :param float seconds: the duration of the transfer
+        """
+        metrics.inc('taca_deliver_transferred_bytes_total', nbytes, cluster=self.cluster, protocol=protocol)
+        metrics.inc('taca_deliver_transfer_seconds_total', seconds, cluster=self.cluster, protocol=protocol)
 
     def delivered_digestfile(self):
         """
@@ -273,6 +605,24 @@ class Deliverer(object):
             os.path.join(
                 self.stagingpath,
                 "{}.lst".format(self.sampleid)))
+
+    def staging_manifestfile(self):
+        """
+            :returns: path to the manifest of the staged files, next to the
+                digest file
+        """
+        return "{}.manifest.json".format(os.path.splitext(self.staging_digestfile())[0])
+
+    def delivered_manifestfile(self):
+        """
+            :returns: path to the copy of the manifest of the last successful
+                delivery, next to the delivery acknowledgement
+        """
+        return self.expand_path(
+            os.path.join(
+                self.deliverystatuspath,
+                "{}_delivered.manifest.json".format(
+                    os.path.basename(self.staging_manifestfile())[:-len(".manifest.json")])))
  
     def transfer_log(self):
         """
@@ -285,6 +635,16 @@ class Deliverer(object):
                 "{}_{}".format(self.sampleid,
                                datetime.datetime.now().strftime("%Y%m%dT%H%M%S"))))
 
+    def timing_log(self):
+        """
+            :returns: path to the file the timing spans of the delivery are
+                appended to, next to the transfer logs
+        """
+        return self.expand_path(
+            os.path.join(
+                self.logpath,
+                "{}_timing.jsonl".format(self.sampleid or self.projectid)))
+
     def expand_path(self, path):
         """ Will expand a path by replacing placeholders with correspondingly 
             named attributes belonging to this Deliverer instance. Placeholders
@@ -419,6 +779,7 @@ class ProjectDeliverer(Deliverer):
         """
         return db.project_entry(db.dbcon(), self.projectid)
 
+    @delivery_metrics('project')
     def deliver_project(self):
         """ Deliver all samples in a project to the destination specified by 
             deliverypath
@@ -448,6 +809,7 @@ class ProjectDeliverer(Deliverer):
             if os.path.exists(self.expand_path(self.stagingpath)):
                 # Try to deliver any miscellaneous files for the project (like reports, analysis)
                 ProjectMiscDeliverer(self.projectid).deliver_misc_data()
+                self.write_project_manifest()
             # query the database whether all samples in the project have been sucessfully delivered
             if self.all_samples_delivered():
                 # this is the only delivery status we want to set on the project level, in order to avoid concurrently
@@ -481,6 +843,37 @@ class ProjectDeliverer(Deliverer):
         except (db.DatabaseError, DelivererInterruptedError, Exception):
             raise
 
+    def staging_manifestfile(self):
+        """
+            :returns: path to the manifest of the whole project, in the staging path
+        """
+        return self.expand_path(os.path.join(self.stagingpath, "{}.manifest.json".format(self.projectid)))
+
+    def write_project_manifest(self):
+        """ Merge the manifests of the staged samples and miscellaneous files into
+            a manifest of the whole project, so that two stagings of the project
+            can be compared by their root digests
+            :returns: path to the project manifest, or None if nothing was staged
+                with a manifest
+        """
+        projectmanifest = self.staging_manifestfile()
+        manifests = []
+        for path in sorted(glob.glob(os.path.join(self.expand_path(self.stagingpath), "*.manifest.json"))):
+            if path == projectmanifest:
+                continue
+            try:
+                manifests.append(manifest.read(path))
+            except (IOError, ValueError) as e:
+                logger.warning("could not read the manifest {} of {}: {}".format(path, str(self), e))
+        if not manifests:
+            return None
+        try:
+            manifest.write(manifest.merge(manifests), projectmanifest)
+        except (IOError, ValueError) as e:
+            logger.warning("could not write the manifest of {}: {}".format(str(self), e))
+            return None
+        return projectmanifest
+
     def update_delivery_status(self, status="DELIVERED"):
         """ Update the delivery_status field in the database to the supplied 
             status for the project specified by this instance
@@ -518,12 +911,20 @@ class ProjectMiscDeliverer(Deliverer):
         if self.files_to_deliver == None:
             logger.info("No miscellaneous files to deliver for project {}".format(self.projectid))
             return False
-        if not self.stage_delivery():
+        with io_slot():
+            staged = self.stage_delivery()
+        if not staged:
             logger.warning("Miscellaneous files were not properly staged for project {}".format(self.projectid))
             return False
         if not self.stage_only:
-            if not self.do_delivery():
+            with io_slot():
+                delivered = self.do_delivery()
+            if not delivered:
                 raise DelivererError("Miscellaneous files for project {} was not properly delivered".format(self.projectid))
+            if self.verify_delivery:
+                with io_slot():
+                    self.verify_delivered_files()
+            self.record_delivered_manifest()
         return True
 
 
@@ -578,6 +979,7 @@ class SampleDeliverer(Deliverer):
         """
         return db.sample_entry(db.dbcon(), self.projectid, self.sampleid)
 
+    @delivery_metrics('sample')
     def deliver_sample(self, sampleentry=None):
         """ Deliver a sample to the destination specified by the config.
             Will check if the sample has already been delivered and should not
@@ -602,33 +1004,36 @@ class SampleDeliverer(Deliverer):
             else:
                 logger.info("Staging {}".format(str(self)))
             try:
-                if self.get_analysis_status(sampleentry) != 'ANALYZED':
-                    if not self.force and not self.ignore_analysis_status:
-                        logger.info("{} has not finished analysis and will not be delivered".format(str(self)))
+                with self.spans.span('status_checks'):
+                    # fetch the entry once for all the checks below, rather than once for each status
+                    sampleentry = sampleentry or self.db_entry()
+                    if self.get_analysis_status(sampleentry) != 'ANALYZED':
+                        if not self.force and not self.ignore_analysis_status:
+                            logger.info("{} has not finished analysis and will not be delivered".format(str(self)))
+                            return False
+                    if self.get_delivery_status(sampleentry) == 'DELIVERED' \
+                            and not self.force:
+                        logger.info("{} has already been delivered. Sample will not be delivered again this time.".format(str(self)))
+                        return True
+                    if self.get_delivery_status(sampleentry) == 'IN_PROGRESS' \
+                            and not self.force:
+                        logger.info("delivery of {} is already in progress".format(
+                            str(self)))
+                        return False
+                    if self.get_sample_status(sampleentry) == 'ABORTED':
+                        logger.info("{} has been marked as ABORTED and will not be delivered".format(str(self)))
+                        #set it to delivered as ABORTED samples should not fail the status of a project
+                        if  self.get_delivery_status(sampleentry):
+                            #if status is set, then overwrite it to NOT_DELIVERED
+                            self.update_delivery_status(status="NOT_DELIVERED")
+                        #otherwhise leave it empty. Return True as an aborted sample should not fail a delivery
+                        return True
+                    if self.get_sample_status(sampleentry) == 'FRESH' \
+                            and not self.force:
+                        logger.info("{} is marked as FRESH (new unporcessed data is available)and will not be delivered".format(str(self)))
                         return False
-                if self.get_delivery_status(sampleentry) == 'DELIVERED' \
-                        and not self.force:
-                    logger.info("{} has already been delivered. Sample will not be delivered again this time.".format(str(self)))
-                    return True
-                if self.get_delivery_status(sampleentry) == 'IN_PROGRESS' \
-                        and not self.force:
-                    logger.info("delivery of {} is already in progress".format(
-                        str(self)))
-                    return False
-                if self.get_sample_status(sampleentry) == 'ABORTED':
-                    logger.info("{} has been marked as ABORTED and will not be delivered".format(str(self)))
-                    #set it to delivered as ABORTED samples should not fail the status of a project
-                    if  self.get_delivery_status(sampleentry):
-                        #if status is set, then overwrite it to NOT_DELIVERED
-                        self.update_delivery_status(status="NOT_DELIVERED")
-                    #otherwhise leave it empty. Return True as an aborted sample should not fail a delivery
-                    return True
-                if self.get_sample_status(sampleentry) == 'FRESH' \
-                        and not self.force:
-                    logger.info("{} is marked as FRESH (new unporcessed data is available)and will not be delivered".format(str(self)))
-                    return False
-                if self.get_delivery_status(sampleentry) == 'FAILED':
-                    logger.info("retrying delivery of previously failed sample {}".format(str(self)))
+                    if self.get_delivery_status(sampleentry) == 'FAILED':
+                        logger.info("retrying delivery of previously failed sample {}".format(str(self)))
             except db.DatabaseError as e:
                 logger.error(
                     "error '{}' occurred during delivery of {}".format(
@@ -636,12 +1041,14 @@ class SampleDeliverer(Deliverer):
                 raise
             # set the delivery status to in_progress which will also mean that any concurrent deliveries
             # will leave this sample alone
-            self.update_delivery_status(status="IN_PROGRESS")
+            with self.spans.span('charon_update', status="IN_PROGRESS"):
+                self.update_delivery_status(status="IN_PROGRESS")
             # an error with the reports should not abort the delivery, so handle
             try:
                 if self.report_sample and self.report_aggregate:
                     logger.info("creating sample reports")
-                    self.create_report()
+                    with self.spans.span('create_report'):
+                        self.create_report()
             except AttributeError:
                 pass
             except Exception as e:
@@ -649,20 +1056,32 @@ class SampleDeliverer(Deliverer):
                     "failed to create reports for {}, reason: {}".format(
                         self, e))
             # stage the delivery
-            if not self.stage_delivery():
+            with io_slot():
+                staged = self.stage_delivery()
+            if not staged:
                 raise DelivererError("sample was not properly staged")
             logger.info("{} successfully staged".format(str(self)))
             if not self.stage_only:
                 # perform the delivery
-                if not self.do_delivery():
+                with io_slot(), self.spans.span('do_delivery'):
+                    delivered = self.do_delivery()
+                if not delivered:
                     raise DelivererError("sample was not properly delivered")
+                if self.verify_delivery:
+                    # a mismatch raises, which marks the sample as FAILED
+                    with io_slot(), self.spans.span('verify_delivery') as span:
+                        verified = self.verify_delivered_files()
+                        span.add(files=verified.files, bytes=verified.bytes)
                 logger.info("{} successfully delivered".format(str(self)))
                 # set the delivery status in database
-                self.update_delivery_status()
+                with self.spans.span('charon_update', status="DELIVERED"):
+                    self.update_delivery_status()
                 # write a delivery acknowledgement to disk
                 self.acknowledge_delivery()
+                self.record_delivered_manifest()
             else:
-                self.update_delivery_status(status="STAGED")
+                with self.spans.span('charon_update', status="STAGED"):
+                    self.update_delivery_status(status="STAGED")
             return True
         except DelivererInterruptedError:
             self.update_delivery_status(status="NOT_DELIVERED")
@@ -6,6 +6,9 @@ import getpass
 import glob
 import time
 import stat
+import threading
+import posixpath
+import Queue
 
 from deliver import *
 
@@ -23,6 +26,8 @@ class CastorProjectDeliverer(ProjectDeliverer):
         self.castordeliverypath = getattr(self, 'castordeliverypath', None)
         self.castorsftpserver = getattr(self, 'castorsftpserver', None)
         self.castorsftpserver_user = getattr(self, 'castorsftpserver_user', None)
+        # number of parallel sftp channels to upload files over
+        self.castorsftpchannels = int(getattr(self, 'castorsftpchannels', 1))
     
     def create_sftp_connnection(self):
         try:
@@ -45,6 +50,7 @@ class CastorProjectDeliverer(ProjectDeliverer):
             logger.error("Caught exception: {}: {}".format(e.__class__, e))
             raise
 
+    @delivery_metrics('project')
     def deliver_project(self):
         """ Deliver all samples in a project to castor
             
@@ -97,12 +103,17 @@ class CastorSampleDeliverer(SampleDeliverer):
         A class for handling sample deliveries to castor
     """
 
+    # the files are uploaded over sftp, without a local delivered digest file to verify against
+    supports_verification = False
+
     def __init__(self, projectid=None, sampleid=None, sftp_client=None, **kwargs):
         super(CastorSampleDeliverer, self).__init__(
             projectid,
             sampleid,
             **kwargs)
         self.sftp_client = sftp_client
+        # number of parallel sftp channels to upload files over
+        self.castorsftpchannels = int(getattr(self, 'castorsftpchannels', 1))
 
 
     def do_delivery(self):
@@ -118,10 +129,15 @@ class CastorSampleDeliverer(SampleDeliverer):
             #walk through the staging path and recreate the same path in castor and put files there
             origin_folder_sample = os.path.join(self.expand_path(self.stagingpath), self.sampleid)
             #create the sample folder
-            self.sftp_client.mkdir(self.sampleid, ignore_existing=True)
+            self.sftp_client.makedirs(self.sampleid)
             #now target dir is created
             targed_dir = self.sampleid
-            self.sftp_client.put_dir(origin_folder_sample ,targed_dir)
+            with self.spans.span('sftp_upload', channels=self.castorsftpchannels) as span:
+                totals = self.sftp_client.put_dir(origin_folder_sample ,targed_dir, channels=self.castorsftpchannels)
+                span.add(files=totals['files'], skipped=totals['skipped'], bytes=totals['bytes'])
+            self.record_transfer('sftp', totals['bytes'], totals['seconds'])
+            logger.info("{}: uploaded {} files, skipped {} files already on castor".format(
+                self.sampleid, totals['files'], totals['skipped']))
             #now copy the md5
             source_md5 = os.path.join(self.expand_path(self.stagingpath), "{}.md5".format(self.sampleid))
             target_md5 = os.path.join(self.sftp_client.getcwd(), "{}.md5".format(self.sampleid))
@@ -136,9 +152,20 @@ class CastorSampleDeliverer(SampleDeliverer):
 
 
 
+def _throughput(nbytes, seconds):
+    """ :returns: the throughput in MB/s """
+    return nbytes / 1e6 / seconds if seconds > 0 else 0.0
+
+
 ###http://stackoverflow.com/questions/4409502/directory-transfers-on-paramiko
 class MySFTPClient(paramiko.SFTPClient):
-    
+
+    def __init__(self, sock):
+        super(MySFTPClient, self).__init__(sock)
+        # remote folders known to exist, as normalized paths, filled from listings and
+        # successful mkdirs in order to save round trips to the server
+        self._known_dirs = set()
+
     def rm_dir(self, target):
         ''' Removes recoursevely contents of the target directory.
         Hidden method to be called only for testing purpose (we are not supposed to delver stuff we have delivered
@@ -152,30 +179,246 @@ class MySFTPClient(paramiko.SFTPClient):
         self.rmdir(target)
     
 
-    def put_dir(self, source, target):
+    def put_dir(self, source, target, channels=1):
         ''' Uploads the contents of the source directory to the target path. The
             target directory needs to exists. All subdirectories in source are 
-            created under target.
+            created under target. If more than one channel is requested, the files
+            are uploaded in parallel over that many sftp channels on the transport
+            of this client, see put_dir_parallel.
+
+            Files already uploaded are skipped and partially uploaded files are
+            resumed (see put_file), so an interrupted upload can be restarted.
+            Each remote folder is listed once to get the state of its files.
+
+            :returns: a dict with the number of files uploaded and skipped, the
+                number of bytes sent and the elapsed time in seconds
         '''
+        if channels > 1:
+            return self.put_dir_parallel(source, target, channels)
+        totals = {'files': 0, 'skipped': 0, 'bytes': 0}
+        started = time.time()
+        self._put_dir_serial(source, target, totals)
+        totals['seconds'] = time.time() - started
+        return totals
+
+    def _put_dir_serial(self, source, target, totals, remote_attrs=None):
+        if remote_attrs is None:
+            remote_attrs = self.listdir_attrs(target)
         for item in os.listdir(source):
-            
             if os.path.isfile(os.path.join(source, item)):
-                self.put(os.path.join(source, item), "{}/{}".format(target, item))
+                nbytes = self.put_file(
+                    os.path.join(source, item), "{}/{}".format(target, item), remote_attrs.get(item))
+                if nbytes is None:
+                    totals['skipped'] += 1
+                else:
+                    totals['files'] += 1
+                    totals['bytes'] += nbytes
+            elif self.is_known_dir("{}/{}".format(target, item)):
+                self._put_dir_serial(os.path.join(source, item), "{}/{}".format(target, item), totals)
             else:
-                self.mkdir("{}/{}".format(target, item), ignore_existing=True)
-                self.put_dir(os.path.join(source, item),"{}/{}".format(target, item))
+                self.makedirs("{}/{}".format(target, item))
+                # a new folder is empty, no need to list it
+                self._put_dir_serial(os.path.join(source, item), "{}/{}".format(target, item), totals, {})
+
+    def put_dir_parallel(self, source, target, channels):
+        ''' Uploads the contents of the source directory to the target path over
+            several sftp channels opened on the transport of this client, so no
+            new authentication is needed. The target directory needs to exist.
+            All subdirectories are created first, then the files are scheduled
+            over the channels largest first. The throughput of each channel and
+            the aggregate throughput are logged.
+
+            :returns: a dict with the number of files uploaded and skipped, the
+                number of bytes sent and the elapsed time in seconds
+        '''
+        # sftp channels start in the home directory, so resolve the target against the current one
+        target = self.normalize(target)
+        files = []
+        new_dirs = set()
+        for parentdir, dirs, dirfiles in os.walk(source, followlinks=True):
+            remotedir = posixpath.join(target, os.path.relpath(parentdir, source)) \
+                if parentdir != source else target
+            # a new folder is empty, no need to list it
+            remote_attrs = self.listdir_attrs(remotedir) if remotedir not in new_dirs else {}
+            for item in dirs:
+                if not self.is_known_dir(posixpath.join(remotedir, item)):
+                    self.makedirs(posixpath.join(remotedir, item))
+                    new_dirs.add(posixpath.join(remotedir, item))
+            for item in dirfiles:
+                localpath = os.path.join(parentdir, item)
+                files.append((os.path.getsize(localpath), localpath, posixpath.join(remotedir, item),
+                              remote_attrs.get(item)))
+        queue = Queue.Queue()
+        for item in sorted(files, key=lambda f: f[0], reverse=True):
+            queue.put(item)
+        transport = self.get_channel().get_transport()
+        results = [None] * min(channels, max(len(files), 1))
+        errors = []
+
+        def _upload(index):
+            nfiles = nskipped = nbytes = 0
+            started = time.time()
+            try:
+                client = MySFTPClient.from_transport(transport)
+                try:
+                    while not errors:
+                        try:
+                            _, localpath, remotepath, remote_attr = queue.get_nowait()
+                        except Queue.Empty:
+                            break
+                        sent = client.put_file(localpath, remotepath, remote_attr)
+                        if sent is None:
+                            nskipped += 1
+                        else:
+                            nfiles += 1
+                            nbytes += sent
+                finally:
+                    client.close()
+            except Exception as e:
+                errors.append(e)
+            results[index] = (nfiles, nskipped, nbytes, time.time() - started)
+
+        started = time.time()
+        workers = [threading.Thread(target=_upload, args=(i,)) for i in range(len(results))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            # join with a timeout, so that signals are still handled while waiting
+            while worker.is_alive():
+                worker.join(0.5)
+        elapsed = time.time() - started
+        if errors:
+            raise errors[0]
+        totals = {'files': 0, 'skipped': 0, 'bytes': 0, 'seconds': elapsed}
+        for index, (nfiles, nskipped, nbytes, seconds) in enumerate(results):
+            logger.info("sftp channel {} uploaded {} files, {} bytes in {:.1f} s ({:.2f} MB/s)".format(
+                index, nfiles, nbytes, seconds, _throughput(nbytes, seconds)))
+            totals['files'] += nfiles
+            totals['skipped'] += nskipped
+            totals['bytes'] += nbytes
+        logger.info("uploaded {} files ({} already present), {} bytes from {} over {} sftp channels in {:.1f} s "
+                    "({:.2f} MB/s)".format(totals['files'], totals['skipped'], totals['bytes'], source, len(results),
+                                           elapsed, _throughput(totals['bytes'], elapsed)))
+        return totals
+
+    def put_file(self, localpath, remotepath, remote_attr=None):
+        ''' Uploads a file, unless the remote file already has the same size and,
+            if the server reports it, the same modification time. A remote file
+            which is shorter than the local file, and matches it where they
+            overlap, is resumed from where it ends. The modification time of the
+            local file is set on the remote file after the upload.
+
+            :param string localpath: the file to upload
+            :param string remotepath: the remote path to upload to
+            :param remote_attr: the SFTPAttributes of the remote file, None if it
+                does not exist
+            :returns: the number of bytes sent, or None if the file was skipped
+        '''
+        local_stat = os.stat(localpath)
+        offset = 0
+        if remote_attr is not None and not stat.S_ISDIR(remote_attr.st_mode or 0):
+            if remote_attr.st_size == local_stat.st_size and \
+                    (remote_attr.st_mtime is None or int(remote_attr.st_mtime) == int(local_stat.st_mtime)):
+                return None
+            if 0 < remote_attr.st_size < local_stat.st_size and \
+                    self._matches_local(localpath, remotepath, remote_attr.st_size):
+                offset = remote_attr.st_size
+        if offset > 0:
+            logger.info("resuming upload of {} from byte {}".format(localpath, offset))
+            self._append_file(localpath, remotepath, offset)
+        else:
+            self.put(localpath, remotepath)
+        try:
+            self.utime(remotepath, (local_stat.st_atime, local_stat.st_mtime))
+        except IOError as e:
+            logger.debug("could not set the modification time of {}: {}".format(remotepath, e))
+        return local_stat.st_size - offset
+
+    def listdir_attrs(self, path):
+        ''' Lists a remote folder with a single request
+            :returns: a dict with the SFTPAttributes of the folder entries, keyed
+                by name, or an empty dict if the folder does not exist
+        '''
+        try:
+            attrs = dict([(attr.filename, attr) for attr in self.listdir_attr(path)])
+        except IOError:
+            return {}
+        self._known_dirs.add(self._dir_key(path))
+        for name, attr in attrs.items():
+            if stat.S_ISDIR(attr.st_mode or 0):
+                self._known_dirs.add(self._dir_key(posixpath.join(path, name)))
+        return attrs
+
+    def _matches_local(self, localpath, remotepath, size, blocksize=65536):
+        ''' Compares the last block of a partially uploaded file with the local file '''
+        start = max(0, size - blocksize)
+        with open(localpath, 'rb') as lfh, self.open(remotepath, 'rb') as rfh:
+            lfh.seek(start)
+            rfh.seek(start)
+            return lfh.read(size - start) == rfh.read(size - start)
+
+    def _append_file(self, localpath, remotepath, offset, blocksize=32768):
+        with open(localpath, 'rb') as lfh, self.open(remotepath, 'r+b') as rfh:
+            rfh.set_pipelined(True)
+            lfh.seek(offset)
+            rfh.seek(offset)
+            data = lfh.read(blocksize)
+            while data:
+                rfh.write(data)
+                data = lfh.read(blocksize)
 
     def mkdir(self, path, mode=511, ignore_existing=False):
-        ''' Augments mkdir by adding an option to not fail if the folder exists  '''
+        ''' Augments mkdir by adding an option to not fail if the folder exists.
+            Folders known to exist are not requested again.
+        '''
+        if ignore_existing and self.is_known_dir(path):
+            return
         try:
             super(MySFTPClient, self).mkdir(path, mode)
         except IOError:
-            if ignore_existing:
-                pass
-            else:
+            # only an existing folder is ignored, e.g. not a missing parent or a file in the way
+            if not ignore_existing or not self._remote_isdir(path):
                 raise
+        self._known_dirs.add(self._dir_key(path))
 
+    def makedirs(self, path, mode=511):
+        ''' Creates a remote folder and any missing parents. If the parent is known
+            to exist, this takes a single request. Otherwise, the deepest existing
+            parent is searched for upwards and the missing folders are created from
+            there.
+        '''
+        key = self._dir_key(path)
+        if key in self._known_dirs:
+            return
+        parent = posixpath.dirname(key)
+        if parent and parent != key and parent not in self._known_dirs:
+            try:
+                super(MySFTPClient, self).mkdir(key, mode)
+                self._known_dirs.add(key)
+                return
+            except IOError:
+                # either the folder exists or its parent is missing
+                if self._remote_isdir(key):
+                    self._known_dirs.add(key)
+                    return
+                self.makedirs(parent, mode)
+        self.mkdir(key, mode, ignore_existing=True)
 
+    def rmdir(self, path):
+        super(MySFTPClient, self).rmdir(path)
+        key = self._dir_key(path)
+        self._known_dirs = set([d for d in self._known_dirs if d != key and not d.startswith(key + '/')])
 
+    def is_known_dir(self, path):
+        ''' :returns: True if the remote folder is known to exist, without asking the server '''
+        return self._dir_key(path) in self._known_dirs
 
+    def _remote_isdir(self, path):
+        try:
+            return stat.S_ISDIR(self.stat(path).st_mode)
+        except IOError:
+            return False
 
+    def _dir_key(self, path):
+        # relative paths are resolved against the current folder, if one has been set
+        return posixpath.normpath(posixpath.join(self.getcwd() or '', path))
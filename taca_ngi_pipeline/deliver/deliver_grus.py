@@ -14,7 +14,9 @@ import logging
 import couchdb
 import json
 import subprocess
+import heapq
 from dateutil import parser
+from dateutil.tz import tzutc
 import sys
 import re
 import shutil
@@ -23,10 +25,33 @@ from ngi_pipeline.database.classes import CharonSession, CharonError
 from taca.utils.filesystem import do_copy, create_folder
 from taca.utils.config import CONFIG
 
-from deliver import ProjectDeliverer, SampleDeliverer, DelivererInterruptedError
+from deliver import ProjectDeliverer, SampleDeliverer, DelivererInterruptedError, delivery_metrics
+from ..utils import filesystem as fs
+from ..utils.cache import LookupCache
+from ..utils.concurrency import BackgroundCall
 
 logger = logging.getLogger(__name__)
 
+def _delivery_started(dbentry, default):
+    """ Parses the time a delivery was started, as recorded in Charon, into a naive UTC datetime
+
+        :param dict dbentry: the Charon project entry
+        :param datetime default: the time to return if no start time has been recorded
+        :returns: the time the delivery was started, or default if it is missing or malformed
+    """
+    started = dbentry.get('delivery_started')
+    if not started:
+        return default
+    try:
+        started = parser.parse(started)
+    except (ValueError, OverflowError, TypeError, AttributeError):
+        logger.warning("Cannot parse the delivery start time {} recorded in Charon, using {} instead".format(
+            started, default))
+        return default
+    if started.tzinfo is not None:
+        started = started.astimezone(tzutc()).replace(tzinfo=None)
+    return started
+
 yes = set(['yes','y', 'ye'])
 no = set(['no','n'])
 def proceed_or_not(question):
@@ -56,7 +81,7 @@ def check_mover_version():
 class GrusProjectDeliverer(ProjectDeliverer):
     """ This object takes care of delivering project samples to castor's wharf.
     """
-    def __init__(self, projectid=None, sampleid=None, pi_email=None, sensitive=True, hard_stage_only=False, **kwargs):
+    def __init__(self, projectid=None, sampleid=None, pi_email=None, sensitive=True, hard_stage_only=False, refresh_cache=False, prefetch=False, **kwargs):
         super(GrusProjectDeliverer, self).__init__(
             projectid,
             sampleid,
@@ -75,6 +100,34 @@ class GrusProjectDeliverer(ProjectDeliverer):
         self.pi_email  = pi_email
         self.sensitive = sensitive
         self.hard_stage_only = hard_stage_only
+        # fraction of the free space and inodes on stagingpathhard to keep in reserve when hard staging
+        self.stagingpathhard_margin = float(getattr(self, 'stagingpathhard_margin', 0.05))
+        # seconds between the moverinfo calls when monitoring a single delivery
+        self.mover_poll_interval = float(getattr(self, 'mover_poll_interval', 900))
+        # cache for the PI lookups in StatusDB, the order portal and SUPR, shared between runs
+        self.lookup_cache = LookupCache(
+            self.expand_path(getattr(self, 'lookup_cache', None)),
+            ttl=float(getattr(self, 'lookup_cache_ttl_days', 7)) * 24 * 3600,
+            refresh=refresh_cache)
+        # lookups in external services started in the background, see prefetch
+        self._prefetched = None
+        if prefetch:
+            self.prefetch()
+
+    def prefetch(self):
+        """ Starts the independent lookups in external services that deliver_project needs (mover version,
+            PI e-mail and SUPR id and the staged samples in Charon) in the background, so that they run
+            concurrently with each other and with the interactive prompts. The results are awaited where
+            they are used. Calling this more than once has no effect.
+        """
+        if self._prefetched is not None:
+            return
+        pi_email = BackgroundCall(self._get_pi_email) if self.pi_email is None else None
+        self._prefetched = {
+            'mover_version': BackgroundCall(check_mover_version),
+            'pi_email': pi_email,
+            'pi_id': BackgroundCall(lambda: self._get_pi_id(pi_email.result() if pi_email else self.pi_email)),
+            'staged_samples': BackgroundCall(self.get_samples_from_charon, delivery_status="STAGED")}
 
     def get_delivery_status(self, dbentry=None):
         """ Returns the delivery status for this sample. If a sampleentry
@@ -110,11 +163,9 @@ class GrusProjectDeliverer(ProjectDeliverer):
         # if it's 'IN_PROGRESS', checking moverinfo
         delivery_token = self.db_entry().get('delivery_token')
         logger.info("Project {} under delivery. Delivery token is {}. Starting monitoring:".format(self.projectid, delivery_token))
-        delivery_status = 'IN_PROGRESS'
-        not_monitoring = False
-        max_delivery_time = relativedelta(days=7)
-        monitoring_start = datetime.datetime.now()
-        while ( not not_monitoring ):
+        delivery_status = None
+        monitoring_start = datetime.datetime.utcnow()
+        while delivery_status is None:
             try:
                 cmd = ['moverinfo', '-i', delivery_token]
                 output=subprocess.check_output(cmd, stderr=subprocess.STDOUT)
@@ -127,74 +178,85 @@ class GrusProjectDeliverer(ProjectDeliverer):
             else:
                 #Moverinfo output with option -i can be: InProgress, Accepted, Failed,
                 mover_status = output.split(':')[0]
-                if mover_status == 'Delivered':
-                    # check the filesystem anyway
-                    if os.path.exists(self.expand_path(self.stagingpathhard)):
-                        logger.error('Delivery {} for project {} delivered done but project folder found in DELIVERY_HARD. Failing delivery.'.format(delivery_token, self.projectid))
-                        delivery_status =  'FAILED'
-                    else:
-                        logger.info("Project {} succefully delivered. Delivery token is {}.".format(self.projectid, delivery_token))
-                        delivery_status = 'DELIVERED'
-                    not_monitoring = True #stop the monitoring, it is either failed or delivered
-                    continue
-                else:
-                    #check for how long time delivery has been going on
-                    if self.db_entry().get('delivery_started'):
-                        delivery_started = self.db_entry().get('delivery_started')
-                    else:
-                        delivery_started = monitoring_start #the first time I checked the status, not necessarly when it begun
-                    now = datetime.datetime.now()
-                    if now -  max_delivery_time > delivery_started:
-                        logger.error('Delivery {} for project {} has been ongoing for more than 48 hours. Check what the f**k is going on. The project status will be reset'.format(delivery_token, self.projectid))
-                        delivery_status = 'FAILED'
-                        not_monitoring = True #stop the monitoring, it is taking too long
-                        continue
-                if  mover_status == 'Accepted':
-                    logger.info("Project {} under delivery. Status for delivery-token {} is : {}".format(self.projectid, delivery_token, mover_status))
-                elif mover_status == 'Failed':
-                    logger.warn("Project {} under delivery (attention mover returned {}). Status for delivery-token {} is : {}".format(self.projectid, mover_status, delivery_token, mover_status))
-                elif mover_status == 'InProgress':
-                    #this is an error because it is a new status
-                    logger.info("Project {} under delivery. Status for delivery-token {} is : {}".format(self.projectid, delivery_token, mover_status))
-                else:
-                    logger.warn("Project {} under delivery. Unexpected status-delivery returned by mover for delivery-token {}: {}".format(self.projectid, delivery_token, mover_status))
-            time.sleep(900) #sleep for 15 minutes and then check again the status
-        #I am here only if not_monitoring is True, that is only if mover status was delivered or the delivery is ongoing for more than 48h
+                # a single look at Charon per cycle
+                delivery_started = _delivery_started(self.db_entry(), monitoring_start)
+                delivery_status = self.evaluate_mover_status(mover_status, delivery_token, delivery_started)
+            if delivery_status is None:
+                time.sleep(self.mover_poll_interval) #sleep (15 minutes by default) and then check again the status
+        #I am here only if mover status was delivered or the delivery is ongoing for more than 7 days
+        self.finalize_mover_delivery(delivery_status)
+
+    def evaluate_mover_status(self, mover_status, delivery_token, delivery_started, max_delivery_time=relativedelta(days=7)):
+        """ Decides, based on the status reported by moverinfo, if the monitoring of a delivery is over
+
+            :param string mover_status: the status reported by moverinfo, e.g. Delivered, Accepted or InProgress
+            :param string delivery_token: the mover delivery token of this project
+            :param datetime delivery_started: when the delivery was started (or first seen), in UTC
+            :param relativedelta max_delivery_time: for how long a delivery is allowed to be ongoing
+            :returns: 'DELIVERED' or 'FAILED' if the delivery is over, None if it is still ongoing
+        """
+        if mover_status == 'Delivered':
+            # check the filesystem anyway
+            if os.path.exists(self.expand_path(self.stagingpathhard)):
+                logger.error('Delivery {} for project {} delivered done but project folder found in DELIVERY_HARD. Failing delivery.'.format(delivery_token, self.projectid))
+                return 'FAILED'
+            logger.info("Project {} succefully delivered. Delivery token is {}.".format(self.projectid, delivery_token))
+            return 'DELIVERED'
+        #check for how long time delivery has been going on
+        if datetime.datetime.utcnow() - max_delivery_time > delivery_started:
+            logger.error('Delivery {} for project {} has been ongoing for more than 48 hours. Check what the f**k is going on. The project status will be reset'.format(delivery_token, self.projectid))
+            return 'FAILED'
+        if  mover_status == 'Accepted':
+            logger.info("Project {} under delivery. Status for delivery-token {} is : {}".format(self.projectid, delivery_token, mover_status))
+        elif mover_status == 'Failed':
+            logger.warn("Project {} under delivery (attention mover returned {}). Status for delivery-token {} is : {}".format(self.projectid, mover_status, delivery_token, mover_status))
+        elif mover_status == 'InProgress':
+            #this is an error because it is a new status
+            logger.info("Project {} under delivery. Status for delivery-token {} is : {}".format(self.projectid, delivery_token, mover_status))
+        else:
+            logger.warn("Project {} under delivery. Unexpected status-delivery returned by mover for delivery-token {}: {}".format(self.projectid, delivery_token, mover_status))
+        return None
+
+    def finalize_mover_delivery(self, delivery_status, sample_entries=None):
+        """ Applies the outcome of a finished mover delivery to the project and its samples in Charon.
+            The samples are read from Charon once and all status updates are based on that snapshot.
+
+            :param string delivery_status: the outcome of the delivery, either 'DELIVERED' or 'FAILED'
+            :param list sample_entries: the Charon sample entries of the project to use instead of
+                fetching them from Charon
+        """
         if delivery_status == 'DELIVERED' or delivery_status == 'FAILED':
-            #fetch all samples that were under delivery
-            in_progress_samples = self.get_samples_from_charon(delivery_status="IN_PROGRESS")
-            # now update them
-            for sample_id in in_progress_samples:
+            if sample_entries is None:
+                sample_entries = self.get_sample_entries_from_charon()
+            charon_session = CharonSession()
+            #update all samples that were under delivery
+            for sample in sample_entries:
+                if sample.get('delivery_status') != 'IN_PROGRESS':
+                    continue
                 try:
-                    sample_deliverer = GrusSampleDeliverer(self.projectid, sample_id)
-                    sample_deliverer.update_delivery_status(status=delivery_status)
+                    charon_session.sample_update(self.projectid, sample.get('sampleid'), delivery_status=delivery_status)
+                    sample['delivery_status'] = delivery_status
                 except Exception, e:
-                    logger.error('Sample {}: Problems in setting sample status on charon. Error: {}'.format(sample_id, error))
+                    logger.error('Sample {}: Problems in setting sample status on charon. Error: {}'.format(sample.get('sampleid'), e))
                     logger.exception(e)
             #now reset delivery
             self.delete_delivery_token_in_charon()
             #now check, if all samples in charon are DELIVERED or are ABORTED as status, then the all projecct is DELIVERED
-            all_samples_delivered = True
-            for sample_id in self.get_samples_from_charon(delivery_status=None):
-                try:
-                    sample_deliverer = GrusSampleDeliverer(self.projectid, sample_id)
-                    if sample_deliverer.get_sample_status() == 'ABORTED':
-                        continue
-                    if sample_deliverer.get_delivery_status() != 'DELIVERED':
-                        all_samples_delivered = False
-                except Exception, e:
-                    logger.error('Sample {}: Problems in setting sample status on charon. Error: {}'.format(sample_id, error))
-                    logger.exception(e)
+            all_samples_delivered = all([sample.get('delivery_status', 'NOT_DELIVERED') == 'DELIVERED'
+                                         for sample in sample_entries if sample.get('status', 'FRESH') != 'ABORTED'])
             if all_samples_delivered:
                 self.update_delivery_status(status=delivery_status)
 
+    @delivery_metrics('project')
     def deliver_project(self):
         """ Deliver all samples in a project to grus
             :returns: True if all samples were delivered successfully, False if
                 any sample was not properly delivered or ready to be delivered
         """
+        # start the lookups in external services, unless this was done when the deliverer was created
+        self.prefetch()
         #first thing check that we are using mover 1.0.0
-        if not check_mover_version():
+        if not self._prefetched['mover_version'].result():
              logger.error("Not delivering becouse wrong mover version detected")
              return False
         # moved this part from constructor, as we can create an object without running the delivery (e.g. to check_delivery_status)
@@ -237,7 +299,7 @@ class GrusProjectDeliverer(ProjectDeliverer):
         #now find the PI mail which is needed to create the delivery project
         if self.pi_email is None:
             try:
-                self.pi_email = self._get_pi_email()
+                self.pi_email = self._prefetched['pi_email'].result()
                 logger.info("email for PI for project {} found: {}".format(self.projectid, self.pi_email))
             except Exception, e:
                 logger.error("Cannot fetch pi_email from StatusDB. Error says: {}".format(str(e)))
@@ -251,17 +313,19 @@ class GrusProjectDeliverer(ProjectDeliverer):
         #and now get the pi PID from snic
         pi_id = ''
         try:
-            pi_id = self._get_pi_id()
+            pi_id = self._prefetched['pi_id'].result()
             logger.info("PI-id for delivering of project {} is {}".format(self.projectid, pi_id))
         except Exception, e:
             logger.error("Cannot fetch pi_id from snic API. Error says: {}".format(str(e)))
             logger.exception(e)
             status = False
             return status
+        logger.info("PI lookup cache for project {}: {hits} hits, {misses} misses".format(
+            self.projectid, **self.lookup_cache.stats()))
         
         # connect to charon, return list of sample objects that have been staged
         try:
-            samples_to_deliver = self.get_samples_from_charon(delivery_status="STAGED")
+            samples_to_deliver = self._prefetched['staged_samples'].result()
         except Exception, e:
             logger.error("Cannot get samples from Charon. Error says: {}".format(str(e)))
             logger.exception(e)
@@ -270,8 +334,18 @@ class GrusProjectDeliverer(ProjectDeliverer):
             logger.warning('No staged samples found in Charon')
             raise AssertionError('No staged samples found in Charon')
 
-        # collect other files (not samples) if any to include in the hard staging
-        misc_to_deliver = [itm for itm in os.listdir(soft_stagepath) if os.path.splitext(itm)[0] not in samples_to_deliver]
+        # collect other files (not samples) if any to include in the hard staging, the sample files
+        # are e.g. NGIU-S001.sha1 and NGIU-S001.manifest.json, which are copied with the sample
+        misc_to_deliver = [itm for itm in os.listdir(soft_stagepath) if itm.split('.', 1)[0] not in samples_to_deliver]
+
+        # make sure that the hard staged copy will fit before starting to copy
+        items_to_stage = [itm for itm in os.listdir(soft_stagepath) if itm.split('.', 1)[0] in samples_to_deliver]
+        items_to_stage.extend(misc_to_deliver)
+        if not self.check_hard_stage_capacity(
+                [os.path.join(soft_stagepath, itm) for itm in items_to_stage], hard_stagepath):
+            # nothing has been copied yet so release the lock
+            os.rmdir(hard_stagepath)
+            return False
 
         question = "\nProject stagepath: {}\nSamples: {}\nMiscellaneous: {}\n\nProceed with delivery ? "
         question = question.format(soft_stagepath, ", ".join(samples_to_deliver), ", ".join(misc_to_deliver))
@@ -282,16 +356,17 @@ class GrusProjectDeliverer(ProjectDeliverer):
             return False
 
         hard_staged_samples = []
-        for sample_id in samples_to_deliver:
-            try:
-                sample_deliverer = GrusSampleDeliverer(self.projectid, sample_id)
-                sample_deliverer.deliver_sample()
-            except Exception, e:
-                logger.error('Sample {} has not been hard staged. Error says: {}'.format(sample_id, e))
-                logger.exception(e)
-                raise e
-            else:
-                hard_staged_samples.append(sample_id)
+        with self.spans.span('hard_staging', samples=len(samples_to_deliver)):
+            for sample_id in samples_to_deliver:
+                try:
+                    sample_deliverer = GrusSampleDeliverer(self.projectid, sample_id)
+                    sample_deliverer.deliver_sample()
+                except Exception, e:
+                    logger.error('Sample {} has not been hard staged. Error says: {}'.format(sample_id, e))
+                    logger.exception(e)
+                    raise e
+                else:
+                    hard_staged_samples.append(sample_id)
         if len(samples_to_deliver) != len(hard_staged_samples):
             # Something unexpected happend, terminate
             logger.warning('Not all the samples have been hard staged. Terminating')
@@ -299,19 +374,20 @@ class GrusProjectDeliverer(ProjectDeliverer):
                                                                                                         len(hard_staged_samples)))
 
         hard_staged_misc = []
-        for itm in misc_to_deliver:
-            src_misc = os.path.join(soft_stagepath, itm)
-            dst_misc = os.path.join(hard_stagepath, itm)
-            try:
-                if os.path.isdir(src_misc):
-                    shutil.copytree(src_misc, dst_misc)
-                else:
-                    shutil.copy(src_misc, dst_misc)
-                hard_staged_misc.append(itm)
-            except Exception, e:
-                logger.error('Miscellaneous file {} has not been hard staged for project {}. Error says: {}'.format(itm, proj, e))
-                logger.exception(e)
-                raise e
+        with self.spans.span('hard_staging_misc', files=len(misc_to_deliver)):
+            for itm in misc_to_deliver:
+                src_misc = os.path.join(soft_stagepath, itm)
+                dst_misc = os.path.join(hard_stagepath, itm)
+                try:
+                    if os.path.isdir(src_misc):
+                        shutil.copytree(src_misc, dst_misc)
+                    else:
+                        shutil.copy(src_misc, dst_misc)
+                    hard_staged_misc.append(itm)
+                except Exception, e:
+                    logger.error('Miscellaneous file {} has not been hard staged for project {}. Error says: {}'.format(itm, proj, e))
+                    logger.exception(e)
+                    raise e
         if len(misc_to_deliver) != len(hard_staged_misc):
             # Something unexpected happend, terminate
             logger.warning('Not all the Miscellaneous files have been hard staged for project {}. Terminating'.format(proj))
@@ -321,35 +397,67 @@ class GrusProjectDeliverer(ProjectDeliverer):
         # create a delivery project id
         supr_name_of_delivery = ''
         try:
-            delivery_project_info = self._create_delivery_project(pi_id, self.sensitive)
+            with self.spans.span('create_delivery_project'):
+                delivery_project_info = self._create_delivery_project(pi_id, self.sensitive)
             supr_name_of_delivery = delivery_project_info['name']
             logger.info("Delivery project for project {} has been created. Delivery IDis {}".format(self.projectid, supr_name_of_delivery))
         except Exception, e:
             logger.error('Cannot create delivery project. Error says: {}'.format())
             logger.exception(e)
-        delivery_token = self.do_delivery(supr_name_of_delivery) # instead of to_outbox
+        with self.spans.span('do_delivery'):
+            delivery_token = self.do_delivery(supr_name_of_delivery) # instead of to_outbox
         #at this point I have delivery_token and supr_name_of_delivery so I need to update the project fields and the samples fields
         if delivery_token:
-            #memorise the delivery token used to check if project is under delivery
-            self.save_delivery_token_in_charon(delivery_token)
-            #memorise the delivery project so I know each NGi project to how many delivery projects it has been sent
-            self.add_supr_name_delivery_in_charon(supr_name_of_delivery)
-            logger.info("Delivery token for project {}, delivery project {} is {}".format(self.projectid,
-                                                                                    supr_name_of_delivery,
-                                                                                    delivery_token))
-            for sample_id in samples_to_deliver:
-                try:
-                    sample_deliverer = GrusSampleDeliverer(self.projectid, sample_id)
-                    sample_deliverer.save_delivery_token_in_charon(delivery_token)
-                    sample_deliverer.add_supr_name_delivery_in_charon(supr_name_of_delivery)
-                except Exception, e:
-                    logger.error('Failed in saving sample infomration for sample {}. Error says: {}'.format(sample_id, e))
-                    logger.exception(e)
+            with self.spans.span('charon_update', samples=len(samples_to_deliver)):
+                #memorise the delivery token used to check if project is under delivery
+                self.save_delivery_token_in_charon(delivery_token)
+                #memorise the delivery project so I know each NGi project to how many delivery projects it has been sent
+                self.add_supr_name_delivery_in_charon(supr_name_of_delivery)
+                logger.info("Delivery token for project {}, delivery project {} is {}".format(self.projectid,
+                                                                                        supr_name_of_delivery,
+                                                                                        delivery_token))
+                for sample_id in samples_to_deliver:
+                    try:
+                        sample_deliverer = GrusSampleDeliverer(self.projectid, sample_id)
+                        sample_deliverer.save_delivery_token_in_charon(delivery_token)
+                        sample_deliverer.add_supr_name_delivery_in_charon(supr_name_of_delivery)
+                    except Exception, e:
+                        logger.error('Failed in saving sample infomration for sample {}. Error says: {}'.format(sample_id, e))
+                        logger.exception(e)
         else:
             logger.error('Delivery project for project {} has not been created'.format(self.projectid))
             status = False
         return status
 
+    def check_hard_stage_capacity(self, paths, hard_stagepath):
+        """ Checks that there is enough free space and inodes on the filesystem
+            of the hard staging path to make a dereferenced copy of the supplied
+            soft staged paths, keeping the fraction stagingpathhard_margin of
+            the free space and inodes in reserve.
+
+            :param list paths: the soft staged files and folders to be copied
+            :param string hard_stagepath: the path where the copy will be made
+            :returns: True if the copy will fit, False otherwise
+        """
+        needed_bytes, needed_inodes = fs.staged_size(paths)
+        free_bytes, free_inodes = fs.available_space(hard_stagepath)
+        usable_bytes = free_bytes * (1.0 - self.stagingpathhard_margin)
+        logger.info("Hard staging {} requires {} bytes and {} inodes, {} bytes and {} inodes available".format(
+            self.projectid, needed_bytes, needed_inodes, free_bytes,
+            free_inodes if free_inodes is not None else "unknown"))
+        if needed_bytes > usable_bytes:
+            logger.error("Not enough space in {} to hard stage project {}: {} bytes needed but only {} bytes usable "
+                         "(margin {})".format(hard_stagepath, self.projectid, needed_bytes, int(usable_bytes),
+                                              self.stagingpathhard_margin))
+            return False
+        if free_inodes is not None and needed_inodes > free_inodes * (1.0 - self.stagingpathhard_margin):
+            logger.error("Not enough inodes in {} to hard stage project {}: {} needed but only {} usable "
+                         "(margin {})".format(hard_stagepath, self.projectid, needed_inodes,
+                                              int(free_inodes * (1.0 - self.stagingpathhard_margin)),
+                                              self.stagingpathhard_margin))
+            return False
+        return True
+
     def save_delivery_token_in_charon(self, delivery_token):
         '''Updates delivery_token in Charon at project level
         '''
@@ -416,14 +524,21 @@ class GrusProjectDeliverer(ProjectDeliverer):
         delivery_token = output.rstrip()
         return delivery_token
 
-    def get_samples_from_charon(self, delivery_status='STAGED'):
-        """Takes as input a delivery status and return all samples with that delivery status
+    def get_sample_entries_from_charon(self):
+        """Fetches the entries of all samples in the project from Charon with a single request
         """
         charon_session = CharonSession()
         result = charon_session.project_get_samples(self.projectid)
         samples = result.get('samples')
         if samples is None:
             raise AssertionError('CharonSession returned no results for project {}'.format(self.projectid))
+        return samples
+
+    def get_samples_from_charon(self, delivery_status='STAGED', sample_entries=None):
+        """Takes as input a delivery status and return all samples with that delivery status. If a list of
+        sample entries is supplied, it will be used instead of fetching from Charon
+        """
+        samples = sample_entries if sample_entries is not None else self.get_sample_entries_from_charon()
         samples_of_interest = []
         for sample in samples:
             sample_id = sample.get('sampleid')
@@ -461,28 +576,38 @@ class GrusProjectDeliverer(ProjectDeliverer):
         result = json.loads(response.content)
         return result
 
-    def _get_pi_id(self):
+    def _get_pi_id(self, pi_email=None):
+        pi_email = pi_email or self.pi_email
+        if not pi_email:
+            raise AssertionError("No PI e-mail found for project {}".format(self.projectid))
+        return self.lookup_cache.get('supr_pi_id', pi_email.lower(), lambda: self._get_pi_id_from_supr(pi_email))
+
+    def _get_pi_id_from_supr(self, pi_email):
         get_user_url = '{}/person/search/'.format(self.config_snic.get('snic_api_url'))
         user         = self.config_snic.get('snic_api_user')
         password     = self.config_snic.get('snic_api_password')
-        params   = {'email_i': self.pi_email}
+        params   = {'email_i': pi_email}
         response = requests.get(get_user_url, params=params, auth=(user, password))
 
         if response.status_code != 200:
-            raise AssertionError("Status code returned when trying to get PI id for email: {} was not 200. Response was: {}".format(self.pi_email, response.content))
+            raise AssertionError("Status code returned when trying to get PI id for email: {} was not 200. Response was: {}".format(pi_email, response.content))
         result = json.loads(response.content)
         matches = result.get("matches")
         if matches is None:
             raise AssertionError('The response returned unexpected data')
         if len(matches) < 1:
-            raise AssertionError("There were no hits in SUPR for email: {}".format(self.pi_email))
+            raise AssertionError("There were no hits in SUPR for email: {}".format(pi_email))
         if len(matches) > 1:
-            raise AssertionError("There we more than one hit in SUPR for email: {}".format(self.pi_email))
+            raise AssertionError("There we more than one hit in SUPR for email: {}".format(pi_email))
 
         pi_id = matches[0].get("id")
         return pi_id
 
     def _get_pi_email(self):
+        portal_id = self.lookup_cache.get('portal_id', self.projectid, self._get_portal_id)
+        return self.lookup_cache.get('pi_email', portal_id, lambda: self._get_pi_email_from_portal(portal_id))
+
+    def _get_portal_id(self):
         url      = self.config_statusdb.get('url')
         username = self.config_statusdb.get('username')
         password = self.config_statusdb.get('password')
@@ -493,17 +618,22 @@ class GrusProjectDeliverer(ProjectDeliverer):
         view = projects_db.view('order_portal/ProjectID_to_PortalID')
         rows = view[self.projectid].rows
         if len(rows) < 1:
-            raise AssertionError("Project {} not found in StatusDB: {}".format(self.projecid, url))
+            raise AssertionError("Project {} not found in StatusDB: {}".format(self.projectid, url))
         if len(rows) > 1:
             raise AssertionError('Project {} has more than one entry in orderportal_db'.format(self.projectid))
-        portal_id = rows[0].value
-        #now get the PI email from order portal API
+        return rows[0].value
+
+    def _get_pi_email_from_portal(self, portal_id):
+        #get the PI email from order portal API
         get_project_url = '{}/v1/order/{}'.format(self.orderportal.get('orderportal_api_url'), portal_id)
         headers = {'X-OrderPortal-API-key': '{}'.format(self.orderportal.get('orderportal_api_token'))}
         response = requests.get(get_project_url, headers=headers)
         if response.status_code != 200:
             raise AssertionError("Status code returned when trying to get PI email from project in order portal: {} was not 200. Response was: {}".format(portal_id, response.content))
-        pi_email = json.loads(response.content)['fields']['project_pi_email']
+        pi_email = json.loads(response.content)['fields'].get('project_pi_email')
+        # a missing e-mail should not be cached
+        if not pi_email:
+            raise AssertionError("No PI e-mail found in order portal for project {}: {}".format(self.projectid, portal_id))
         return pi_email
 
 
@@ -546,16 +676,24 @@ class GrusSampleDeliverer(SampleDeliverer):
             hard_stagepath = self.expand_path(self.stagingpathhard)
             soft_stagepath = self.expand_path(self.stagingpath)
             try:
-                if self.get_delivery_status(sampleentry) != 'STAGED':
-                    logger.info("{} has not been staged and will not be delivered".format(str(self)))
-                    return False
+                with self.spans.span('status_checks'):
+                    if self.get_delivery_status(sampleentry) != 'STAGED':
+                        logger.info("{} has not been staged and will not be delivered".format(str(self)))
+                        return False
             except db.DatabaseError as e:
                 logger.error("error '{}' occurred during delivery of {}".format(str(e), str(self)))
                 logger.exception(e)
                 raise(e)
             #at this point copywith deferance the softlink folder
-            self.update_delivery_status(status="IN_PROGRESS")
-            self.do_delivery()
+            with self.spans.span('charon_update', status="IN_PROGRESS"):
+                self.update_delivery_status(status="IN_PROGRESS")
+            with self.spans.span('do_delivery') as span:
+                self.do_delivery()
+                if self.spans.enabled:
+                    # only walk the copy when the span is recorded
+                    nbytes, nentries = fs.staged_size(
+                        [os.path.join(self.expand_path(self.stagingpathhard), self.sampleid)])
+                    span.add(bytes=nbytes, entries=nentries)
         #in case of faiulure put again the status to STAGED
         except DelivererInterruptedError, e:
             self.update_delivery_status(status="STAGED")
@@ -604,3 +742,142 @@ class GrusSampleDeliverer(SampleDeliverer):
             shutil.copy(file, self.expand_path(self.stagingpathhard))
         logger.info("Sample {} has been hard staged to {}".format(self.sampleid, destination_dir))
         return
+
+
+class MoverMonitor(object):
+    """ Monitors the mover deliveries of several projects from a single process.
+
+        Each project is polled with its own interval, which is short right after mover
+        has accepted the delivery and then backs off while the delivery is ongoing.
+        The moverinfo calls for the projects that are due are run concurrently and
+        killed if they do not finish in time. As soon as the delivery of a project is
+        over, its outcome is applied to Charon, independently of the other projects.
+    """
+
+    def __init__(self, min_interval=60, max_interval=900, backoff=2.0, timeout=120, max_concurrent=8,
+                 max_delivery_time=relativedelta(days=7)):
+        """
+            :param int min_interval: seconds between polls right after a delivery was accepted
+            :param int max_interval: the longest time in seconds between two polls of a delivery
+            :param float backoff: factor to increase the poll interval with while a delivery is ongoing
+            :param int timeout: seconds to wait for a moverinfo call before killing it
+            :param int max_concurrent: the maximum number of concurrent moverinfo calls
+            :param relativedelta max_delivery_time: for how long a delivery is allowed to be ongoing
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_concurrent = max_concurrent
+        self.max_delivery_time = max_delivery_time
+        self.pending = []
+        self.running = []
+        self.results = {}
+        self._sequence = 0
+
+    def add(self, deliverer):
+        """ Add a project to monitor, if it is under delivery
+
+            :param GrusProjectDeliverer deliverer: the deliverer of the project to monitor
+            :returns: True if the project is under delivery and will be monitored, False otherwise
+        """
+        dbentry = deliverer.db_entry()
+        if deliverer.get_delivery_status(dbentry) != 'IN_PROGRESS':
+            logger.info("Project {} has no delivery token. Project is not being delivered at the moment".format(deliverer.projectid))
+            return False
+        delivery = _MonitoredDelivery(deliverer, dbentry, self.min_interval)
+        logger.info("Project {} under delivery. Delivery token is {}. Starting monitoring:".format(
+            deliverer.projectid, delivery.token))
+        self._schedule(delivery, 0)
+        return True
+
+    def run(self):
+        """ Monitor the added projects until all deliveries are over
+
+            :returns: a dict with the outcome, DELIVERED or FAILED, of each finished delivery
+        """
+        try:
+            while self.pending or self.running:
+                now = time.time()
+                while self.pending and self.pending[0][0] <= now and len(self.running) < self.max_concurrent:
+                    self._start_poll(heapq.heappop(self.pending)[2])
+                for delivery in list(self.running):
+                    if delivery.process.poll() is None:
+                        if now - delivery.poll_started > self.timeout:
+                            logger.error("moverinfo for project {} did not finish within {} seconds, killing it".format(
+                                delivery.deliverer.projectid, self.timeout))
+                            delivery.process.kill()
+                        continue
+                    self.running.remove(delivery)
+                    self._handle_poll(delivery, delivery.process.returncode, delivery.process.communicate()[0])
+                if self.running or not self.pending:
+                    time.sleep(1)
+                else:
+                    time.sleep(max(0, min(self.pending[0][0] - time.time(), self.max_interval)))
+        finally:
+            for delivery in self.running:
+                if delivery.process.poll() is None:
+                    delivery.process.kill()
+        return self.results
+
+    def _schedule(self, delivery, delay):
+        self._sequence += 1
+        heapq.heappush(self.pending, (time.time() + delay, self._sequence, delivery))
+
+    def _start_poll(self, delivery):
+        delivery.poll_started = time.time()
+        delivery.process = subprocess.Popen(
+            ['moverinfo', '-i', delivery.token], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.running.append(delivery)
+
+    def _handle_poll(self, delivery, returncode, output):
+        deliverer = delivery.deliverer
+        if returncode != 0:
+            logger.error('Cannot get the delivery status for project {}, moverinfo returned {}: {}'.format(
+                deliverer.projectid, returncode, output))
+            mover_status = None
+        else:
+            #Moverinfo output with option -i can be: InProgress, Accepted, Failed,
+            mover_status = output.split(':')[0]
+        try:
+            if mover_status is None:
+                # without a status from mover, only give up when the delivery has been going on for too long
+                delivery_status = None
+                if datetime.datetime.utcnow() - self.max_delivery_time > delivery.started:
+                    logger.error('Delivery {} for project {} has been ongoing for too long and its status is unknown. '
+                                 'The project status will be reset'.format(delivery.token, deliverer.projectid))
+                    delivery_status = 'FAILED'
+            else:
+                delivery_status = deliverer.evaluate_mover_status(
+                    mover_status, delivery.token, delivery.started, max_delivery_time=self.max_delivery_time)
+            if delivery_status is not None:
+                deliverer.finalize_mover_delivery(delivery_status)
+                self.results[deliverer.projectid] = delivery_status
+                return
+        except Exception, e:
+            logger.error('Problems when checking the delivery status of project {}. Error: {}'.format(deliverer.projectid, e))
+            logger.exception(e)
+        # the interval is kept as it is after a failed poll
+        if mover_status is not None:
+            if mover_status == 'Accepted' and delivery.mover_status != 'Accepted':
+                # poll often right after acceptance, the delivery may be quick
+                delivery.interval = self.min_interval
+            else:
+                delivery.interval = min(delivery.interval * self.backoff, self.max_interval)
+            delivery.mover_status = mover_status
+        self._schedule(delivery, delivery.interval)
+
+
+class _MonitoredDelivery(object):
+    """ The state of a delivery monitored by MoverMonitor
+    """
+
+    def __init__(self, deliverer, dbentry, interval):
+        self.deliverer = deliverer
+        self.token = dbentry.get('delivery_token')
+        self.interval = interval
+        # the first time I checked the status, not necessarly when it begun
+        self.started = _delivery_started(dbentry, datetime.datetime.utcnow())
+        self.mover_status = None
+        self.process = None
+        self.poll_started = None
@@ -4,6 +4,8 @@
 
 import paramiko
 import getpass
+import hashlib
+import sys
 import tarfile
 import threading
 import glob
@@ -11,6 +13,16 @@ import time
 
 
 from deliver import *
+from ..utils.compression import ParallelGzipWriter, is_compressed
+from ..utils.concurrency import BackgroundCall, BoundedPipe
+
+# the size of the writes from the tar stream to the upload buffer
+STREAM_CHUNK_SIZE = 1024*1024
+
+# serializes the password prompts of concurrent project deliveries, and keeps the passwords
+# that were accepted so that the operator is only asked once per server and user
+_prompt_lock = threading.Lock()
+_passwords = {}
 
 
 
@@ -29,8 +41,12 @@ class MoslerProjectDeliverer(ProjectDeliverer):
         self.moslersftpserver = getattr(self, 'moslersftpserver', None)
         self.moslersftpserver_user = getattr(self, 'moslersftpserver_user', None)
         self.moslersftpmaxfiles = getattr(self, 'moslersftpmaxfiles', None)
+        # bounds, in seconds, of the interval between checks of the mosler sftp quota
+        self.moslerpoll_min_interval = int(getattr(self, 'moslerpoll_min_interval', 30))
+        self.moslerpoll_max_interval = int(getattr(self, 'moslerpoll_max_interval', 600))
     
 
+    @delivery_metrics('project')
     def deliver_project(self):
         """ Deliver all samples in a project to mosler
             
@@ -50,8 +66,18 @@ class MoslerProjectDeliverer(ProjectDeliverer):
             # Open sftp session with mosler, in this way multiple tranfer will be possible
             try:
                 transport=paramiko.Transport(self.moslersftpserver)
-                password = getpass.getpass(prompt='Mosler Password for user {}:'.format(self.moslersftpserver_user))
-                transport.connect(username = self.moslersftpserver_user, password = password)
+                with _prompt_lock:
+                    credentials = (str(self.moslersftpserver), self.moslersftpserver_user)
+                    password = _passwords.get(credentials)
+                    if password is None:
+                        password = getpass.getpass(
+                            prompt='Mosler Password for user {}:'.format(self.moslersftpserver_user))
+                    try:
+                        transport.connect(username = self.moslersftpserver_user, password = password)
+                    except Exception:
+                        _passwords.pop(credentials, None)
+                        raise
+                    _passwords[credentials] = password
             except Exception as e:
                 logger.error("Caught exception: {}: {}".format(e.__class__, e))
                 raise
@@ -60,35 +86,7 @@ class MoslerProjectDeliverer(ProjectDeliverer):
             samples_to_deliver = [sentry['sampleid'] for sentry in db.project_sample_entries(
                     db.dbcon(), self.projectid).get('samples', [])]
             
-            # run multiple threads and store return functions
-            # http://stackoverflow.com/questions/6893968/how-to-get-the-return-value-from-a-thread-in-python
-            threads = [None] * len(samples_to_deliver)
-            results = [None] * len(samples_to_deliver)
-            thread  = 0
-            while len(samples_to_deliver) > 0:
-                # check how many samples there are in mosler sftp server
-                # create an sftp client for each sample (only one put can be done in one client. This was needed for the threaded version)
-                sftp_client = transport.open_sftp_client()
-                # move to the delivery directory in the sftp
-                sftp_client.chdir(self.expand_path(self.moslerdeliverypath))
-                # Count number of files
-                num_tar_files_mosler = len(sftp_client.listdir('.'))
-                # if the the number of remote tar files is higher the the maximum number of deliveries wait
-                if num_tar_files_mosler >= self.moslersftpmaxfiles:
-                    logger.info("More than {} files in Mosler sftp server".format(self.moslersftpmaxfiles))
-                    sftp_client.close()
-                    # wait 10 minutes
-                    time.sleep(600)
-                    continue
-                # otherwise take next sample
-                sampleid = samples_to_deliver.pop()
-                sampleDelivererObj = MoslerSampleDeliverer(self.projectid, sampleid, sftp_client)
-                st = sampleDelivererObj.deliver_sample()
-                # initiate the thread and give it the return index
-                #threads[thread] = threading.Thread(target=sampleDelivererObj.deliver_sample_thread, args=(None, results, thread))
-                #threads[thread].start()
-                #take a nap not need to rush
-                status = (status and st) # I need to wait for the last job and then cehck the status....
+            status = self.deliver_samples(transport, samples_to_deliver)
             try:
                 transport.close()
             except Exception as e:
@@ -104,6 +102,111 @@ class MoslerProjectDeliverer(ProjectDeliverer):
         except (db.DatabaseError, DelivererInterruptedError, Exception):
             raise
 
+    def deliver_samples(self, transport, samples_to_deliver):
+        """ Deliver samples to mosler, keeping as many uploads in flight as the
+            mosler sftp quota (moslersftpmaxfiles) allows. Each sample is delivered
+            in its own thread with its own sftp client, so the staging of a sample
+            overlaps with the uploads of the others. The remote folder is polled
+            with an exponential backoff while the quota is full.
+
+            The samples are started in the given order. If the delivery of a sample
+            raises an exception, no more samples are started and the exception is
+            raised once the running deliveries have finished. If the delivery is
+            interrupted, the running uploads are cancelled and the samples are reset
+            to NOT_DELIVERED.
+
+            :param transport: an authenticated paramiko.Transport to mosler
+            :param list samples_to_deliver: the ids of the samples to deliver
+            :returns: True if all samples were delivered successfully, False otherwise
+        """
+        pending = list(samples_to_deliver)
+        running = {}
+        results = {}
+        failure = None
+        interval = self.moslerpoll_min_interval
+        listing_client = transport.open_sftp_client()
+        listing_client.chdir(self.expand_path(self.moslerdeliverypath))
+        try:
+            while running or (pending and failure is None):
+                # collect the finished deliveries
+                for sampleid, (sample_deliverer, delivery) in running.items():
+                    if delivery.is_alive():
+                        continue
+                    del running[sampleid]
+                    sample_deliverer.sftp_client.close()
+                    try:
+                        results[sampleid] = delivery.result()
+                    except Exception:
+                        results[sampleid] = False
+                        failure = failure or sys.exc_info()
+                if not pending or failure is not None:
+                    # nothing more to start, wait for the running deliveries to finish
+                    if running:
+                        self._wait_for_deliveries(running, self.moslerpoll_max_interval)
+                    continue
+                # the archives of running deliveries that have started uploading are already
+                # in the remote listing, the others will need a slot
+                remote_files = set(listing_client.listdir('.'))
+                waiting = [sampleid for sampleid, (sample_deliverer, _) in running.items()
+                           if sample_deliverer.remote_archive_name() not in remote_files]
+                free_slots = self.moslersftpmaxfiles - len(remote_files) - len(waiting)
+                if free_slots <= 0:
+                    logger.info("{} files in Mosler sftp server and {} deliveries about to upload, the maximum "
+                                "is {}, checking again in {} s".format(
+                                    len(remote_files), len(waiting), self.moslersftpmaxfiles, interval))
+                    self._wait_for_deliveries(running, interval)
+                    interval = min(interval * 2, self.moslerpoll_max_interval)
+                    continue
+                interval = self.moslerpoll_min_interval
+                for _ in xrange(min(free_slots, len(pending))):
+                    sampleid = pending.pop(0)
+                    # create an sftp client for each sample, only one put can be done in one client
+                    sftp_client = transport.open_sftp_client()
+                    sftp_client.chdir(self.expand_path(self.moslerdeliverypath))
+                    # the deliverer is created here, since it installs signal handlers
+                    # which can only be done in the main thread
+                    sample_deliverer = MoslerSampleDeliverer(self.projectid, sampleid, sftp_client)
+                    running[sampleid] = (sample_deliverer, BackgroundCall(sample_deliverer.deliver_sample))
+                    logger.info("started delivery of {} ({} running, {} pending)".format(
+                        sample_deliverer, len(running), len(pending)))
+        finally:
+            listing_client.close()
+            # deliveries are only left running if the loop was interrupted
+            self._cancel_deliveries(running)
+        if failure is not None:
+            raise failure[0], failure[1], failure[2]
+        return all(results.values())
+
+    @staticmethod
+    def _cancel_deliveries(running):
+        """ Cancel the running deliveries by closing their sftp clients, wait for them to stop and reset
+            the delivery status of their samples, so that they can be delivered again
+        """
+        for sample_deliverer, _ in running.values():
+            logger.warning("cancelling the delivery of {}".format(sample_deliverer))
+            try:
+                sample_deliverer.sftp_client.close()
+            except Exception as e:
+                logger.error("Caught exception: {}: {}".format(e.__class__, e))
+        for sampleid, (sample_deliverer, delivery) in running.items():
+            try:
+                delivery.result()
+            except Exception:
+                # the upload is expected to fail when its sftp client is closed
+                pass
+            try:
+                sample_deliverer.update_delivery_status(status="NOT_DELIVERED")
+            except Exception as e:
+                logger.error("could not reset the delivery status of {}: {}".format(sample_deliverer, e))
+            del running[sampleid]
+
+    @staticmethod
+    def _wait_for_deliveries(running, seconds):
+        """ Sleep for the given number of seconds, or until one of the running deliveries finishes """
+        deadline = time.time() + seconds
+        while time.time() < deadline and all([delivery.is_alive() for _, delivery in running.values()]):
+            time.sleep(min(1, max(0, deadline - time.time())))
+
 
 
 
@@ -113,14 +216,27 @@ class MoslerSampleDeliverer(SampleDeliverer):
         A class for handling sample deliveries to Mosler
     """
 
+    # the sample is uploaded over sftp as a single archive, there are no delivered files to verify
+    supports_verification = False
+
     def __init__(self, projectid=None, sampleid=None, sftp_client=None, **kwargs):
         super(MoslerSampleDeliverer, self).__init__(
             projectid,
             sampleid,
             **kwargs)
         self.sftp_client = sftp_client
+        # number of STREAM_CHUNK_SIZE chunks to buffer between the tar stream and the upload
+        self.moslerstreambuffer = int(getattr(self, 'moslerstreambuffer', 16))
+        # optionally compress the archive, using several threads
+        self.moslercompress = getattr(self, 'moslercompress', False)
+        self.moslercompress_level = int(getattr(self, 'moslercompress_level', 6))
+        self.moslercompress_threads = getattr(self, 'moslercompress_threads', None)
 
 
+    def remote_archive_name(self):
+        """ :returns: the name of the archive of this sample on the mosler sftp server """
+        return "{}.tar.gz".format(self.sampleid) if self.moslercompress else "{}.tar".format(self.sampleid)
+
     def deliver_sample_thread(self, sampleentry=None, result=None, index=None):
         result[index] = self.deliver_sample(sampleentry)
         return None
@@ -132,32 +248,96 @@ class MoslerSampleDeliverer(SampleDeliverer):
             :raises DelivererTOBEDEFINEDError: if an exception occurred during
                 transfer
         """
-        # tar sample directory before moving it to mosler
-        # stolen from http://stackoverflow.com/questions/2032403/how-to-create-full-compressed-tar-file-using-python
-        # get the folder where tar file will be stored (same as the project delivery)
+        # the tar archive is streamed straight into the remote file through a bounded
+        # buffer, so no local copy of the sample is needed and reading the staged files
+        # overlaps with the upload. The digest of the archive is computed on the way.
         sample_tar_location = self.expand_path(self.stagingpath)
-        # create the tar archve
-        sample_tar_archive = os.path.join(sample_tar_location, "{}.tar".format(self.sampleid))
-        sample_tar = tarfile.open(sample_tar_archive, "w", dereference=True)
-        # add to the archive the directory
-        logger.info("{} building tar file for sample".format(self.sampleid))
-        sample_tar.add(os.path.join(sample_tar_location,  "{}".format(self.sampleid)), arcname="{}".format(self.sampleid))
-        # close the tar ball
-        logger.info("{} tar file for sample builded".format(self.sampleid))
-        sample_tar.close()
-        # transfer it (maybe an open session is needed)
-        logger.info("{} transferring sample to nestor sftp server".format(self.sampleid))
+        sample_tar_name = self.remote_archive_name()
+        logger.info("{} streaming tar file for sample to nestor sftp server".format(self.sampleid))
+        started = time.time()
         try:
-            self.sftp_client.put(sample_tar_archive, "{}.tar".format(self.sampleid))
+            remote_tar = self.sftp_client.open(sample_tar_name, "wb")
+            try:
+                remote_tar.set_pipelined(True)
+                pipe = BoundedPipe(
+                    remote_tar,
+                    maxchunks=self.moslerstreambuffer,
+                    hasher=hashlib.new(self.hash_algorithm))
+                try:
+                    if self.moslercompress:
+                        self._stream_compressed_archive(
+                            os.path.join(sample_tar_location, "{}".format(self.sampleid)), pipe)
+                    else:
+                        sample_tar = tarfile.open(
+                            fileobj=pipe, mode="w|", bufsize=STREAM_CHUNK_SIZE, dereference=True)
+                        sample_tar.add(
+                            os.path.join(sample_tar_location, "{}".format(self.sampleid)),
+                            arcname="{}".format(self.sampleid))
+                        sample_tar.close()
+                finally:
+                    pipe.close()
+            finally:
+                remote_tar.close()
+            remote_size = self.sftp_client.stat(sample_tar_name).st_size
+            if remote_size != pipe.bytes_written:
+                raise IOError("size mismatch in {}: {} bytes were sent but the remote file has {} bytes".format(
+                    sample_tar_name, pipe.bytes_written, remote_size))
         except Exception as e:
             print 'Caught exception: {}: {}'.format(e.__class__, e)
+            # do not leave a partial archive behind on the server
+            try:
+                self.sftp_client.remove(sample_tar_name)
+            except IOError:
+                pass
             raise
-        logger.info("{} sample transferred to nestor sftp server".format(self.sampleid))
-        # delete the tar
-        os.remove(os.path.join(sample_tar_location,  "{}.tar".format(self.sampleid)))
+        self.spans.record(
+            'archive_upload', time.time() - started, started=started, files=1, bytes=pipe.bytes_written)
+        self.record_transfer('sftp', pipe.bytes_written, time.time() - started)
+        digest = pipe.hasher.hexdigest()
+        with open(os.path.join(sample_tar_location, "{}.{}".format(sample_tar_name, self.hash_algorithm)), 'w') as dh:
+            dh.write("{}  {}\n".format(digest, sample_tar_name))
+        logger.info("{} sample transferred to nestor sftp server ({} bytes, {} {})".format(
+            self.sampleid, pipe.bytes_written, self.hash_algorithm, digest))
         # close the sftp client, I will not reuse it anymore
         self.sftp_client.close()
         # return True, if something went wrong an exception is thrown before this
         return True
 
+    def _stream_compressed_archive(self, sample_dir, fileobj):
+        """ Write a compressed tar archive of the sample folder to a file-like object.
+            The archive is compressed in parallel blocks into a multi-member gzip
+            stream. Files which are already compressed are stored without
+            compressing them again.
+        """
+        level = self.moslercompress_level
+        # os.times is process-wide, so this includes the cpu time of anything else running concurrently,
+        # e.g. the other samples of the project, python 2 has no cpu clock per thread
+        cpu_start = os.times()
+        archive = ParallelGzipWriter(fileobj, level=level, threads=self.moslercompress_threads,
+                                     blocksize=STREAM_CHUNK_SIZE)
+        try:
+            # in "w" mode, tarfile writes each member straight to the archive, so the
+            # compression level can be switched at the member boundaries
+            sample_tar = tarfile.open(fileobj=archive, mode="w", dereference=True)
+            sample_tar.add(sample_dir, arcname=self.sampleid, recursive=False)
+            for parentdir, dirs, files in os.walk(sample_dir, followlinks=True):
+                dirs.sort()
+                for name in sorted(dirs + files):
+                    path = os.path.join(parentdir, name)
+                    archive.set_level(0 if is_compressed(path) else level)
+                    sample_tar.add(
+                        path,
+                        arcname=os.path.join(self.sampleid, os.path.relpath(path, sample_dir)),
+                        recursive=False)
+            archive.set_level(level)
+            sample_tar.close()
+        finally:
+            archive.close()
+        cpu_end = os.times()
+        logger.info("{} archive compressed from {} to {} bytes (ratio {:.2f}), process cpu time (all threads) "
+                    "during compression {:.1f} s".format(
+            self.sampleid, archive.bytes_in, archive.bytes_out,
+            float(archive.bytes_in) / archive.bytes_out if archive.bytes_out else 0.0,
+            sum(cpu_end[:2]) - sum(cpu_start[:2])))
+
 
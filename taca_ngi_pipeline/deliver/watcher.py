@@ -0,0 +1,236 @@
+"""
+    Module for watching the database for samples that are ready to be delivered
+"""
+import collections
+import json
+import logging
+import os
+import signal
+import tempfile
+import time
+
+from deliver import DelivererInterruptedError, _signal_handler
+from ..utils import database as db
+from ..utils.concurrency import BackgroundCall
+
+logger = logging.getLogger(__name__)
+
+
+def _sample_state(sampleentry):
+    """ :returns: the parts of a database sample entry which decide if it is ready for delivery """
+    return {
+        'status': sampleentry.get('status', 'FRESH'),
+        'analysis_status': sampleentry.get('analysis_status', 'TO_ANALYZE'),
+        'delivery_status': sampleentry.get('delivery_status', 'NOT_DELIVERED')}
+
+
+def _is_ready(state):
+    """ :returns: True if a sample in this state has finished analysis and has not been delivered """
+    return state['analysis_status'] == 'ANALYZED' and \
+        state['delivery_status'] not in ['DELIVERED', 'IN_PROGRESS'] and \
+        state['status'] not in ['ABORTED', 'FRESH']
+
+
+class DeliveryWatcher(object):
+    """ Polls the database for samples which have become ready for delivery and
+        delivers them. Only samples which have finished analysis since they were
+        last seen are picked up, so a sample whose delivery failed is not retried
+        until it has been analyzed again. The last seen state of each sample and
+        the samples waiting for delivery are kept in a state file, so that the
+        watcher can be restarted.
+
+        Ready samples are put in a bounded delivery queue. When the queue is full,
+        further samples are left to be picked up by a later poll.
+
+        When interrupted, no more deliveries are started and the running deliveries
+        are allowed to finish. A second interruption resets the delivery status of
+        the samples still being delivered and queues them again.
+    """
+
+    def __init__(self, deliverer_factory, statefile, projectids=None, interval=300, jobs=2,
+                 jobs_per_project=1, queue_size=100, deliver_fn=None, path_index=None):
+        """
+            :param deliverer_factory: function taking a project id and a sample id and
+                returning a sample deliverer
+            :param string statefile: path to the file to keep the watcher state in
+            :param list projectids: the projects to watch. If empty, all open projects
+                in the database are watched
+            :param int interval: the number of seconds between polls of the database
+            :param int jobs: the maximum number of samples delivered at the same time
+            :param int jobs_per_project: the maximum number of samples from the same
+                project delivered at the same time
+            :param int queue_size: the maximum number of samples waiting for delivery
+            :param deliver_fn: function taking a sample deliverer and delivering the
+                sample, defaults to calling deliver_sample on the deliverer
+            :param path_index: an optional fswatch.PathIndex, which the deliverers will
+                locate the files to deliver from
+        """
+        self.deliverer_factory = deliverer_factory
+        self.deliver_fn = deliver_fn or (lambda deliverer: deliverer.deliver_sample())
+        self.statefile = statefile
+        self.projectids = list(projectids or [])
+        self.interval = interval
+        self.jobs = jobs
+        self.jobs_per_project = jobs_per_project
+        self.queue_size = queue_size
+        self.path_index = path_index
+        self.queue = collections.deque()
+        self.running = {}
+        self.results = {}
+        self.cursor = {}
+        self._load_state()
+
+    def run(self, once=False):
+        """ Poll the database and deliver the ready samples until interrupted
+
+            :param bool once: if True, poll once, deliver the ready samples and return
+            :returns: a dict with the result of each delivery, keyed on (projectid, sampleid)
+        """
+        # only the main thread receives signals, so interrupt the polling loop from here
+        signal.signal(signal.SIGINT, _signal_handler)
+        signal.signal(signal.SIGTERM, _signal_handler)
+        try:
+            next_poll = None
+            while True:
+                changed = self._collect()
+                if next_poll is None or (not once and time.time() >= next_poll):
+                    self.poll()
+                    next_poll = time.time() + self.interval
+                    changed = True
+                elif once and not self.queue and not self.running:
+                    break
+                if self._dispatch() or changed:
+                    self._save_state()
+                time.sleep(1)
+        except DelivererInterruptedError:
+            self._stop_deliveries()
+            raise
+        finally:
+            self._save_state()
+        return self.results
+
+    def poll(self):
+        """ Fetch the sample entries of the watched projects and queue the samples
+            which have become ready for delivery since they were last seen
+        """
+        dbc = db.dbcon()
+        projectids = self.projectids or [
+            entry['projectid'] for entry in db.project_entries(dbc).get('projects', [])
+            if entry.get('status') == 'OPEN']
+        queued = 0
+        for projectid in projectids:
+            try:
+                sampleentries = db.project_sample_entries(dbc, projectid).get('samples', [])
+            except db.DatabaseError as e:
+                logger.warning("could not fetch the samples in {}: {}".format(projectid, e))
+                continue
+            project_cursor = self.cursor.setdefault(projectid, {})
+            for sampleentry in sampleentries:
+                sampleid = sampleentry['sampleid']
+                state = _sample_state(sampleentry)
+                previous = project_cursor.get(sampleid)
+                key = (projectid, sampleid)
+                if _is_ready(state) and (previous is None or previous['analysis_status'] != 'ANALYZED') \
+                        and key not in self.queue and key not in self.running:
+                    if len(self.queue) >= self.queue_size:
+                        # leave the cursor behind, so that the sample is picked up again by a later poll
+                        continue
+                    self.queue.append(key)
+                    queued += 1
+                project_cursor[sampleid] = state
+        logger.info("{} samples ready for delivery, {} queued and {} being delivered".format(
+            queued, len(self.queue), len(self.running)))
+
+    def _dispatch(self):
+        """ Start deliveries from the queue, within the concurrency limits
+            :returns: True if any delivery was started
+        """
+        started = False
+        for key in list(self.queue):
+            if len(self.running) >= self.jobs:
+                break
+            projectid, sampleid = key
+            if len([k for k in self.running if k[0] == projectid]) >= self.jobs_per_project:
+                continue
+            self.queue.remove(key)
+            # the deliverer is created here, since it installs signal handlers which can only
+            # be done in the main thread
+            try:
+                deliverer = self.deliverer_factory(projectid, sampleid)
+                if self.path_index is not None:
+                    deliverer.path_index = self.path_index
+            except Exception as e:
+                logger.error("could not set up the delivery of {}:{}: {}".format(projectid, sampleid, e))
+                self.results[key] = False
+                continue
+            self.running[key] = (deliverer, BackgroundCall(self.deliver_fn, deliverer))
+            started = True
+            logger.info("started delivery of {}:{}".format(projectid, sampleid))
+        return started
+
+    def _collect(self):
+        """ Collect the results of finished deliveries
+            :returns: True if any delivery had finished
+        """
+        finished = False
+        for key, (_, delivery) in self.running.items():
+            if delivery.is_alive():
+                continue
+            del self.running[key]
+            finished = True
+            try:
+                self.results[key] = delivery.result()
+            except Exception as e:
+                logger.error("delivery of {}:{} failed: {}".format(key[0], key[1], e))
+                self.results[key] = False
+        return finished
+
+    def _stop_deliveries(self):
+        """ Wait for the running deliveries to finish without starting new ones. If interrupted
+            again, the delivery status of the samples still being delivered is reset, so that
+            they are delivered again when the watcher is restarted
+        """
+        try:
+            while self.running:
+                logger.warning(
+                    "watcher interrupted while delivering {}, waiting for them to finish. Interrupt again "
+                    "to cancel them".format(", ".join(["{}:{}".format(*key) for key in sorted(self.running)])))
+                while not self._collect():
+                    time.sleep(1)
+        except DelivererInterruptedError:
+            for key, (deliverer, _) in sorted(self.running.items()):
+                logger.warning("cancelling the delivery of {}:{}".format(*key))
+                try:
+                    deliverer.update_delivery_status(status="NOT_DELIVERED")
+                except Exception as e:
+                    logger.error("could not reset the delivery status of {}:{}: {}".format(key[0], key[1], e))
+
+    def _load_state(self):
+        try:
+            with open(self.statefile, 'r') as fh:
+                state = json.load(fh)
+        except IOError:
+            return
+        except ValueError as e:
+            logger.warning("ignoring unreadable watcher state {}: {}".format(self.statefile, e))
+            return
+        self.cursor = state.get('cursor', {})
+        # deliveries which were queued or running when the watcher stopped are queued again
+        self.queue.extend([tuple(key) for key in state.get('queue', [])])
+        logger.info("resuming from {} with {} samples queued for delivery".format(self.statefile, len(self.queue)))
+
+    def _save_state(self):
+        """ Write the state file atomically """
+        state = {
+            'cursor': self.cursor,
+            'queue': [list(key) for key in list(self.running) + list(self.queue)]}
+        try:
+            statedir = os.path.dirname(os.path.abspath(self.statefile))
+            if not os.path.exists(statedir):
+                os.makedirs(statedir)
+            fd, tmppath = tempfile.mkstemp(dir=statedir, prefix=".{}".format(os.path.basename(self.statefile)))
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(state, fh)
+            os.rename(tmppath, self.statefile)
+        except (IOError, OSError) as e:
+            logger.warning("could not write watcher state to {}: {}".format(self.statefile, e))
@@ -0,0 +1,117 @@
+""" A persistent cache for slow lookups in external services
+"""
+import json
+import os
+import tempfile
+import time
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class LookupCache(object):
+    """ A key-value cache with a time-to-live, stored as a JSON file on disk so that it
+        can be shared between runs. Values are grouped in namespaces, one for each kind
+        of lookup.
+    """
+
+    def __init__(self, path=None, ttl=7*24*3600, refresh=False):
+        """
+            :param string path: the file to store the cache in. If None, the cache
+                will only be kept in memory
+            :param int ttl: the number of seconds a cached value is valid
+            :param bool refresh: if True, cached values will be ignored and replaced
+                with freshly fetched values
+        """
+        self.path = path
+        self.ttl = ttl
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.entries = self._load()
+
+    def get(self, namespace, key, fetch_fn):
+        """ Get the value for a key, fetching and caching it if it is not cached,
+            has expired or a refresh was requested
+
+            :param string namespace: the kind of lookup, e.g. 'pi_email'
+            :param string key: the key to look up
+            :param fetch_fn: function taking no arguments, which will be called to
+                fetch the value if needed
+            :returns: the cached or fetched value
+        """
+        entry = self.entries.get(namespace, {}).get(key)
+        if entry is not None and not self.refresh and time.time() - entry['stored'] < self.ttl:
+            self.hits += 1
+            logger.debug("lookup cache hit for {} {}".format(namespace, key))
+            return entry['value']
+        self.misses += 1
+        value = fetch_fn()
+        self.set(namespace, key, value)
+        return value
+
+    def set(self, namespace, key, value):
+        """ Store a value in the cache and write the cache to disk
+
+            :param string namespace: the kind of lookup
+            :param string key: the key to store the value under
+            :param value: the value to store, must be serializable to JSON
+        """
+        self.entries.setdefault(namespace, {})[key] = {'value': value, 'stored': time.time()}
+        self.save()
+
+    def invalidate(self, namespace, key=None):
+        """ Remove a key, or all keys in a namespace, from the cache
+
+            :param string namespace: the kind of lookup
+            :param string key: the key to remove. If None, the whole namespace is removed
+        """
+        if key is None:
+            self.entries.pop(namespace, None)
+        else:
+            self.entries.get(namespace, {}).pop(key, None)
+        self.save(merge=False)
+
+    def stats(self):
+        """
+            :returns: a dict with the number of cache hits and misses
+        """
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def save(self, merge=True):
+        """ Write the cache to disk. The file is replaced atomically and, unless told
+            otherwise, entries written by concurrent runs are kept if they are newer
+
+            :param bool merge: if True, merge with the entries currently on disk
+        """
+        if self.path is None:
+            return
+        if merge:
+            for namespace, entries in self._load().items():
+                for key, entry in entries.items():
+                    current = self.entries.setdefault(namespace, {}).get(key)
+                    if current is None or current['stored'] < entry['stored']:
+                        self.entries[namespace][key] = entry
+        try:
+            cachedir = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            fd, tmppath = tempfile.mkstemp(dir=cachedir, prefix=".{}".format(os.path.basename(self.path)))
+            with os.fdopen(fd, 'w') as fh:
+                json.dump(self.entries, fh)
+            os.rename(tmppath, self.path)
+        except (IOError, OSError) as e:
+            logger.warning("could not write lookup cache to {}: {}".format(self.path, e))
+
+    def _load(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path, 'r') as fh:
+                return json.load(fh)
+        except IOError:
+            return {}
+        except ValueError as e:
+            logger.warning("ignoring unreadable lookup cache {}: {}".format(self.path, e))
+            return {}
@@ -0,0 +1,147 @@
+""" Parallel compression of data streams
+"""
+import collections
+import multiprocessing
+import os
+import Queue
+import struct
+import sys
+import threading
+import zlib
+
+# extensions of files which are already compressed and will not get any smaller
+COMPRESSED_EXTENSIONS = (
+    '.gz', '.bgz', '.bz2', '.xz', '.zip', '.bam', '.cram', '.png', '.jpg', '.jpeg')
+
+
+def is_compressed(path):
+    """
+        :param string path: path to a file
+        :returns: True if the file extension shows that the file is already compressed
+    """
+    return os.path.splitext(path)[1].lower() in COMPRESSED_EXTENSIONS
+
+
+def gzip_member(data, level):
+    """ Compress data into a complete gzip member. Concatenated members form a
+        valid gzip file.
+
+        :param string data: the data to compress
+        :param int level: the compression level, 0 to 9
+        :returns: the gzip member as a string
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    # magic, deflate, no flags, no mtime, no extra flags, unknown os
+    header = struct.pack('<BBBBLBB', 0x1f, 0x8b, 8, 0, 0, 0, 255)
+    trailer = struct.pack('<LL', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + body + trailer
+
+
+class _Block(object):
+
+    def __init__(self, data, level):
+        self.data = data
+        self.level = level
+        self.member = None
+        self.exc_info = None
+        self.done = threading.Event()
+
+
+class ParallelGzipWriter(object):
+    """ A write-only file-like object which compresses the data written to it into
+        a multi-member gzip stream. The data is split in blocks which are compressed
+        independently in a pool of threads (zlib releases the GIL while compressing)
+        and written to the underlying file-like object in order.
+
+        The compression level can be changed between writes, e.g. to store data
+        which is already compressed without compressing it again.
+    """
+
+    def __init__(self, fileobj, level=6, threads=None, blocksize=1024*1024):
+        """
+            :param fileobj: the file-like object to write the compressed stream to
+            :param int level: the compression level, 0 to 9
+            :param int threads: the number of compression threads, defaults to the
+                number of cpus
+            :param int blocksize: the size of the independently compressed blocks
+        """
+        self.fileobj = fileobj
+        self.level = level
+        self.blocksize = blocksize
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self._buffer = []
+        self._buffered = 0
+        self._pending = collections.deque()
+        self._queue = Queue.Queue()
+        self._workers = []
+        for _ in xrange(threads or multiprocessing.cpu_count()):
+            worker = threading.Thread(target=self._compress, name="ParallelGzipWriter-worker")
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def set_level(self, level):
+        """ Change the compression level. Data written so far is compressed with the
+            previous level.
+
+            :param int level: the compression level, 0 to 9
+        """
+        if level != self.level:
+            self._submit()
+            self.level = level
+
+    def write(self, data):
+        self.bytes_in += len(data)
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.blocksize:
+            self._submit()
+
+    def tell(self):
+        """ :returns: the number of uncompressed bytes written """
+        return self.bytes_in
+
+    def close(self):
+        """ Compress the remaining data and write it out. The underlying file-like
+            object is not closed.
+        """
+        self._submit(force=not self.bytes_out and not self._pending)
+        while self._pending:
+            self._write_next()
+        for _ in self._workers:
+            self._queue.put(None)
+
+    def _submit(self, force=False):
+        if self._buffered or force:
+            block = _Block("".join(self._buffer), self.level)
+            self._buffer = []
+            self._buffered = 0
+            self._pending.append(block)
+            self._queue.put(block)
+        # keep the workers busy, but do not buffer more blocks than needed for that
+        while len(self._pending) > 2 * len(self._workers):
+            self._write_next()
+
+    def _write_next(self):
+        block = self._pending.popleft()
+        # wait with a timeout, so that signals are still handled while waiting
+        while not block.done.wait(0.5):
+            pass
+        if block.exc_info is not None:
+            raise block.exc_info[0], block.exc_info[1], block.exc_info[2]
+        self.fileobj.write(block.member)
+        self.bytes_out += len(block.member)
+
+    def _compress(self):
+        while True:
+            block = self._queue.get()
+            if block is None:
+                return
+            try:
+                block.member = gzip_member(block.data, block.level)
+            except Exception:
+                block.exc_info = sys.exc_info()
+            block.data = None
+            block.done.set()
@@ -0,0 +1,111 @@
+""" Helpers for running work concurrently
+"""
+import Queue
+import sys
+import threading
+
+
+class BackgroundCall(threading.Thread):
+    """ Calls a function in a background thread as soon as it is created and keeps
+        the result, or the exception raised, until it is asked for
+    """
+
+    def __init__(self, fn, *args, **kwargs):
+        """
+            :param fn: the function to call
+            :param args: positional arguments to pass to the function
+            :param kwargs: keyword arguments to pass to the function
+        """
+        super(BackgroundCall, self).__init__(name="BackgroundCall-{}".format(getattr(fn, '__name__', fn)))
+        self.daemon = True
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self._result = None
+        self._exc_info = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self.fn(*self.args, **self.kwargs)
+        except Exception:
+            self._exc_info = sys.exc_info()
+
+    def result(self):
+        """ Wait for the call to finish and return its result
+
+            :returns: the value returned by the function
+            :raises: the exception raised by the function, with its original traceback
+        """
+        # join with a timeout, so that signals are still handled while waiting
+        while self.is_alive():
+            self.join(0.5)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class BoundedPipe(object):
+    """ A write-only file-like object which hands the data written to it over to a
+        background thread, which writes it on to another file-like object. At most
+        maxchunks writes are buffered, so a producer that is faster than the sink
+        is held back instead of filling up the memory.
+    """
+
+    def __init__(self, sink, maxchunks=16, hasher=None):
+        """
+            :param sink: the file-like object to write the data to
+            :param int maxchunks: the maximum number of writes to buffer
+            :param hasher: an optional hashlib object, which will be updated with
+                the data as it is written to the sink
+        """
+        self.sink = sink
+        self.hasher = hasher
+        self.bytes_written = 0
+        self._queue = Queue.Queue(maxsize=maxchunks)
+        self._exc_info = None
+        self._consumer = threading.Thread(target=self._consume, name="BoundedPipe-consumer")
+        self._consumer.daemon = True
+        self._consumer.start()
+
+    def write(self, data):
+        self._put(data)
+        self.bytes_written += len(data)
+
+    def close(self):
+        """ Wait for the buffered data to be written to the sink. The sink is not closed.
+
+            :raises: the exception raised when writing to the sink, if any
+        """
+        if self._consumer.is_alive():
+            self._put(None)
+        # join with a timeout, so that signals are still handled while waiting
+        while self._consumer.is_alive():
+            self._consumer.join(0.5)
+        self._raise_consumer_error()
+
+    def _put(self, data):
+        # put with a timeout, so that a failing consumer does not block the producer forever
+        while True:
+            self._raise_consumer_error()
+            try:
+                self._queue.put(data, timeout=0.5)
+                return
+            except Queue.Full:
+                pass
+
+    def _raise_consumer_error(self):
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def _consume(self):
+        try:
+            while True:
+                data = self._queue.get()
+                if data is None:
+                    return
+                self.sink.write(data)
+                if self.hasher is not None:
+                    self.hasher.update(data)
+        except Exception:
+            self._exc_info = sys.exc_info()
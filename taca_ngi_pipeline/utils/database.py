@@ -2,6 +2,8 @@ __author__ = 'Pontus'
 
 from ngi_pipeline.database import classes as db
 
+from . import metrics
+
 
 class DatabaseError(Exception):
     pass
@@ -16,7 +18,8 @@ def _wrap_database_query(query_fn, *query_args, **query_kwargs):
             if an error occurred when communicating with the database
     """
     try:
-        return query_fn(*query_args, **query_kwargs)
+        with metrics.timed('taca_deliver_charon_request_seconds', method=getattr(query_fn, '__name__', 'unknown')):
+            return query_fn(*query_args, **query_kwargs)
     except db.CharonError as ce:
         raise DatabaseError(ce.message)
 
@@ -37,6 +40,15 @@ def project_entry(dbc, projectid):
     return _wrap_database_query(dbc.project_get, projectid)
 
 
+def project_entries(dbc):
+    """ Fetch the database entries of all projects
+        :returns: a json-formatted dict with the database project entries listed under 'projects'
+        :raises DatabaseError:
+            if an error occurred when communicating with the database
+    """
+    return _wrap_database_query(dbc.projects_get_all)
+
+
 def project_sample_entries(dbc, projectid):
     """ Fetch the database sample entries representing the instance's project
         :returns: a list of json-formatted database sample entries
@@ -1,8 +1,10 @@
 __author__ = 'Pontus'
 
+import time
+
 from glob import iglob
 from logging import getLogger
-from os import path, walk
+from os import path, stat, statvfs, walk
 from taca.utils.misc import hashfile
 
 logger = getLogger(__name__)
@@ -16,7 +18,7 @@ class PatternNotMatchedException(Exception):
     pass
 
 
-def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
+def gather_files(patterns, no_checksum=False, hash_algorithm="md5", index=None, stats=None):
     """ This method will locate files matching the patterns specified in
         the config and compute the checksum and construct the staging path
         according to the config.
@@ -27,10 +29,23 @@ def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
         folder or file. File globs will be expanded and folders will be
         traversed to include everything beneath.
 
+        If a path index is supplied, the patterns are expanded and the folders
+        traversed from the index instead of from the file system.
+
+        :param index: an optional taca_ngi_pipeline.utils.fswatch.PathIndex
+        :param dict stats: an optional dict, which will be updated with the time
+            spent hashing ('hash_seconds') and the number of files and bytes
+            hashed ('hashed_files', 'hashed_bytes')
         :returns: A generator of tuples with source path,
             destination path and the checksum of the source file
             (or None if source is a folder)
     """
+    if index is not None:
+        index.refresh()
+        _glob, _walk, _isdir = index.glob, index.walk, index.isdir
+    else:
+        _glob, _walk, _isdir = iglob, lambda top: walk(top, followlinks=True), path.isdir
+
     def _get_digest(sourcepath, destpath, no_digest_cache=False, no_digest=False):
         digest = None
         # skip the digest if either the global or the per-file setting is to skip
@@ -40,7 +55,12 @@ def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
                 with open(checksumpath, 'r') as fh:
                     digest = fh.next()
             except IOError:
+                started = time.time()
                 digest = hashfile(sourcepath, hasher=hash_algorithm)
+                if stats is not None:
+                    stats['hash_seconds'] = stats.get('hash_seconds', 0) + time.time() - started
+                    stats['hashed_files'] = stats.get('hashed_files', 0) + 1
+                    stats['hashed_bytes'] = stats.get('hashed_bytes', 0) + path.getsize(sourcepath)
                 if not no_digest_cache:
                     try:
                         with open(checksumpath, 'w') as fh:
@@ -51,9 +71,9 @@ def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
 
     def _walk_files(currpath, destpath):
         # if current path is a folder, return all files below it
-        if path.isdir(currpath):
+        if _isdir(currpath):
             parent = path.dirname(currpath)
-            for parentdir, _, dirfiles in walk(currpath, followlinks=True):
+            for parentdir, _, dirfiles in _walk(currpath):
                 for currfile in dirfiles:
                     fullpath = path.join(parentdir, currfile)
                     # the relative path will be used in the destination path
@@ -74,7 +94,7 @@ def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
         except IndexError:
             extra = {}
         matches = 0
-        for f in iglob(sfile):
+        for f in _glob(sfile):
             for spath, dpath in _walk_files(f, dfile):
                 # ignore checksum files
                 if not spath.endswith(".{}".format(hash_algorithm)):
@@ -100,3 +120,61 @@ def gather_files(patterns, no_checksum=False, hash_algorithm="md5"):
                 raise PatternNotMatchedException(msg)
             logger.warning(msg)
 
+
+def staged_size(paths):
+    """ Summarize the size of the supplied files and folders, as they would be
+        after a copy that dereferences symlinks. The stat of a file is cached
+        per symlink target, so files linked from several places are only stat'ed
+        once, although resolving the links with realpath still looks up each
+        path. Folders are counted as entries only.
+
+        :param list paths: the files and folders to summarize
+        :returns: a tuple with the total size in bytes and the total number of
+            files and folders below (and including) the supplied paths
+    """
+    stat_cache = {}
+
+    def _stat(entry):
+        entry = path.realpath(entry)
+        try:
+            return stat_cache[entry]
+        except KeyError:
+            stat_cache[entry] = stat(entry)
+            return stat_cache[entry]
+
+    nbytes = 0
+    nentries = 0
+    for entry in paths:
+        nentries += 1
+        if not path.isdir(entry):
+            nbytes += _stat(entry).st_size
+            continue
+        for parentdir, dirs, dirfiles in walk(entry, followlinks=True):
+            nentries += len(dirs)
+            for currfile in dirfiles:
+                fullpath = path.join(parentdir, currfile)
+                try:
+                    nbytes += _stat(fullpath).st_size
+                except OSError as e:
+                    # a broken symlink will not be copied but should not break the summary
+                    logger.warning("could not stat {}: {}".format(fullpath, e))
+                    continue
+                nentries += 1
+    return nbytes, nentries
+
+
+def available_space(pth):
+    """ Get the free space on the filesystem where the supplied path is, or
+        would be, located. If the path does not exist, its closest existing
+        parent folder will be used.
+
+        :param string pth: the path to check
+        :returns: a tuple with the number of bytes and the number of inodes
+            available to a non-privileged user. The number of inodes will be
+            None if the filesystem does not report it
+    """
+    pth = path.abspath(pth)
+    while not path.exists(pth):
+        pth = path.dirname(pth)
+    st = statvfs(pth)
+    return st.f_bavail * st.f_frsize, (st.f_favail if st.f_files > 0 else None)
@@ -0,0 +1,342 @@
+""" An in-memory index of the files below a set of folders, kept up to date with
+    inotify where possible and with rescans of modified folders otherwise
+"""
+import ctypes
+import ctypes.util
+import errno
+import fnmatch
+import glob
+import os
+import struct
+import sys
+import threading
+import time
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# file systems where inotify does not see changes made from other hosts
+NETWORK_FILESYSTEMS = ('nfs', 'nfs4', 'cifs', 'smb', 'smbfs', 'lustre', 'gpfs', 'beegfs', 'ceph', 'glusterfs')
+
+# inotify event flags, see inotify(7)
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+_WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+_EVENT_HEADER = struct.Struct('iIII')
+
+# a folder modified this close to when it was listed may change again within the
+# resolution of its modification time, so it is listed again on the next refresh
+_MTIME_RESOLUTION = 2
+
+
+def filesystem_type(pth, mounts='/proc/mounts'):
+    """
+        :param string pth: a path
+        :param string mounts: the file listing the mounted file systems
+        :returns: the type of the file system the path is on, or None if it is not known
+    """
+    pth = os.path.realpath(pth)
+    best = (None, None)
+    try:
+        with open(mounts) as fh:
+            for line in fh:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mountpoint = fields[1].decode('string_escape') if '\\' in fields[1] else fields[1]
+                if (pth == mountpoint or pth.startswith(mountpoint.rstrip('/') + '/')) and \
+                        len(mountpoint) > len(best[0] or ''):
+                    best = (mountpoint, fields[2])
+    except IOError:
+        pass
+    return best[1]
+
+
+class _Inotify(object):
+    """ A minimal interface to the Linux inotify API through ctypes """
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._rm_watch = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+
+    def add_watch(self, pth):
+        if isinstance(pth, unicode):
+            pth = pth.encode(sys.getfilesystemencoding())
+        wd = self._add_watch(self.fd, pth, _WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+        return wd
+
+    def rm_watch(self, wd):
+        self._rm_watch(self.fd, wd)
+
+    def read_events(self):
+        """ :returns: a list of (watch descriptor, mask, name) tuples for the pending events """
+        events = []
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                if e.errno in [errno.EAGAIN, errno.EWOULDBLOCK]:
+                    return events
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, namelen = _EVENT_HEADER.unpack_from(data, offset)
+                offset += _EVENT_HEADER.size
+                events.append((wd, mask, data[offset:offset + namelen].rstrip('\0')))
+                offset += namelen
+
+    def close(self):
+        os.close(self.fd)
+
+
+class _Folder(object):
+
+    def __init__(self, mtime, entries, wd=None):
+        # the modification time when listed, or None if it should be listed again
+        self.mtime = mtime
+        # the names in the folder, mapped to True for folders and False for files
+        self.entries = entries
+        self.wd = wd
+
+
+class PathIndex(object):
+    """ An index of the files and folders below a set of root folders, which can
+        replace globbing and walking the file system. Root folders are added as
+        needed when a pattern outside of the indexed folders is globbed.
+
+        Where inotify is available, and the root is not on a network file system,
+        changes are picked up from inotify events and only the affected folders
+        are listed again. Otherwise, refresh checks the modification time of all
+        indexed folders and lists the modified ones again.
+
+        The index is safe to use from several threads.
+    """
+
+    def __init__(self, use_inotify=True):
+        """
+            :param bool use_inotify: if False, always use modification time rescans
+        """
+        self.roots = {}
+        self.listings = 0
+        self._folders = {}
+        self._watches = {}
+        self._lock = threading.RLock()
+        self._inotify = None
+        if use_inotify:
+            try:
+                self._inotify = _Inotify()
+            except (AttributeError, OSError, TypeError) as e:
+                logger.info("inotify is not available, changes will be found by rescanning: {}".format(e))
+
+    def add_root(self, root):
+        """ Index the files and folders below a folder
+
+            :param string root: the folder to index
+        """
+        root = os.path.normpath(os.path.abspath(root))
+        with self._lock:
+            if self._root_of(root) is not None:
+                return
+            use_inotify = self._inotify is not None and filesystem_type(root) not in NETWORK_FILESYSTEMS
+            # roots below the new root are now covered by it
+            for other in [r for r in self.roots if r.startswith(root + os.sep)]:
+                del self.roots[other]
+            self.roots[root] = use_inotify
+            self._scan(root, use_inotify)
+            logger.debug("indexed {} folders below {} using {}".format(
+                len([f for f in self._folders if f == root or f.startswith(root + os.sep)]), root,
+                "inotify" if use_inotify else "rescans"))
+
+    def refresh(self):
+        """ Bring the index up to date with the file system """
+        with self._lock:
+            dirty = set()
+            if self._inotify is not None:
+                for wd, mask, _ in self._inotify.read_events():
+                    if mask & IN_Q_OVERFLOW:
+                        # events were lost, fall back to checking all folders
+                        dirty.update([f for f in self._folders if self._uses_inotify(f)])
+                        continue
+                    # the same folder can be indexed under several paths through symlinks
+                    folders = self._watches.get(wd, set())
+                    if mask & IN_IGNORED:
+                        self._watches.pop(wd, None)
+                        for folder in folders:
+                            if folder in self._folders:
+                                self._folders[folder].wd = None
+                    dirty.update(folders)
+            for root, use_inotify in self.roots.items():
+                if not use_inotify:
+                    self._check_mtimes(root, dirty)
+            # folders listed too close to their modification time are listed again
+            dirty.update([f for f, entry in self._folders.items() if entry.mtime is None])
+            for folder in sorted(dirty):
+                if folder in self._folders:
+                    self._scan(folder, self._uses_inotify(folder))
+
+    def glob(self, pattern):
+        """ Expand a glob pattern like glob.glob does, but from the index
+
+            :param string pattern: the pattern to expand
+            :returns: a list of the matching paths
+        """
+        pattern = os.path.normpath(os.path.abspath(pattern))
+        parts = pattern.split(os.sep)
+        # the leading folders without wildcards, the last part is always matched against the index
+        static = parts[:min(len(parts) - 1, next((i for i, p in enumerate(parts) if glob.has_magic(p)), len(parts)))]
+        prefix = os.sep.join(static) or os.sep
+        with self._lock:
+            if self._root_of(prefix) is None:
+                if not os.path.isdir(prefix):
+                    return []
+                self.add_root(prefix)
+            return self._match(prefix, parts[len(static):])
+
+    def walk(self, top):
+        """ Walk the folders below top like os.walk(top, followlinks=True), but from the index
+
+            :param string top: the folder to walk
+            :returns: a list of (folder, folder names, file names) tuples
+        """
+        top = os.path.normpath(os.path.abspath(top))
+        with self._lock:
+            if self._root_of(top) is None:
+                if not os.path.isdir(top):
+                    return []
+                self.add_root(top)
+            result = []
+            pending = [top]
+            while pending:
+                folder = pending.pop(0)
+                entry = self._folders.get(folder)
+                if entry is None:
+                    continue
+                dirs = sorted([name for name, isdir in entry.entries.items() if isdir])
+                files = sorted([name for name, isdir in entry.entries.items() if not isdir])
+                result.append((folder, dirs, files))
+                pending.extend([os.path.join(folder, name) for name in dirs])
+            return result
+
+    def isdir(self, pth):
+        """ :returns: True if the path is an indexed folder, or a folder outside of the index """
+        pth = os.path.normpath(os.path.abspath(pth))
+        with self._lock:
+            if self._root_of(pth) is None:
+                return os.path.isdir(pth)
+            return pth in self._folders
+
+    def close(self):
+        """ Stop watching for changes """
+        with self._lock:
+            if self._inotify is not None:
+                self._inotify.close()
+                self._inotify = None
+            self._watches = {}
+
+    def _root_of(self, pth):
+        for root in self.roots:
+            if pth == root or pth.startswith(root.rstrip(os.sep) + os.sep):
+                return root
+        return None
+
+    def _uses_inotify(self, folder):
+        root = self._root_of(folder)
+        return root is not None and self.roots[root] and self._inotify is not None
+
+    def _match(self, folder, parts):
+        entry = self._folders.get(folder)
+        if entry is None:
+            return []
+        if not parts:
+            return [folder]
+        part, rest = parts[0], parts[1:]
+        if glob.has_magic(part):
+            names = [n for n in entry.entries if part.startswith('.') or not n.startswith('.')]
+            names = sorted(fnmatch.filter(names, part))
+        else:
+            names = [part] if part in entry.entries else []
+        matches = []
+        for name in names:
+            pth = os.path.join(folder, name)
+            if not rest:
+                matches.append(pth)
+            elif entry.entries[name]:
+                matches.extend(self._match(pth, rest))
+        return matches
+
+    def _check_mtimes(self, folder, dirty):
+        """ Collect the folders below folder which were modified since they were listed """
+        entry = self._folders.get(folder)
+        if entry is None:
+            return
+        try:
+            mtime = os.stat(folder).st_mtime
+        except OSError:
+            dirty.add(folder)
+            return
+        if mtime != entry.mtime:
+            dirty.add(folder)
+        # the modification time of a folder only changes with its own entries, so check the subfolders too
+        for name, isdir in entry.entries.items():
+            if isdir:
+                self._check_mtimes(os.path.join(folder, name), dirty)
+
+    def _forget(self, folder):
+        """ Drop a folder, and everything below it, from the index """
+        for pth in [f for f in self._folders if f == folder or f.startswith(folder + os.sep)]:
+            entry = self._folders.pop(pth)
+            if entry.wd is not None and self._inotify is not None:
+                folders = self._watches.get(entry.wd, set())
+                folders.discard(pth)
+                if not folders:
+                    self._inotify.rm_watch(entry.wd)
+                    self._watches.pop(entry.wd, None)
+
+    def _scan(self, folder, use_inotify):
+        """ List a folder, and any folders below it which are new to the index """
+        previous = self._folders.get(folder)
+        wd = previous.wd if previous is not None else None
+        if use_inotify and wd is None and self._inotify is not None:
+            # watch before listing, so that no change is missed in between
+            try:
+                wd = self._inotify.add_watch(folder)
+                self._watches.setdefault(wd, set()).add(folder)
+            except OSError as e:
+                logger.warning("could not watch {}, changes will be found by rescanning: {}".format(folder, e))
+                self.roots[self._root_of(folder)] = False
+                use_inotify = False
+        try:
+            mtime = os.stat(folder).st_mtime
+            names = os.listdir(folder)
+        except OSError:
+            self._forget(folder)
+            return
+        self.listings += 1
+        if time.time() - mtime < _MTIME_RESOLUTION:
+            mtime = None
+        entries = dict([(name, os.path.isdir(os.path.join(folder, name))) for name in names])
+        self._folders[folder] = _Folder(mtime, entries, wd)
+        # forget folders which have disappeared and index the new ones
+        old_entries = previous.entries if previous is not None else {}
+        for name, isdir in old_entries.items():
+            if isdir and not entries.get(name):
+                self._forget(os.path.join(folder, name))
+        for name, isdir in entries.items():
+            if isdir and os.path.join(folder, name) not in self._folders:
+                self._scan(os.path.join(folder, name), use_inotify)
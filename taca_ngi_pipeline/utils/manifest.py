@@ -0,0 +1,187 @@
+""" Hierarchical (Merkle) manifests of staged deliveries
+
+    A manifest is a tree mirroring the staged folder structure. Each file node
+    holds the digest and size of the file, and each folder node holds a digest
+    computed from the names, digests and sizes of its children and the total size
+    below it. Files which are not hashed get their modification time in place of
+    a digest, see mtime_digest. Two manifests can therefore be compared by descending only into
+    the folders whose digests differ, so that the cost of a comparison depends on
+    the number of changed subtrees rather than on the number of files.
+
+    Manifests are stored as JSON, e.g.
+
+        {"version": 1, "algorithm": "sha1",
+         "root": {"hash": "...", "size": 1024, "children": {
+             "NGIU-S001": {"hash": "...", "size": 1024, "children": {
+                 "reads.fastq.gz": {"hash": "...", "size": 1024}}}}}}
+"""
+import hashlib
+import json
+import os
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+MANIFEST_VERSION = 1
+
+
+def mtime_digest(mtime):
+    """ :returns: a stand-in for the digest of a file which is not hashed, which
+        changes with the modification time of the file
+    """
+    return "mtime:{:.6f}".format(mtime)
+
+
+def _is_dir(node):
+    return 'children' in node
+
+
+def _join(path, name):
+    # concatenated rather than formatted, which would encode unicode names as ASCII
+    return path + '/' + name if path else name
+
+
+def _seal(node, hash_algorithm):
+    """ Compute the digests and sizes of a folder node and the folders below it """
+    hasher = hashlib.new(hash_algorithm)
+    size = 0
+    for name in sorted(node['children']):
+        child = node['children'][name]
+        if _is_dir(child):
+            _seal(child, hash_algorithm)
+        size += child['size']
+        # the names are byte strings when built from the file system and unicode when read from JSON,
+        # both are hashed as UTF-8 so that the digests are the same
+        if isinstance(name, str):
+            name = name.decode('utf-8')
+        hasher.update(u"{}\t{}\t{}\t{}\n".format(
+            'd' if _is_dir(child) else 'f', name, child['hash'], child['size']).encode('utf-8'))
+    node['hash'] = hasher.hexdigest()
+    node['size'] = size
+
+
+def _add(root, fpath, node):
+    parts = [part for part in fpath.split('/') if part not in ['', '.']]
+    parent = root
+    for part in parts[:-1]:
+        parent = parent['children'].setdefault(part, {'children': {}})
+        if not _is_dir(parent):
+            raise ValueError("{} is both a file and a folder in the manifest".format(part))
+    parent['children'][parts[-1]] = node
+
+
+def build(entries, hash_algorithm):
+    """ Build a manifest from the files of a staged delivery
+
+        :param entries: (path, digest, size) tuples for the files, with the paths
+            relative to the staging folder
+        :param string hash_algorithm: the algorithm of the file digests, which is
+            also used for the folder digests
+        :returns: the manifest, as a dict
+    """
+    root = {'children': {}}
+    for fpath, digest, size in entries:
+        _add(root, fpath, {'hash': digest, 'size': size})
+    _seal(root, hash_algorithm)
+    return {'version': MANIFEST_VERSION, 'algorithm': hash_algorithm, 'root': root}
+
+
+def merge(manifests):
+    """ Merge manifests, e.g. those of the samples of a project, into one. A file
+        present in several manifests is taken from the last one.
+
+        :param list manifests: the manifests to merge
+        :returns: the merged manifest
+        :raises ValueError: if the manifests were made with different hash algorithms
+    """
+    algorithms = set([m['algorithm'] for m in manifests])
+    if len(algorithms) != 1:
+        raise ValueError("cannot merge manifests with the hash algorithms {}".format(", ".join(sorted(algorithms))))
+    root = {'children': {}}
+    for m in manifests:
+        for fpath, node in iter_files(m):
+            _add(root, fpath, dict(node))
+    _seal(root, algorithms.pop())
+    return {'version': MANIFEST_VERSION, 'algorithm': manifests[0]['algorithm'], 'root': root}
+
+
+def iter_files(manifest, node=None, path=''):
+    """ :returns: a generator of (path, node) tuples for the files in a manifest """
+    node = manifest['root'] if node is None else node
+    for name in sorted(node['children']):
+        child = node['children'][name]
+        childpath = _join(path, name)
+        if _is_dir(child):
+            for item in iter_files(manifest, child, childpath):
+                yield item
+        else:
+            yield childpath, child
+
+
+def diff(old, new):
+    """ Compare two manifests, descending only into the folders that differ
+
+        :param dict old: the earlier manifest, e.g. of the last delivery
+        :param dict new: the later manifest
+        :returns: a tuple with the sorted paths of the files that were added or
+            changed in new and of the files in old that are not in new
+    """
+    changed = []
+    removed = []
+    if old['algorithm'] != new['algorithm']:
+        # the digests cannot be compared, so everything is different
+        return sorted([fpath for fpath, _ in iter_files(new)]), []
+    _diff(old['root'], new['root'], '', changed, removed)
+    return sorted(changed), sorted(removed)
+
+
+def _diff(old, new, path, changed, removed):
+    if old is not None and new is not None and _is_dir(old) == _is_dir(new) and \
+            old['hash'] == new['hash'] and old['size'] == new['size']:
+        return
+    if new is None:
+        removed.extend(_files_below(old, path))
+        return
+    if not _is_dir(new):
+        changed.append(path)
+        if old is not None and _is_dir(old):
+            removed.extend(_files_below(old, path))
+        return
+    old_children = {}
+    if old is not None and _is_dir(old):
+        old_children = old['children']
+    elif old is not None:
+        removed.append(path)
+    for name in set(old_children) | set(new['children']):
+        childpath = _join(path, name)
+        _diff(old_children.get(name), new['children'].get(name), childpath, changed, removed)
+
+
+def _files_below(node, path):
+    if not _is_dir(node):
+        return [path]
+    return [_join(path, fpath)
+            for fpath, _ in iter_files({'root': node})]
+
+
+def write(manifest, path):
+    """ Write a manifest to a file, replacing it atomically """
+    tmppath = "{}.tmp".format(path)
+    with open(tmppath, 'w') as fh:
+        json.dump(manifest, fh, sort_keys=True, separators=(',', ':'))
+    os.rename(tmppath, path)
+
+
+def read(path):
+    """ Read a manifest from a file
+
+        :returns: the manifest
+        :raises IOError: if the file could not be read
+        :raises ValueError: if the file is not a manifest of a supported version
+    """
+    with open(path) as fh:
+        manifest = json.load(fh)
+    if not isinstance(manifest, dict) or manifest.get('version') != MANIFEST_VERSION:
+        raise ValueError("{} is not a version {} manifest".format(path, MANIFEST_VERSION))
+    return manifest
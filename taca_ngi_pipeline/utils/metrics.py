@@ -0,0 +1,206 @@
+""" Delivery metrics in the text file format of the Prometheus node_exporter
+    textfile collector
+"""
+import contextlib
+import fcntl
+import os
+import re
+import tempfile
+import threading
+import time
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+# the type and help text of the exported metrics. Summaries are exported as
+# <name>_sum and <name>_count counters, so that they can be added up between runs
+METRICS = {
+    'taca_deliver_staged_bytes_total': (
+        'counter', "Bytes of files staged for delivery"),
+    'taca_deliver_staged_files_total': (
+        'counter', "Files staged for delivery"),
+    'taca_deliver_hashed_bytes_total': (
+        'counter', "Bytes of staged files hashed"),
+    'taca_deliver_hashing_seconds_total': (
+        'counter', "Seconds spent hashing staged files"),
+    'taca_deliver_transferred_bytes_total': (
+        'counter', "Bytes transferred to the delivery destination"),
+    'taca_deliver_transfer_seconds_total': (
+        'counter', "Seconds spent transferring to the delivery destination"),
+    'taca_deliver_verified_bytes_total': (
+        'counter', "Bytes of delivered files hashed again to verify them"),
+    'taca_deliver_verification_seconds_total': (
+        'counter', "Seconds spent verifying delivered files"),
+    'taca_deliver_sample_files': (
+        'summary', "Files staged per sample"),
+    'taca_deliver_charon_request_seconds': (
+        'summary', "Latency of requests to Charon"),
+    'taca_deliver_delivery_seconds': (
+        'summary', "Duration of deliveries"),
+}
+
+_SAMPLE_LINE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{.*\})?\s+(\S+)$')
+
+
+def _labelstr(labels):
+    if not labels:
+        return ''
+    return "{{{}}}".format(",".join(
+        '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for k, v in sorted(labels.items())))
+
+
+def _family(name):
+    """ :returns: the name of the metric a sample belongs to """
+    for suffix in ['_sum', '_count']:
+        if name.endswith(suffix) and METRICS.get(name[:-len(suffix)], (None,))[0] == 'summary':
+            return name[:-len(suffix)]
+    return name
+
+
+class MetricsTextfile(object):
+    """ Counters and summaries which are added to the values in a .prom file when
+        flushed. The file is updated under a lock and replaced atomically, so
+        several delivery processes on the same node can share it and the collector
+        never reads a partially written file.
+    """
+
+    def __init__(self, path):
+        """
+            :param string path: the .prom file, in the directory read by the
+                textfile collector
+        """
+        self.path = path
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """ Increase a counter
+
+            :param string name: the name of the counter
+            :param value: the amount to increase the counter with
+            :param labels: the labels of the counter
+        """
+        key = (name, _labelstr(labels))
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        """ Add an observation to a summary
+
+            :param string name: the name of the summary
+            :param value: the observed value
+            :param labels: the labels of the summary
+        """
+        self.inc("{}_sum".format(name), value, **labels)
+        self.inc("{}_count".format(name), 1, **labels)
+
+    def flush(self):
+        """ Add the values collected since the last flush to the file """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        try:
+            promdir = os.path.dirname(os.path.abspath(self.path))
+            if not os.path.exists(promdir):
+                os.makedirs(promdir)
+            with open("{}.lock".format(self.path), 'a') as lockfh:
+                fcntl.flock(lockfh, fcntl.LOCK_EX)
+                values = self._read()
+                for key, value in pending.items():
+                    values[key] = values.get(key, 0) + value
+                # the collector ignores files which do not end in .prom
+                fd, tmppath = tempfile.mkstemp(dir=promdir, prefix=".{}".format(os.path.basename(self.path)))
+                with os.fdopen(fd, 'w') as fh:
+                    self._write(fh, values)
+                os.chmod(tmppath, 0o644)
+                os.rename(tmppath, self.path)
+        except (IOError, OSError) as e:
+            logger.warning("could not write delivery metrics to {}: {}".format(self.path, e))
+
+    def _read(self):
+        values = {}
+        try:
+            with open(self.path, 'r') as fh:
+                for line in fh:
+                    m = _SAMPLE_LINE.match(line.strip())
+                    if line.startswith('#') or m is None:
+                        continue
+                    try:
+                        values[(m.group(1), m.group(2) or '')] = float(m.group(3))
+                    except ValueError:
+                        continue
+        except IOError:
+            pass
+        return values
+
+    def _write(self, fh, values):
+        families = {}
+        for name, labels in values:
+            families.setdefault(_family(name), []).append((name, labels))
+        for family in sorted(families):
+            if family in METRICS:
+                fh.write("# HELP {} {}\n# TYPE {} {}\n".format(
+                    family, METRICS[family][1], family, METRICS[family][0]))
+            for name, labels in sorted(families[family]):
+                fh.write("{}{} {}\n".format(name, labels, repr(float(values[(name, labels)]))))
+
+
+# the metrics of this process, if enabled with configure
+_textfile = None
+
+
+def configure(path):
+    """ Enable the metrics and write them to a .prom file
+
+        :param string path: the .prom file, or None to disable the metrics
+    """
+    global _textfile
+    if path is None:
+        _textfile = None
+    elif _textfile is None or _textfile.path != path:
+        _textfile = MetricsTextfile(path)
+
+
+def enabled():
+    """ :returns: True if the metrics are enabled """
+    return _textfile is not None
+
+
+def inc(name, value=1, **labels):
+    """ Increase a counter, if the metrics are enabled. See MetricsTextfile.inc """
+    if _textfile is not None:
+        _textfile.inc(name, value, **labels)
+
+
+def observe(name, value, **labels):
+    """ Add an observation to a summary, if the metrics are enabled. See MetricsTextfile.observe """
+    if _textfile is not None:
+        _textfile.observe(name, value, **labels)
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+    """ Context manager observing the duration of a block in a summary, with an
+        outcome label which is 'error' if the block raised an exception
+    """
+    if _textfile is None:
+        yield
+        return
+    started = time.time()
+    outcome = 'success'
+    try:
+        yield
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        observe(name, time.time() - started, outcome=outcome, **labels)
+
+
+def flush():
+    """ Write the collected metrics to the .prom file, if the metrics are enabled """
+    if _textfile is not None:
+        _textfile.flush()
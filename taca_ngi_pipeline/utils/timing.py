@@ -0,0 +1,113 @@
+""" Timing of the phases of a delivery
+"""
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+from logging import getLogger
+
+logger = getLogger(__name__)
+
+
+class Span(object):
+    """ A timed phase, which can be given byte and file counts and other fields """
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def add(self, **counts):
+        """ Add to the counts of the span, e.g. span.add(bytes=1024, files=1) """
+        for key, value in counts.items():
+            self.fields[key] = self.fields.get(key, 0) + value
+
+    def set(self, **fields):
+        """ Set fields of the span """
+        self.fields.update(fields)
+
+
+class _NullSpan(object):
+    """ A span which records nothing, used when timing is disabled """
+
+    def add(self, **counts):
+        pass
+
+    def set(self, **fields):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class SpanRecorder(object):
+    """ Records timing spans as JSON lines appended to a file. If no file is given,
+        recording is disabled and the spans cost next to nothing.
+    """
+
+    def __init__(self, path=None, **context):
+        """
+            :param string path: the file to append the spans to, or None to disable
+                recording
+            :param context: fields to include in every span, e.g. the project and
+                sample ids
+        """
+        self.path = path
+        self.context = context
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    @contextlib.contextmanager
+    def span(self, name, **fields):
+        """ Context manager timing a phase. The span is recorded when the phase
+            ends, also if it ends with an exception.
+
+            :param string name: the name of the phase
+            :param fields: fields to record with the span
+            :returns: the Span, to which counts can be added
+        """
+        if not self.enabled:
+            yield _NULL_SPAN
+            return
+        span = Span(name, fields)
+        started = time.time()
+        try:
+            yield span
+        except Exception as e:
+            span.set(error=e.__class__.__name__)
+            raise
+        finally:
+            self.record(name, time.time() - started, started=started, **span.fields)
+
+    def record(self, name, seconds, started=None, **fields):
+        """ Record a span which was timed elsewhere
+
+            :param string name: the name of the phase
+            :param float seconds: the duration of the phase
+            :param float started: the start of the phase as a unix timestamp,
+                defaults to seconds before now
+            :param fields: fields to record with the span
+        """
+        if not self.enabled:
+            return
+        started = started if started is not None else time.time() - seconds
+        entry = dict(self.context)
+        entry.update(fields)
+        entry.update({
+            'span': name,
+            'started': datetime.datetime.utcfromtimestamp(started).isoformat() + "Z",
+            'seconds': round(seconds, 6)})
+        try:
+            with self._lock:
+                spandir = os.path.dirname(self.path)
+                if spandir and not os.path.exists(spandir):
+                    os.makedirs(spandir)
+                with open(self.path, 'a') as fh:
+                    fh.write("{}\n".format(json.dumps(entry, sort_keys=True)))
+        except (IOError, OSError) as e:
+            logger.warning("could not record timing span to {}: {}".format(self.path, e))
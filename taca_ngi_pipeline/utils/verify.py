@@ -0,0 +1,223 @@
+""" Verification of delivered files against the digest file written when staging
+
+    The delivered files are hashed again on a pool of worker threads, each file
+    read once with large sequential reads, and the digests are compared with the
+    ones in the digest file. When the delivery went to a remote host, this module
+    is sent over ssh and run there as a helper script, so it only uses the
+    standard library and runs with both python 2 and 3.
+"""
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+from logging import getLogger
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+logger = getLogger(__name__)
+
+# the size of the reads when hashing, large enough for the reads to be sequential on disk
+READ_SIZE = 4 * 1024 * 1024
+
+
+class VerificationError(Exception):
+    pass
+
+
+class VerificationResult(object):
+    """ The outcome of a verification
+    """
+
+    def __init__(self, files=0, bytes=0, seconds=0.0, mismatches=None):
+        """
+            :param int files: the number of files verified
+            :param int bytes: the number of bytes hashed
+            :param float seconds: the wall time of the verification
+            :param list mismatches: (path, expected digest, actual digest) tuples for
+                the files which did not match, with None as the actual digest of
+                missing files
+        """
+        self.files = files
+        self.bytes = bytes
+        self.seconds = seconds
+        self.mismatches = mismatches or []
+
+    @property
+    def ok(self):
+        return not self.mismatches
+
+    @property
+    def bytes_per_second(self):
+        return int(self.bytes / self.seconds) if self.seconds > 0 else 0
+
+    def to_dict(self):
+        return {
+            'files': self.files,
+            'bytes': self.bytes,
+            'seconds': round(self.seconds, 3),
+            'mismatches': [list(mismatch) for mismatch in self.mismatches]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['files'], data['bytes'], data['seconds'], [tuple(m) for m in data['mismatches']])
+
+
+def read_digestfile(digestfile):
+    """ Read a digest file, with lines on the form '<digest>  <path>'
+
+        :param string digestfile: the digest file
+        :returns: a list of (digest, path) tuples, with the paths relative to the
+            folder of the digest file
+    """
+    entries = []
+    with open(digestfile) as fh:
+        for line in fh:
+            line = line.rstrip('\n')
+            if not line.strip():
+                continue
+            digest, fpath = line.split(None, 1)
+            entries.append((digest, fpath))
+    return entries
+
+
+def hash_file(path, hash_algorithm, read_size=READ_SIZE):
+    """ :returns: a tuple with the hex digest of a file and its size in bytes """
+    hasher = hashlib.new(hash_algorithm)
+    nbytes = 0
+    with open(path, 'rb') as fh:
+        data = fh.read(read_size)
+        while data:
+            hasher.update(data)
+            nbytes += len(data)
+            data = fh.read(read_size)
+    return hasher.hexdigest(), nbytes
+
+
+def verify_digestfile(digestfile, hash_algorithm=None, workers=4, read_size=READ_SIZE):
+    """ Hash the files listed in a digest file and compare them with the listed digests
+
+        :param string digestfile: the digest file, the paths in it are relative to its folder
+        :param string hash_algorithm: the hash algorithm, by default the extension of
+            the digest file
+        :param int workers: the number of files to hash in parallel
+        :param int read_size: the size of the reads
+        :returns: a VerificationResult
+        :raises VerificationError: if the digest file could not be read
+    """
+    hash_algorithm = hash_algorithm or os.path.splitext(digestfile)[1].lstrip('.')
+    try:
+        entries = read_digestfile(digestfile)
+    except (IOError, OSError, ValueError) as e:
+        raise VerificationError("could not read the digest file {}: {}".format(digestfile, e))
+    basedir = os.path.dirname(os.path.abspath(digestfile))
+    # the largest files first, so that the workers finish at about the same time
+    todo = []
+    mismatches = []
+    for digest, fpath in entries:
+        try:
+            size = os.path.getsize(os.path.join(basedir, fpath))
+        except OSError:
+            mismatches.append((fpath, digest, None))
+            continue
+        todo.append((size, fpath, digest))
+    pending = queue.Queue()
+    for item in sorted(todo, reverse=True):
+        pending.put(item)
+    lock = threading.Lock()
+    totals = {'files': 0, 'bytes': 0}
+    errors = []
+
+    def _work():
+        while not errors:
+            try:
+                _, fpath, expected = pending.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                actual, nbytes = hash_file(os.path.join(basedir, fpath), hash_algorithm, read_size)
+            except (IOError, OSError):
+                actual, nbytes = None, 0
+            except Exception as e:
+                errors.append(e)
+                return
+            with lock:
+                totals['files'] += 1
+                totals['bytes'] += nbytes
+                if actual != expected:
+                    mismatches.append((fpath, expected, actual))
+
+    started = time.time()
+    threads = [threading.Thread(target=_work) for _ in range(max(1, min(workers, len(todo))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        # join with a timeout, so that signals are still handled while waiting
+        while thread.is_alive():
+            thread.join(0.5)
+    if errors:
+        raise VerificationError("could not verify {}: {}".format(digestfile, errors[0]))
+    return VerificationResult(totals['files'], totals['bytes'], time.time() - started, sorted(mismatches))
+
+
+def verify_remote(digestfile, remote_host, remote_user=None, hash_algorithm=None, workers=4, python='python'):
+    """ Verify a digest file on a remote host, by running this module there over ssh
+
+        :param string digestfile: the path to the digest file on the remote host
+        :param string remote_host: the remote host
+        :param string remote_user: the user to log in as, by default the local user
+        :param string hash_algorithm: see verify_digestfile
+        :param int workers: see verify_digestfile
+        :param string python: the python interpreter on the remote host
+        :returns: a VerificationResult
+        :raises VerificationError: if the helper could not be run
+    """
+    target = "{}@{}".format(remote_user, remote_host) if remote_user else remote_host
+    command = ['ssh', '-o', 'BatchMode=yes', target, python, '-', digestfile, '--workers', str(workers)]
+    if hash_algorithm:
+        command.extend(['--hash-algorithm', hash_algorithm])
+    with open(os.path.splitext(__file__)[0] + '.py', 'rb') as fh:
+        source = fh.read()
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate(source)
+    except OSError as e:
+        raise VerificationError("could not run ssh to verify {} on {}: {}".format(digestfile, remote_host, e))
+    if process.returncode != 0:
+        raise VerificationError("verification of {} on {} failed with exit status {}: {}".format(
+            digestfile, remote_host, process.returncode, err.strip()))
+    try:
+        return VerificationResult.from_dict(json.loads(out.decode('utf-8')))
+    except (ValueError, KeyError, TypeError) as e:
+        raise VerificationError("unexpected output from the verification of {} on {}: {}".format(
+            digestfile, remote_host, e))
+
+
+def main(argv=None):
+    """ Verify a digest file and write the result as JSON to stdout. This is the
+        entry point of the remote helper.
+    """
+    import argparse
+    parser = argparse.ArgumentParser(description="Verify the files listed in a digest file")
+    parser.add_argument('digestfile')
+    parser.add_argument('--hash-algorithm', default=None)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args(argv)
+    try:
+        result = verify_digestfile(args.digestfile, hash_algorithm=args.hash_algorithm, workers=args.workers)
+    except VerificationError as e:
+        sys.stderr.write("{}\n".format(e))
+        return 1
+    sys.stdout.write(json.dumps(result.to_dict()))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
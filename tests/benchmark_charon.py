@@ -0,0 +1,108 @@
+""" Benchmark of a project delivery against a local Charon stand-in
+
+    A synthetic project tree is built as in benchmark_deliver.py and the project
+    and its samples are added to a CharonStandIn, with the configured latency and
+    error injection. ProjectDeliverer.deliver_project then stages the project,
+    talking to the stand-in over HTTP through ngi_pipeline's CharonSession, and
+    the wall time and the number of Charon calls are reported, e.g.
+
+        python benchmark_charon.py --samples 20 --latency 0.05
+        python benchmark_charon.py --samples 20 --max-calls-per-sample 5
+
+    The samples are only staged, so that no transfer is needed.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from taca.utils.config import CONFIG
+from taca_ngi_pipeline.deliver import deliver
+
+import benchmark_deliver
+from charon_server import CharonStandIn
+
+API_TOKEN = "charon-stand-in-token"
+
+
+def run(rootdir, samples, files_per_sample, sizes, latency=0.0, jitter=0.0, error_rate=0.0, seed=None):
+    """ Deliver a synthetic project against the stand-in
+        :returns: a dict with the wall time, the Charon calls and the outcome
+    """
+    sampleids, nfiles, _ = benchmark_deliver.build_tree(rootdir, samples, files_per_sample, sizes)
+    config = benchmark_deliver.deliverer_config(rootdir)
+    # only stage the samples, and skip the external report commands
+    config['stage_only'] = True
+    for key in ['report_aggregate', 'report_sample', 'copy_reports_to_reports_outbox']:
+        config.pop(key, None)
+    with CharonStandIn(latency=latency, jitter=jitter, error_rate=error_rate, api_token=API_TOKEN,
+                       seed=seed) as charon:
+        charon.add_project(benchmark_deliver.PROJECTID, uppnex_id="a2099999")
+        for sampleid in sampleids:
+            charon.add_sample(benchmark_deliver.PROJECTID, sampleid, analysis_status="ANALYZED")
+        os.environ['CHARON_BASE_URL'] = charon.base_url
+        os.environ['CHARON_API_TOKEN'] = API_TOKEN
+        # the sample deliverers are set up from the deliver section of the config
+        CONFIG['deliver'] = dict(config)
+        error = None
+        started = time.time()
+        try:
+            deliver.ProjectDeliverer(benchmark_deliver.PROJECTID, **config).deliver_project()
+        except Exception as e:
+            error = "{}: {}".format(e.__class__.__name__, e)
+        wall = time.time() - started
+        staged = len([s for s in charon.samples.values() if s['delivery_status'] == 'STAGED'])
+        return {
+            'wall_seconds': wall,
+            'files': nfiles,
+            'samples': len(sampleids),
+            'staged_samples': staged,
+            'calls': dict(("{} {}".format(*key), count) for key, count in charon.calls.items()),
+            'total_calls': charon.total_calls(),
+            'calls_per_sample': float(charon.total_calls()) / max(len(sampleids), 1),
+            'injected_errors': charon.errors,
+            'error': error}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--samples', type=int, default=10, help="number of samples in the project")
+    parser.add_argument('--files-per-sample', type=int, default=4,
+                        help="number of files matching each wildcard pattern for a sample")
+    parser.add_argument('--size-dist', default='fixed:1024',
+                        help="file size distribution in bytes: fixed:SIZE, uniform:MIN:MAX or lognormal:MU:SIGMA")
+    parser.add_argument('--latency', type=float, default=0.0, help="seconds added to each Charon request")
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help="up to this many seconds added at random to each Charon request")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="fraction of Charon requests that fail")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the file sizes, jitter and errors")
+    parser.add_argument('--max-calls-per-sample', type=float, default=None,
+                        help="exit with an error if the average number of Charon calls per sample is above this")
+    args = parser.parse_args(argv)
+
+    rootdir = tempfile.mkdtemp(prefix="taca_benchmark_charon_")
+    try:
+        result = run(rootdir, args.samples, args.files_per_sample,
+                     benchmark_deliver.size_distribution(args.size_dist, args.seed),
+                     latency=args.latency, jitter=args.jitter, error_rate=args.error_rate, seed=args.seed)
+    finally:
+        shutil.rmtree(rootdir, ignore_errors=True)
+
+    print("staged {staged_samples} of {samples} samples ({files} files) in {wall_seconds:.3f} s".format(**result))
+    if result['error']:
+        print("the delivery failed with {}".format(result['error']))
+    print("{total_calls} Charon calls, {calls_per_sample:.1f} per sample, {injected_errors} injected errors".format(
+        **result))
+    for call, count in sorted(result['calls'].items()):
+        print("  {:<16}{:>6}".format(call, count))
+    if args.max_calls_per_sample is not None and result['calls_per_sample'] > args.max_calls_per_sample:
+        print("{:.1f} Charon calls per sample is above {:.1f}".format(
+            result['calls_per_sample'], args.max_calls_per_sample))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,96 @@
+""" Benchmark of the start-up time of the delivery CLI
+
+    The CLI only imports the backend of the selected cluster, so that starting it
+    does not load the heavy dependencies of all backends. Each command is run in
+    a fresh interpreter, importing the CLI and showing the help of the deliver
+    commands, and the best and the median wall time of the repeats are reported
+    together with the backend modules imported, e.g.
+
+        python benchmark_cli.py
+        python benchmark_cli.py --repeats 20 --max-seconds 1.0
+
+    The wall time includes starting the interpreter, which is measured on its own
+    as a baseline.
+"""
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+# the modules which should only be imported when the cluster needing them is selected
+BACKEND_MODULES = [
+    'taca_ngi_pipeline.deliver.deliver',
+    'taca_ngi_pipeline.deliver.deliver_castor',
+    'taca_ngi_pipeline.deliver.deliver_grus',
+    'taca_ngi_pipeline.deliver.deliver_mosler',
+    'ngi_pipeline',
+    'couchdb',
+    'paramiko',
+    'requests']
+
+# the code run for each command, printing the imported modules as json on the last line
+COMMANDS = [
+    ('python', "pass"),
+    ('import cli', "import taca_ngi_pipeline.cli"),
+    ('deliver --help',
+     "import taca_ngi_pipeline.cli; "
+     "taca_ngi_pipeline.cli.deliver.main(['--help'], prog_name='deliver', standalone_mode=False)"),
+    ('deliver project --help',
+     "import taca_ngi_pipeline.cli; "
+     "taca_ngi_pipeline.cli.deliver.main(['project', '--help'], prog_name='deliver', standalone_mode=False)")]
+
+
+def time_command(code):
+    """ Run the code in a fresh interpreter
+        :returns: a tuple with the wall time and the names of the imported modules
+    """
+    code = "import json, sys; {}; print(json.dumps(sorted(sys.modules.keys())))".format(code)
+    started = time.time()
+    output = subprocess.check_output([sys.executable, "-c", code])
+    wall = time.time() - started
+    return wall, json.loads(output.splitlines()[-1])
+
+
+def run(repeats):
+    """ Time each command
+        :returns: a dict with the best and the median wall time and the imported backend
+            modules of each command
+    """
+    results = {}
+    for name, code in COMMANDS:
+        walls = []
+        for _ in xrange(repeats):
+            wall, modules = time_command(code)
+            walls.append(wall)
+        walls.sort()
+        results[name] = {
+            'best_seconds': walls[0],
+            'median_seconds': walls[len(walls) // 2],
+            'backends': [module for module in BACKEND_MODULES if module in modules]}
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--repeats', type=int, default=5, help="number of times each command is run")
+    parser.add_argument('--max-seconds', type=float, default=None,
+                        help="exit with an error if the best time of a command is above this")
+    args = parser.parse_args(argv)
+
+    results = run(args.repeats)
+    print("{:<24}{:>10}{:>10}  {}".format("command", "best s", "median s", "backends imported"))
+    for name, _ in COMMANDS:
+        result = results[name]
+        print("{:<24}{:>10.3f}{:>10.3f}  {}".format(
+            name, result['best_seconds'], result['median_seconds'], ", ".join(result['backends']) or "-"))
+    slow = [name for name, _ in COMMANDS if args.max_seconds is not None and
+            results[name]['best_seconds'] > args.max_seconds]
+    if slow:
+        print("{} took more than {:.3f} s".format(", ".join(slow), args.max_seconds))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
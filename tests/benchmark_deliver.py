@@ -0,0 +1,343 @@
+""" Benchmarks for locating, hashing and staging the files of a delivery
+
+    A synthetic project tree is built from the files_to_deliver patterns in
+    data/taca_test_cfg.yaml, with a configurable number of samples, files per
+    wildcard and file size distribution. gather_files, Deliverer.stage_delivery
+    and Deliverer.expand_path are then timed, each in a separate process, and
+    the wall time, read and write system calls, file system calls and peak
+    memory are reported. The file system calls (stat, listdir, open, symlink
+    and the like) are counted in a separate run, so that counting them does not
+    add to the wall time.
+
+    The results can be saved as a baseline in JSON, and later runs are compared
+    to the baseline as percentage deltas, e.g.
+
+        python benchmark_deliver.py --samples 20 --save-baseline
+        python benchmark_deliver.py --samples 20 --max-regression 10
+
+    The benchmarks are not part of the test suite, since their timing depends on
+    the machine they run on.
+"""
+import __builtin__
+import argparse
+import datetime
+import json
+import mock
+import multiprocessing
+import os
+import random
+import re
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import yaml
+
+from ngi_pipeline.database import classes as db
+from taca_ngi_pipeline.deliver import deliver
+from taca_ngi_pipeline.utils import filesystem
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+CONFIG_FILE = os.path.join(BENCHMARK_DIR, "data", "taca_test_cfg.yaml")
+BASELINE_FILE = os.path.join(BENCHMARK_DIR, "benchmark_baseline.json")
+PROJECTID = "NGIU-P001"
+# the measured values, for all of them lower is better
+METRICS = ['wall_seconds', 'io_syscalls', 'fs_calls', 'peak_memory_kb']
+# the file system calls counted, in the os module
+FS_CALLS = ['stat', 'lstat', 'listdir', 'readlink', 'symlink', 'mkdir', 'makedirs', 'unlink', 'rename', 'access']
+
+
+def size_distribution(spec, seed):
+    """
+        :param string spec: 'fixed:SIZE', 'uniform:MIN:MAX' or 'lognormal:MU:SIGMA',
+            with sizes in bytes
+        :param int seed: the seed of the random sizes
+        :returns: a function returning a file size for each call
+    """
+    rng = random.Random(seed)
+    kind, _, args = spec.partition(':')
+    try:
+        args = [float(a) for a in args.split(':')]
+        if kind == 'fixed' and len(args) == 1:
+            return lambda: int(args[0])
+        if kind == 'uniform' and len(args) == 2:
+            return lambda: rng.randint(int(args[0]), int(args[1]))
+        if kind == 'lognormal' and len(args) == 2:
+            return lambda: int(rng.lognormvariate(args[0], args[1]))
+    except ValueError:
+        pass
+    raise argparse.ArgumentTypeError("unknown size distribution '{}'".format(spec))
+
+
+def _concrete_paths(pattern, nfiles):
+    """ Turn a file glob into paths of files that it matches. A wildcard in the file
+        name gives nfiles files, a wildcard in a folder name gives one folder and a
+        character class gives one file for each character.
+    """
+    folder, name = os.path.split(pattern)
+    folder = re.sub(r'\[(.)[^\]]*\]', r'\1', folder.replace('*', 'FC01').replace('?', '1'))
+    names = [name]
+    m = re.search(r'\[([^\]]+)\]', name)
+    if m is not None:
+        names = [name.replace(m.group(0), c) for c in m.group(1)]
+    if '*' in name or '?' in name:
+        names = [n.replace('*', 'L{:03d}'.format(i)).replace('?', '1') for n in names for i in xrange(nfiles)]
+    return [os.path.join(folder, n) for n in names]
+
+
+def deliverer_config(rootdir):
+    """ :returns: the deliver section of the test config, with the paths below rootdir """
+    with open(CONFIG_FILE) as fh:
+        config = yaml.safe_load(fh)['deliver']
+    for key in ['analysispath', 'datapath', 'stagingpath', 'deliverypath']:
+        config[key] = os.path.join(rootdir, config[key].replace('data/', '', 1))
+    return config
+
+
+def build_tree(rootdir, samples, files_per_sample, sizes):
+    """ Create the files matched by the config patterns for each sample
+
+        :returns: a tuple with the sample ids and the number of files and bytes created
+    """
+    config = deliverer_config(rootdir)
+    sampleids = ["{}_{:03d}".format(PROJECTID.replace('-P', '-S'), i) for i in xrange(samples)]
+    created = set()
+    nbytes = 0
+    for sampleid in sampleids:
+        d = new_deliverer(config, sampleid)
+        for pattern in config['files_to_deliver']:
+            for fpath in _concrete_paths(d.expand_path(pattern[0]), files_per_sample):
+                if fpath in created:
+                    continue
+                if not os.path.exists(os.path.dirname(fpath)):
+                    os.makedirs(os.path.dirname(fpath))
+                size = sizes()
+                # sparse files, the hashing cost is the same as for real data
+                with open(fpath, 'w') as fh:
+                    fh.truncate(size)
+                created.add(fpath)
+                nbytes += size
+    return sampleids, len(created), nbytes
+
+
+def new_deliverer(config, sampleid):
+    with mock.patch.object(deliver.db, 'dbcon', autospec=db.CharonSession):
+        return deliver.Deliverer(PROJECTID, sampleid, **config)
+
+
+def _proc_io():
+    """ :returns: the number of read and write system calls made by this process so far """
+    try:
+        with open("/proc/self/io") as fh:
+            fields = dict(line.split(':') for line in fh if ':' in line)
+        return int(fields['syscr']) + int(fields['syscw'])
+    except (IOError, KeyError, ValueError):
+        return None
+
+
+def _count_fs_calls(fn):
+    """ Call fn, counting the file system calls it makes
+        :returns: the number of calls
+    """
+    counter = {'calls': 0}
+
+    def _counted(call):
+        def _wrapper(*args, **kwargs):
+            counter['calls'] += 1
+            return call(*args, **kwargs)
+        return _wrapper
+
+    patchers = [mock.patch.object(os, name, _counted(getattr(os, name))) for name in FS_CALLS]
+    # the names imported from os before patching
+    patchers.append(mock.patch.object(filesystem, 'stat', _counted(os.stat)))
+    patchers.append(mock.patch.object(__builtin__, 'open', _counted(open)))
+    for patcher in patchers:
+        patcher.start()
+    try:
+        fn()
+    finally:
+        for patcher in patchers:
+            patcher.stop()
+    return counter['calls']
+
+
+def _run_counted(setup, fn, conn):
+    setup()
+    conn.send(_count_fs_calls(fn))
+    conn.close()
+
+
+def _run_measured(setup, fn, conn):
+    setup()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    io_before = _proc_io()
+    started = time.time()
+    fn()
+    wall = time.time() - started
+    io_after = _proc_io()
+    conn.send({
+        'wall_seconds': wall,
+        'io_syscalls': io_after - io_before if io_before is not None else None,
+        # the peak resident memory is inherited at fork, so only the growth is counted
+        'peak_memory_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before})
+    conn.close()
+
+
+def measure(setup, fn, repeat):
+    """ Run a benchmark in fresh processes
+
+        :param setup: function preparing the benchmark, not measured
+        :param fn: the function to measure
+        :param int repeat: the number of runs
+        :returns: a dict with the fastest wall time and the smallest syscall
+            count and peak memory of the runs
+    """
+    runs = [_in_process(_run_measured, setup, fn) for _ in xrange(repeat)]
+    result = dict((key, min(run[key] for run in runs) if runs[0][key] is not None else None)
+                  for key in METRICS if key != 'fs_calls')
+    result['fs_calls'] = _in_process(_run_counted, setup, fn)
+    return result
+
+
+def _in_process(target, setup, fn):
+    """ Run a benchmark function in a forked process
+        :returns: what the process sent back
+    """
+    parent_conn, child_conn = multiprocessing.Pipe(duplex=False)
+    process = multiprocessing.Process(target=target, args=(setup, fn, child_conn))
+    process.start()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError("benchmark process exited with {}".format(process.exitcode))
+    return result
+
+
+def benchmarks(rootdir, sampleids):
+    """ :returns: a list of (name, setup, function) tuples for the benchmarks """
+    config = deliverer_config(rootdir)
+
+    def _deliverers(**kwargs):
+        cfg = dict(config)
+        cfg.update(kwargs)
+        return [new_deliverer(cfg, sampleid) for sampleid in sampleids]
+
+    def _remove_digests():
+        for parentdir, _, files in os.walk(rootdir):
+            for fname in files:
+                if fname.endswith(".sha1"):
+                    os.unlink(os.path.join(parentdir, fname))
+
+    def _remove_staging():
+        shutil.rmtree(config['stagingpath'].replace('<PROJECTID>', PROJECTID), ignore_errors=True)
+
+    def _expand_paths():
+        for d in _deliverers():
+            for _ in xrange(100):
+                for pattern in d.files_to_deliver:
+                    d.expand_path(pattern[0])
+                    d.expand_path(pattern[1])
+
+    def _gather(**kwargs):
+        for d in _deliverers(**kwargs):
+            list(d.gather_files())
+
+    def _stage():
+        for d in _deliverers():
+            d.stage_delivery()
+
+    return [
+        ('expand_path', lambda: None, _expand_paths),
+        ('gather_files', lambda: None, lambda: _gather(no_checksum=True)),
+        ('gather_files_hashing', _remove_digests, _gather),
+        ('stage_delivery', _remove_staging, _stage)]
+
+
+def compare(results, baseline):
+    """ Print the results, with the percentage change from the baseline
+
+        :returns: the largest wall time regression in percent, or None without a baseline
+    """
+    worst = None
+    print("{:<24}{:<16}{:>14}{:>14}{:>10}".format("benchmark", "metric", "baseline", "current", "delta"))
+    for name in sorted(results):
+        for metric in METRICS:
+            current = results[name][metric]
+            previous = (baseline or {}).get(name, {}).get(metric)
+            delta = ""
+            if current is not None and previous:
+                change = 100.0 * (current - previous) / previous
+                delta = "{:+.1f}%".format(change)
+                if metric == 'wall_seconds':
+                    worst = change if worst is None else max(worst, change)
+            print("{:<24}{:<16}{:>14}{:>14}{:>10}".format(
+                name, metric, _fmt(previous), _fmt(current), delta))
+    return worst
+
+
+def _fmt(value):
+    if value is None:
+        return "-"
+    return "{:.4f}".format(value) if isinstance(value, float) else str(value)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--samples', type=int, default=10, help="number of samples in the project")
+    parser.add_argument('--files-per-sample', type=int, default=8,
+                        help="number of files matching each wildcard pattern for a sample")
+    parser.add_argument('--size-dist', default='lognormal:12:2',
+                        help="file size distribution in bytes: fixed:SIZE, uniform:MIN:MAX or lognormal:MU:SIGMA")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the random file sizes")
+    parser.add_argument('--repeat', type=int, default=3, help="number of runs of each benchmark")
+    parser.add_argument('--rootdir', default=None,
+                        help="folder to build the project tree in, a temporary folder by default")
+    parser.add_argument('--baseline', default=BASELINE_FILE, help="the baseline JSON file")
+    parser.add_argument('--save-baseline', action='store_true', help="save the results as the new baseline")
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help="exit with an error if a wall time is this many percent above the baseline")
+    args = parser.parse_args(argv)
+    sizes = size_distribution(args.size_dist, args.seed)
+    params = dict((key, getattr(args, key)) for key in ['samples', 'files_per_sample', 'size_dist', 'seed'])
+
+    rootdir = args.rootdir or tempfile.mkdtemp(prefix="taca_benchmark_")
+    try:
+        sampleids, nfiles, nbytes = build_tree(rootdir, args.samples, args.files_per_sample, sizes)
+        print("built {} samples with {} files and {} bytes in {}".format(len(sampleids), nfiles, nbytes, rootdir))
+        results = {}
+        for name, setup, fn in benchmarks(rootdir, sampleids):
+            results[name] = measure(setup, fn, args.repeat)
+    finally:
+        if args.rootdir is None:
+            shutil.rmtree(rootdir, ignore_errors=True)
+
+    baseline = None
+    try:
+        with open(args.baseline) as fh:
+            baseline = json.load(fh)
+        if baseline.get('params') != params:
+            print("the baseline was recorded with {}, deltas are not comparable".format(baseline.get('params')))
+    except IOError:
+        print("no baseline in {}".format(args.baseline))
+    worst = compare(results, (baseline or {}).get('results'))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as fh:
+            json.dump({
+                'recorded': datetime.datetime.now().isoformat(),
+                'python': sys.version.split()[0],
+                'params': params,
+                'results': results}, fh, indent=2, sort_keys=True)
+        print("baseline saved to {}".format(args.baseline))
+    if args.max_regression is not None and worst is not None and worst > args.max_regression:
+        print("wall time regression of {:.1f}% is above {:.1f}%".format(worst, args.max_regression))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,151 @@
+""" Benchmark of a Grus delivery against local stand-ins for mover, SUPR, the
+    order portal, StatusDB and Charon
+
+    A synthetic project tree is built as in benchmark_deliver.py and staged
+    against a CharonStandIn. GrusProjectDeliverer.deliver_project then hard stages
+    the project and hands it to the fake to_outbox, looking up the PI in the
+    SuprStandIn, and GrusProjectDeliverer.check_mover_delivery_status monitors the
+    delivery through the fake moverinfo until it reports Delivered. The
+    interactive prompts are answered with yes. The wall time of both steps and
+    the calls made to the stand-ins are reported, e.g.
+
+        python benchmark_grus.py --samples 20 --latency 0.05
+        python benchmark_grus.py --statuses Accepted,InProgress,Delivered --moverinfo-delay 0.5
+"""
+import argparse
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from taca.utils.config import CONFIG
+from taca_ngi_pipeline.deliver import deliver
+from taca_ngi_pipeline.deliver import deliver_grus
+
+import benchmark_deliver
+from charon_server import CharonStandIn
+from mover_stubs import MoverToolchain
+from supr_server import SuprStandIn
+
+API_TOKEN = "charon-stand-in-token"
+
+
+def _timed(fn):
+    """ :returns: a tuple with the wall time of fn, what it returned and the error it raised, if any """
+    started = time.time()
+    result = error = None
+    try:
+        result = fn()
+    except (Exception, SystemExit) as e:
+        error = "{}: {}".format(e.__class__.__name__, e)
+    return time.time() - started, result, error
+
+
+def run(rootdir, samples, files_per_sample, sizes, statuses, latency=0.0, moverinfo_delay=0.0,
+        to_outbox_delay=0.0, poll_interval=0.1):
+    """ Stage a synthetic project and deliver it to Grus against the stand-ins
+        :returns: a dict with the wall times, the calls to the stand-ins and the outcome
+    """
+    sampleids, nfiles, nbytes = benchmark_deliver.build_tree(rootdir, samples, files_per_sample, sizes)
+    config = benchmark_deliver.deliverer_config(rootdir)
+    for key in ['report_aggregate', 'report_sample', 'copy_reports_to_reports_outbox']:
+        config.pop(key, None)
+    config['stagingpathhard'] = os.path.join(rootdir, "DELIVERY_HARD", "<PROJECTID>")
+    config['mover_poll_interval'] = poll_interval
+    mover = MoverToolchain(os.path.join(rootdir, "bin"), statuses=statuses, moverinfo_delay=moverinfo_delay,
+                           to_outbox_delay=to_outbox_delay)
+    prompts = mock.Mock(return_value=True)
+    patchers = [mock.patch.object(deliver_grus, 'proceed_or_not', prompts)]
+    if os.geteuid() != 0:
+        # the hard staged files are given to the group of the delivery project, which needs root here
+        patchers.append(mock.patch.object(deliver_grus.os, 'chown'))
+    with CharonStandIn(latency=latency, api_token=API_TOKEN) as charon, \
+            SuprStandIn(latency=latency) as supr, mover:
+        charon.add_project(benchmark_deliver.PROJECTID, uppnex_id="a2099999", delivery_projects=[])
+        for sampleid in sampleids:
+            charon.add_sample(benchmark_deliver.PROJECTID, sampleid, analysis_status="ANALYZED",
+                              delivery_projects=[])
+        supr.add_project(benchmark_deliver.PROJECTID, pi_email="pi@example.com")
+        os.environ['CHARON_BASE_URL'] = charon.base_url
+        os.environ['CHARON_API_TOKEN'] = API_TOKEN
+        CONFIG.update(supr.config())
+        CONFIG['deliver'] = dict(config, stage_only=True)
+        staging = _timed(lambda: deliver.ProjectDeliverer(
+            benchmark_deliver.PROJECTID, **CONFIG['deliver']).deliver_project())
+        staging_calls = charon.total_calls()
+        # the sample deliverers are set up from the deliver section of the config
+        CONFIG['deliver'] = dict(config)
+        for patcher in patchers:
+            patcher.start()
+        try:
+            delivery = _timed(lambda: deliver_grus.GrusProjectDeliverer(
+                benchmark_deliver.PROJECTID, **config).deliver_project())
+            delivery_calls = charon.total_calls() - staging_calls
+            monitoring = _timed(lambda: deliver_grus.GrusProjectDeliverer(
+                benchmark_deliver.PROJECTID, **config).check_mover_delivery_status())
+            monitoring_calls = charon.total_calls() - staging_calls - delivery_calls
+        finally:
+            for patcher in patchers:
+                patcher.stop()
+        delivered = len([s for s in charon.samples.values() if s['delivery_status'] == 'DELIVERED'])
+        return {
+            'files': nfiles,
+            'bytes': nbytes,
+            'samples': len(sampleids),
+            'delivered_samples': delivered,
+            'project_status': charon.projects[benchmark_deliver.PROJECTID]['delivery_status'],
+            'prompts': prompts.call_count,
+            'steps': [
+                ('stage', staging[0], staging[2], staging_calls),
+                ('deliver_project', delivery[0], delivery[2], delivery_calls),
+                ('check_mover_delivery_status', monitoring[0], monitoring[2], monitoring_calls)],
+            'supr_calls': dict(supr.calls),
+            'mover_calls': len(mover.calls()),
+            'moverinfo_polls': sum(mover.polls().values())}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--samples', type=int, default=10, help="number of samples in the project")
+    parser.add_argument('--files-per-sample', type=int, default=4,
+                        help="number of files matching each wildcard pattern for a sample")
+    parser.add_argument('--size-dist', default='fixed:65536',
+                        help="file size distribution in bytes: fixed:SIZE, uniform:MIN:MAX or lognormal:MU:SIGMA")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the random file sizes")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to each request to Charon, SUPR, the order portal and StatusDB")
+    parser.add_argument('--statuses', default='Accepted,InProgress,Delivered',
+                        help="comma separated statuses reported by moverinfo for the delivery, in turn")
+    parser.add_argument('--moverinfo-delay', type=float, default=0.0, help="seconds each moverinfo call takes")
+    parser.add_argument('--to-outbox-delay', type=float, default=0.0, help="seconds each to_outbox call takes")
+    parser.add_argument('--poll-interval', type=float, default=0.1,
+                        help="seconds between moverinfo calls when monitoring the delivery")
+    args = parser.parse_args(argv)
+
+    rootdir = tempfile.mkdtemp(prefix="taca_benchmark_grus_")
+    try:
+        result = run(rootdir, args.samples, args.files_per_sample,
+                     benchmark_deliver.size_distribution(args.size_dist, args.seed), args.statuses.split(','),
+                     latency=args.latency, moverinfo_delay=args.moverinfo_delay,
+                     to_outbox_delay=args.to_outbox_delay, poll_interval=args.poll_interval)
+    finally:
+        shutil.rmtree(rootdir, ignore_errors=True)
+
+    print("{samples} samples with {files} files and {bytes} bytes, {prompts} prompts answered".format(**result))
+    print("{:<32}{:>12}{:>14}".format("step", "seconds", "charon calls"))
+    for step, seconds, error, calls in result['steps']:
+        print("{:<32}{:>12.3f}{:>14}".format(step, seconds, calls))
+        if error:
+            print("  failed with {}".format(error))
+    print("{} SUPR, order portal and StatusDB calls: {}".format(
+        sum(result['supr_calls'].values()),
+        ", ".join("{} {}".format(kind, count) for kind, count in sorted(result['supr_calls'].items()))))
+    print("{mover_calls} mover calls, {moverinfo_polls} moverinfo polls".format(**result))
+    print("{delivered_samples} of {samples} samples delivered, project status {project_status}".format(**result))
+    return 0 if all(error is None for _, _, error, _ in result['steps']) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
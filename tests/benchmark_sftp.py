@@ -0,0 +1,161 @@
+""" Benchmarks of the SFTP uploads to Castor and Mosler, against an in-process
+    SFTP server
+
+    Three synthetic sample folders are staged: many small files, to measure the
+    per-file overhead, one large file, to measure the throughput, and a tree of
+    folders with one small file each, to measure the cost of creating folders.
+    Each is uploaded with MySFTPClient.put_dir over one and over several
+    channels (the Castor path) and streamed as a tar archive, plain and
+    compressed, with MoslerSampleDeliverer.do_delivery (the Mosler path). The
+    wall time, the throughput and the SFTP requests made are reported, e.g.
+
+        python benchmark_sftp.py --latency 0.01
+        python benchmark_sftp.py --small-files 1000 --large-file-mb 512 --channels 8
+
+    The latency is added to each metadata request, see sftp_server.py.
+"""
+import argparse
+import logging
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from ngi_pipeline.database import classes as db
+from taca_ngi_pipeline.deliver import deliver
+from taca_ngi_pipeline.deliver import deliver_castor
+from taca_ngi_pipeline.deliver import deliver_mosler
+
+from sftp_server import SFTPStandIn
+
+PROJECTID = "NGIU-P001"
+
+
+def build_samples(stagingpath, small_files, small_size, large_size, dirs):
+    """ Create the sample folders in stagingpath
+        :returns: a list of (sampleid, description, files, bytes) tuples
+    """
+    samples = []
+
+    def _write(path, size):
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        # random data, so that the compression of the archives is not flattered
+        with open(path, 'wb') as fh:
+            while size > 0:
+                fh.write(os.urandom(min(size, 1024 * 1024)))
+                size -= 1024 * 1024
+
+    sampledir = os.path.join(stagingpath, "small_files")
+    for i in xrange(small_files):
+        _write(os.path.join(sampledir, "file_{:05d}".format(i)), small_size)
+    samples.append(("small_files", "per-file overhead", small_files, small_files * small_size))
+    _write(os.path.join(stagingpath, "large_file", "reads.fastq.gz"), large_size)
+    samples.append(("large_file", "large-file throughput", 1, large_size))
+    sampledir = os.path.join(stagingpath, "folders")
+    for i in xrange(dirs):
+        # two levels of folders, so that the parents are created on the way
+        _write(os.path.join(sampledir, "level1_{:03d}".format(i / 10), "level2_{:03d}".format(i), "file"),
+               small_size)
+    samples.append(("folders", "folder creation", dirs, dirs * small_size))
+    return samples
+
+
+def _sample_deliverer(deliverer_class, stagingpath, sampleid, sftp_client, **kwargs):
+    with mock.patch.object(deliver.db, 'dbcon', autospec=db.CharonSession):
+        return deliverer_class(
+            PROJECTID, sampleid, sftp_client, stagingpath=stagingpath, deliverypath=stagingpath,
+            analysispath=stagingpath, hash_algorithm='md5', **kwargs)
+
+
+def _castor(channels):
+    def _deliver(server, stagingpath, sampleid):
+        transport = server.connect()
+        client = deliver_castor.MySFTPClient.from_transport(transport)
+        try:
+            client.chdir("/")
+            client.mkdir(sampleid)
+            return client.put_dir(os.path.join(stagingpath, sampleid), sampleid, channels=channels)['bytes']
+        finally:
+            client.close()
+            transport.close()
+    return _deliver
+
+
+def _mosler(compress):
+    def _deliver(server, stagingpath, sampleid):
+        transport = server.connect()
+        client = transport.open_sftp_client()
+        client.chdir("/")
+        deliverer = _sample_deliverer(deliver_mosler.MoslerSampleDeliverer, stagingpath, sampleid, client,
+                                      moslercompress=compress)
+        try:
+            # do_delivery closes the client when done
+            deliverer.do_delivery()
+            return os.path.getsize(os.path.join(server.rootdir, deliverer.remote_archive_name()))
+        finally:
+            transport.close()
+    return _deliver
+
+
+def run(rootdir, samples, channels, latency):
+    """ Upload each sample with each method to a fresh server folder
+        :returns: a list of (sample, method, seconds, bytes sent, requests) tuples
+    """
+    stagingpath = os.path.join(rootdir, "STAGING")
+    methods = [
+        ("castor put_dir", _castor(1)),
+        ("castor put_dir x{}".format(channels), _castor(channels)),
+        ("mosler tar", _mosler(False)),
+        ("mosler tar.gz", _mosler(True))]
+    results = []
+    for sampleid, _, _, _ in samples:
+        for method, fn in methods:
+            remotedir = tempfile.mkdtemp(prefix="remote_", dir=rootdir)
+            with SFTPStandIn(remotedir, latency=latency) as server:
+                started = time.time()
+                nbytes = fn(server, stagingpath, sampleid)
+                results.append((sampleid, method, time.time() - started, nbytes, server.total_requests()))
+            shutil.rmtree(remotedir)
+            # the digest of the mosler archive is written next to the staged sample
+            for digest in ["{}.tar.md5".format(sampleid), "{}.tar.gz.md5".format(sampleid)]:
+                if os.path.exists(os.path.join(stagingpath, digest)):
+                    os.unlink(os.path.join(stagingpath, digest))
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument('--small-files', type=int, default=200, help="number of files in the small files sample")
+    parser.add_argument('--small-size', type=int, default=4096, help="size in bytes of the small files")
+    parser.add_argument('--large-file-mb', type=int, default=64, help="size in MB of the large file")
+    parser.add_argument('--dirs', type=int, default=100, help="number of folders in the folder sample")
+    parser.add_argument('--channels', type=int, default=4, help="number of sftp channels of the parallel upload")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="seconds added to each metadata request to the sftp server")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    rootdir = tempfile.mkdtemp(prefix="taca_benchmark_sftp_")
+    try:
+        samples = build_samples(os.path.join(rootdir, "STAGING"), args.small_files, args.small_size,
+                                args.large_file_mb * 1024 * 1024, args.dirs)
+        results = run(rootdir, samples, args.channels, args.latency)
+    finally:
+        shutil.rmtree(rootdir, ignore_errors=True)
+
+    items = dict((sampleid, nitems) for sampleid, _, nitems, _ in samples)
+    print("{:<14}{:<22}{:>10}{:>10}{:>14}{:>10}".format(
+        "sample", "method", "seconds", "MB/s", "ms per item", "requests"))
+    for sampleid, method, seconds, nbytes, nrequests in results:
+        print("{:<14}{:<22}{:>10.3f}{:>10.2f}{:>14.2f}{:>10}".format(
+            sampleid, method, seconds, nbytes / 1e6 / seconds if seconds > 0 else 0.0,
+            1000.0 * seconds / items[sampleid], nrequests))
+    print("items are the files of small_files and large_file and the folders of folders")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,192 @@
+""" A local stand-in for the Charon tracking database, for tests and benchmarks
+
+    The stand-in implements the project and sample endpoints that the deliverers
+    use through ngi_pipeline's CharonSession, keeps the entries in memory and
+    counts the requests it serves. Latency and errors can be injected to see how
+    the deliverers behave with real round-trip costs, e.g.
+
+        with CharonStandIn(latency=0.05) as charon:
+            charon.add_project("P1")
+            charon.add_sample("P1", "P1_101", analysis_status="ANALYZED")
+            os.environ['CHARON_BASE_URL'] = charon.base_url
+            ...
+            print(charon.calls)
+"""
+import BaseHTTPServer
+import collections
+import copy
+import json
+import random
+import re
+import SocketServer
+import threading
+import time
+
+# the endpoints, the kind of request is used to count the calls
+_ROUTES = [
+    (re.compile(r'^/api/v1/projects/?$'), 'projects'),
+    (re.compile(r'^/api/v1/project/([^/]+)/?$'), 'project'),
+    (re.compile(r'^/api/v1/samples/([^/]+)/?$'), 'samples'),
+    (re.compile(r'^/api/v1/sample/([^/]+)/([^/]+)/?$'), 'sample')]
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # keep connections alive, like a requests session expects
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def _handle(self, method):
+        body = None
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+        status, content = self.server.charon.handle(
+            method, self.path.split('?')[0], body, self.headers.getheader('X-Charon-API-token'))
+        data = json.dumps(content) if content is not None else ""
+        self.send_response(status)
+        if data:
+            self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class CharonStandIn(object):
+    """ An HTTP server implementing the Charon project and sample GET and PUT
+        endpoints, running in a background thread
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=500, api_token=None, seed=None):
+        """
+            :param float latency: seconds added to every request
+            :param float jitter: up to this many seconds are added at random to every request
+            :param float error_rate: the fraction of requests answered with error_status
+            :param int error_status: the HTTP status of injected errors
+            :param string api_token: if given, requests without this token are refused
+            :param seed: seed of the injected jitter and errors
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.api_token = api_token
+        self.projects = collections.OrderedDict()
+        self.samples = collections.OrderedDict()
+        self.calls = collections.Counter()
+        self.errors = 0
+        self._fail_next = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "http://{}:{}".format(*self._server.server_address)
+
+    def start(self):
+        """ Start serving on a free local port
+            :returns: the base url of the server
+        """
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.charon = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name="charon-stand-in")
+        self._thread.daemon = True
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_project(self, projectid, **fields):
+        entry = {'projectid': projectid, 'name': projectid, 'status': 'OPEN', 'delivery_status': 'NOT_DELIVERED'}
+        entry.update(fields)
+        with self._lock:
+            self.projects[projectid] = entry
+        return entry
+
+    def add_sample(self, projectid, sampleid, **fields):
+        entry = {'projectid': projectid, 'sampleid': sampleid, 'status': 'STALE',
+                 'analysis_status': 'TO_ANALYZE', 'delivery_status': 'NOT_DELIVERED'}
+        entry.update(fields)
+        with self._lock:
+            self.samples[(projectid, sampleid)] = entry
+        return entry
+
+    def fail_next(self, count=1):
+        """ Answer the next requests with errors
+            :param int count: the number of requests to fail
+        """
+        with self._lock:
+            self._fail_next += count
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def handle(self, method, path, body, token):
+        """ Serve a request
+            :returns: a tuple with the HTTP status and the content to send as JSON
+        """
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+        for pattern, kind in _ROUTES:
+            m = pattern.match(path)
+            if m is not None:
+                break
+        else:
+            return 404, {'message': "no such endpoint {}".format(path)}
+        with self._lock:
+            self.calls[(method, kind)] += 1
+            if self.api_token is not None and token != self.api_token:
+                return 401, {'message': "invalid API token"}
+            if self._fail_next > 0 or (self.error_rate and self._random.random() < self.error_rate):
+                self._fail_next = max(self._fail_next - 1, 0)
+                self.errors += 1
+                return self.error_status, {'message': "injected error"}
+            return self._route(method, kind, m.groups(), body)
+
+    def _route(self, method, kind, ids, body):
+        if kind == 'projects' and method == 'GET':
+            return 200, {'projects': copy.deepcopy(self.projects.values())}
+        if kind == 'samples' and method == 'GET':
+            if ids[0] not in self.projects:
+                return 404, {'message': "no such project"}
+            return 200, {'samples': copy.deepcopy(
+                [entry for key, entry in self.samples.items() if key[0] == ids[0]])}
+        entries, key = (self.projects, ids[0]) if kind == 'project' else (self.samples, ids)
+        if key not in entries:
+            return 404, {'message': "no such {}".format(kind)}
+        if method == 'GET':
+            return 200, copy.deepcopy(entries[key])
+        if method == 'PUT':
+            try:
+                entries[key].update(json.loads(body or "{}"))
+            except ValueError:
+                return 400, {'message': "invalid JSON"}
+            return 204, None
+        return 405, {'message': "method not allowed"}
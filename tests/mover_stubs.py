@@ -0,0 +1,167 @@
+""" Local stand-ins for the mover executables, for tests and benchmarks of Grus deliveries
+
+    MoverToolchain writes fake moverinfo and to_outbox executables to a folder,
+    which is put first on the PATH. Their behaviour is scripted through a JSON
+    state file in the same folder, e.g.
+
+        with MoverToolchain(bindir, statuses=['Accepted', 'InProgress', 'Delivered']) as mover:
+            ... # deliver, moverinfo -i <token> reports the statuses in turn
+            print(mover.calls())
+
+    to_outbox moves the hard staged folder to an outbox folder, as mover does once
+    it has taken over a delivery, and prints a new delivery token. moverinfo -i
+    reports the next status of the scripted sequence for the token, and keeps
+    reporting the last one when the sequence is exhausted.
+"""
+import fcntl
+import json
+import os
+import sys
+
+_STATE_FILE = "mover_state.json"
+
+# the common source of the executables, which dispatch on their name
+_SCRIPT = r'''#!{python}
+import fcntl, json, os, shutil, sys, time
+
+statefile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "{statefile}")
+command = os.path.basename(sys.argv[0])
+with open(statefile + ".lock", "a") as lockfh:
+    fcntl.flock(lockfh, fcntl.LOCK_EX)
+    with open(statefile) as fh:
+        state = json.load(fh)
+    state["calls"].append([command] + sys.argv[1:])
+    returncode = 0
+    if command == "moverinfo" and sys.argv[1:] == ["--version"]:
+        delay = 0
+        output = "moverinfo version {{}}".format(state["version"])
+    elif command == "moverinfo" and len(sys.argv) == 3 and sys.argv[1] == "-i":
+        token = sys.argv[2]
+        statuses = state["scripts"].get(token, state["statuses"])
+        polls = state["polls"].get(token, 0)
+        state["polls"][token] = polls + 1
+        delay = state["moverinfo_delay"]
+        output = "{{}}: {{}}".format(statuses[min(polls, len(statuses) - 1)], token)
+    elif command == "to_outbox" and len(sys.argv) == 3:
+        path, receiver = sys.argv[1:]
+        delay = state["to_outbox_delay"]
+        if state["to_outbox_returncode"] or not os.path.isdir(path):
+            returncode = state["to_outbox_returncode"] or 1
+            output = "Error: {{}} could not be delivered to {{}}".format(path, receiver)
+        else:
+            state["deliveries"] += 1
+            token = "{{}}-{{}}-{{}}".format(os.path.basename(path), receiver, state["deliveries"])
+            shutil.move(path, os.path.join(state["outbox"], token))
+            output = token
+    else:
+        delay = 0
+        returncode = 2
+        output = "usage: {{}} ...".format(command)
+    with open(statefile + ".tmp", "w") as fh:
+        json.dump(state, fh)
+    os.rename(statefile + ".tmp", statefile)
+time.sleep(delay)
+sys.stdout.write(output + "\n")
+sys.exit(returncode)
+'''
+
+
+class MoverToolchain(object):
+    """ Fake moverinfo and to_outbox executables with scripted behaviour
+    """
+
+    def __init__(self, bindir, statuses=None, version="1.0.0", moverinfo_delay=0.0, to_outbox_delay=0.0,
+                 to_outbox_returncode=0, outbox=None):
+        """
+            :param string bindir: the folder to write the executables to
+            :param list statuses: the statuses reported by moverinfo -i for each
+                token, in turn. Defaults to ['Delivered']
+            :param string version: the version reported by moverinfo --version
+            :param float moverinfo_delay: seconds each moverinfo -i call takes
+            :param float to_outbox_delay: seconds each to_outbox call takes
+            :param int to_outbox_returncode: if not 0, to_outbox fails with this exit status
+            :param string outbox: the folder to_outbox moves the delivered folders
+                to, defaults to bindir/outbox
+        """
+        self.bindir = os.path.abspath(bindir)
+        self.statefile = os.path.join(self.bindir, _STATE_FILE)
+        self.outbox = outbox or os.path.join(self.bindir, "outbox")
+        self._path = None
+        for folder in [self.bindir, self.outbox]:
+            if not os.path.exists(folder):
+                os.makedirs(folder)
+        self._write_state({
+            'version': version,
+            'statuses': statuses or ['Delivered'],
+            'scripts': {},
+            'polls': {},
+            'moverinfo_delay': moverinfo_delay,
+            'to_outbox_delay': to_outbox_delay,
+            'to_outbox_returncode': to_outbox_returncode,
+            'outbox': self.outbox,
+            'deliveries': 0,
+            'calls': []})
+        source = _SCRIPT.format(python=sys.executable, statefile=_STATE_FILE)
+        for command in ['moverinfo', 'to_outbox']:
+            with open(os.path.join(self.bindir, command), 'w') as fh:
+                fh.write(source)
+            os.chmod(os.path.join(self.bindir, command), 0o755)
+
+    def install(self):
+        """ Put the executables first on the PATH """
+        if self._path is None:
+            self._path = os.environ.get('PATH', '')
+            os.environ['PATH'] = os.pathsep.join([self.bindir, self._path])
+
+    def uninstall(self):
+        """ Restore the PATH """
+        if self._path is not None:
+            os.environ['PATH'] = self._path
+            self._path = None
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.uninstall()
+
+    def script(self, token, statuses):
+        """ Script the statuses moverinfo -i reports for a token
+
+            :param string token: the delivery token
+            :param list statuses: the statuses to report, in turn
+        """
+        self._update(lambda state: state['scripts'].update({token: statuses}))
+
+    def set(self, **settings):
+        """ Change the behaviour set when the toolchain was created, e.g.
+            set(to_outbox_returncode=1)
+        """
+        self._update(lambda state: state.update(settings))
+
+    def calls(self, command=None):
+        """ :returns: the argument lists of the calls made so far, optionally only
+            those of a command
+        """
+        return [call for call in self._read_state()['calls'] if command is None or call[0] == command]
+
+    def polls(self):
+        """ :returns: a dict with the number of moverinfo -i calls for each token """
+        return self._read_state()['polls']
+
+    def _read_state(self):
+        with open(self.statefile) as fh:
+            return json.load(fh)
+
+    def _write_state(self, state):
+        with open("{}.tmp".format(self.statefile), 'w') as fh:
+            json.dump(state, fh)
+        os.rename("{}.tmp".format(self.statefile), self.statefile)
+
+    def _update(self, fn):
+        with open("{}.lock".format(self.statefile), 'a') as lockfh:
+            fcntl.flock(lockfh, fcntl.LOCK_EX)
+            state = self._read_state()
+            fn(state)
+            self._write_state(state)
@@ -0,0 +1,223 @@
+""" An in-process SFTP server backed by a local folder, for tests and benchmarks
+    of the Castor and Mosler deliveries
+
+    The server accepts any user and password, serves the given folder as its
+    root and counts the SFTP requests it gets by kind, e.g.
+
+        with SFTPStandIn(rootdir, latency=0.02) as server:
+            transport = server.connect()
+            client = MySFTPClient.from_transport(transport)
+            ...
+            print(server.requests)
+
+    The latency is added to each metadata request (open, close, stat, mkdir,
+    listings and the like) but not to the reads and writes of file data, which
+    paramiko pipelines, so that it models the round trip time of a remote server
+    without limiting the throughput of large files.
+"""
+import collections
+import os
+import socket
+import threading
+import time
+
+import paramiko
+from paramiko import SFTPAttributes, SFTPHandle, SFTPServer, SFTPServerInterface
+
+# generating a host key takes a while, so it is shared between the servers
+_host_key = []
+
+
+def _sftp_request(kind):
+    """ Decorator counting and delaying a request, and answering OSErrors with
+        the corresponding SFTP error
+    """
+    def _decorator(fn):
+        def _wrapper(self, *args):
+            self.standin._request(kind)
+            try:
+                return fn(self, *args)
+            except (IOError, OSError) as e:
+                return SFTPServer.convert_errno(e.errno)
+        return _wrapper
+    return _decorator
+
+
+class _Handle(SFTPHandle):
+
+    def __init__(self, standin, path, flags):
+        super(_Handle, self).__init__(flags)
+        self.standin = standin
+        self.filename = path
+
+    @_sftp_request('fstat')
+    def stat(self):
+        return SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+    @_sftp_request('fsetstat')
+    def chattr(self, attr):
+        SFTPServer.set_file_attr(self.filename, attr)
+        return paramiko.SFTP_OK
+
+    def close(self):
+        self.standin._request('close')
+        super(_Handle, self).close()
+
+
+class _Interface(SFTPServerInterface):
+    """ Maps the SFTP requests to the root folder of the stand-in """
+
+    def __init__(self, server, standin, *args, **kwargs):
+        super(_Interface, self).__init__(server, *args, **kwargs)
+        self.standin = standin
+
+    def _local(self, path):
+        return os.path.join(self.standin.rootdir, self.canonicalize(path).lstrip('/'))
+
+    @_sftp_request('listdir')
+    def list_folder(self, path):
+        path = self._local(path)
+        attrs = []
+        for name in os.listdir(path):
+            attr = SFTPAttributes.from_stat(os.stat(os.path.join(path, name)))
+            attr.filename = name
+            attrs.append(attr)
+        return attrs
+
+    @_sftp_request('stat')
+    def stat(self, path):
+        return SFTPAttributes.from_stat(os.stat(self._local(path)))
+
+    @_sftp_request('lstat')
+    def lstat(self, path):
+        return SFTPAttributes.from_stat(os.lstat(self._local(path)))
+
+    @_sftp_request('open')
+    def open(self, path, flags, attr):
+        path = self._local(path)
+        fd = os.open(path, flags, 0o644)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        handle = _Handle(self.standin, path, flags)
+        handle.readfile = handle.writefile = os.fdopen(fd, mode)
+        return handle
+
+    @_sftp_request('remove')
+    def remove(self, path):
+        os.remove(self._local(path))
+        return paramiko.SFTP_OK
+
+    @_sftp_request('rename')
+    def rename(self, oldpath, newpath):
+        os.rename(self._local(oldpath), self._local(newpath))
+        return paramiko.SFTP_OK
+
+    @_sftp_request('mkdir')
+    def mkdir(self, path, attr):
+        os.mkdir(self._local(path))
+        return paramiko.SFTP_OK
+
+    @_sftp_request('rmdir')
+    def rmdir(self, path):
+        os.rmdir(self._local(path))
+        return paramiko.SFTP_OK
+
+    @_sftp_request('setstat')
+    def chattr(self, path, attr):
+        SFTPServer.set_file_attr(self._local(path), attr)
+        return paramiko.SFTP_OK
+
+
+class _Server(paramiko.ServerInterface):
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class SFTPStandIn(object):
+    """ An SFTP server on a local port, serving a folder, running in background threads
+    """
+
+    def __init__(self, rootdir, latency=0.0):
+        """
+            :param string rootdir: the folder served as the root of the server
+            :param float latency: seconds added to every metadata request
+        """
+        self.rootdir = os.path.abspath(rootdir)
+        self.latency = latency
+        self.requests = collections.Counter()
+        self._lock = threading.Lock()
+        self._socket = None
+        self._transports = []
+
+    @property
+    def address(self):
+        return self._socket.getsockname()
+
+    def start(self):
+        """ Start serving on a free local port
+            :returns: the address of the server, as a (host, port) tuple
+        """
+        if not _host_key:
+            _host_key.append(paramiko.RSAKey.generate(1024))
+        self._socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind(('127.0.0.1', 0))
+        self._socket.listen(8)
+        thread = threading.Thread(target=self._serve, args=(self._socket,), name="sftp-stand-in")
+        thread.daemon = True
+        thread.start()
+        return self.address
+
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        for transport in self._transports:
+            transport.close()
+        self._transports = []
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def connect(self, username="user", password="password"):
+        """ :returns: an authenticated paramiko.Transport to the server """
+        transport = paramiko.Transport(self.address)
+        transport.connect(username=username, password=password)
+        return transport
+
+    def total_requests(self):
+        return sum(self.requests.values())
+
+    def _serve(self, sock):
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except (socket.error, AttributeError):
+                # the socket was closed by stop
+                return
+            transport = paramiko.Transport(conn)
+            transport.add_server_key(_host_key[0])
+            transport.set_subsystem_handler('sftp', SFTPServer, _Interface, self)
+            transport.start_server(server=_Server())
+            self._transports.append(transport)
+
+    def _request(self, kind):
+        with self._lock:
+            self.requests[kind] += 1
+        if self.latency:
+            time.sleep(self.latency)
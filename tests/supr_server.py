@@ -0,0 +1,211 @@
+""" A local stand-in for SUPR, the order portal and the StatusDB project view, for
+    tests and benchmarks of Grus deliveries
+
+    The stand-in serves the endpoints that GrusProjectDeliverer uses to look up the
+    PI of a project and to create the delivery project, e.g.
+
+        with SuprStandIn(latency=0.05) as supr:
+            supr.add_project("P1", pi_email="pi@example.com")
+            CONFIG.update(supr.config())
+            ...
+            print(supr.calls)
+
+    The delivery projects created are kept in supr.delivery_projects.
+"""
+import base64
+import BaseHTTPServer
+import collections
+import json
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+
+API_USER = "supr-user"
+API_PASSWORD = "supr-password"
+API_KEY = "orderportal-key"
+
+# the endpoints, the kind of request is used to count the calls
+_ROUTES = [
+    (re.compile(r'^/supr/person/search/?$'), 'supr_person_search'),
+    (re.compile(r'^/supr/ngi_delivery/project/create/?$'), 'supr_project_create'),
+    (re.compile(r'^/orderportal/v1/order/([^/]+)$'), 'orderportal_order'),
+    (re.compile(r'^/projects/?$'), 'statusdb_projects'),
+    (re.compile(r'^/projects/_design/order_portal/_view/ProjectID_to_PortalID$'), 'statusdb_portal_id')]
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_HEAD(self):
+        self._handle('HEAD')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        body = None
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            body = self.rfile.read(length)
+        url = urlparse.urlparse(self.path)
+        status, content = self.server.supr.handle(
+            method, url.path, urlparse.parse_qs(url.query), body, self.headers)
+        data = json.dumps(content) if content is not None else ""
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if method != 'HEAD':
+            self.wfile.write(data)
+
+
+class SuprStandIn(object):
+    """ An HTTP server implementing the SUPR person search and delivery project
+        creation, the order portal order lookup and the StatusDB view mapping
+        project ids to order portal ids, running in a background thread
+    """
+
+    def __init__(self, latency=0.0):
+        """
+            :param float latency: seconds added to every request
+        """
+        self.latency = latency
+        self.portal_ids = {}
+        self.pi_emails = {}
+        self.pi_ids = {}
+        self.delivery_projects = []
+        self.calls = collections.Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "http://{}:{}".format(*self._server.server_address)
+
+    def config(self):
+        """ :returns: the snic, statusdb and order_portal sections of the TACA
+            config pointing to the stand-in
+        """
+        host, port = self._server.server_address
+        return {
+            'snic': {
+                'snic_api_url': "{}/supr".format(self.base_url),
+                'snic_api_user': API_USER,
+                'snic_api_password': API_PASSWORD},
+            'statusdb': {'url': host, 'port': port, 'username': "user", 'password': "password"},
+            'order_portal': {
+                'orderportal_api_url': "{}/orderportal".format(self.base_url),
+                'orderportal_api_token': API_KEY}}
+
+    def start(self):
+        """ Start serving on a free local port
+            :returns: the base url of the server
+        """
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.supr = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name="supr-stand-in")
+        self._thread.daemon = True
+        self._thread.start()
+        return self.base_url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def add_project(self, projectid, pi_email, portal_id=None, pi_id=None):
+        """ Add a project with its PI
+
+            :param string projectid: the NGI project id
+            :param string pi_email: the e-mail of the PI in the order portal and SUPR
+            :param string portal_id: the order portal id of the project
+            :param int pi_id: the SUPR id of the PI
+        """
+        with self._lock:
+            portal_id = portal_id or "NGI{:05d}".format(len(self.portal_ids) + 1)
+            self.portal_ids[projectid] = portal_id
+            self.pi_emails[portal_id] = pi_email
+            self.pi_ids.setdefault(pi_email.lower(), pi_id or len(self.pi_ids) + 1)
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def handle(self, method, path, query, body, headers):
+        """ Serve a request
+            :returns: a tuple with the HTTP status and the content to send as JSON
+        """
+        if self.latency:
+            time.sleep(self.latency)
+        for pattern, kind in _ROUTES:
+            m = pattern.match(path)
+            if m is not None:
+                break
+        else:
+            return 404, {'error': "not_found", 'reason': "no such endpoint {}".format(path)}
+        with self._lock:
+            self.calls[kind] += 1
+            if kind.startswith('supr') and headers.getheader('Authorization') != "Basic {}".format(
+                    base64.b64encode("{}:{}".format(API_USER, API_PASSWORD))):
+                return 401, {'message': "invalid credentials"}
+            if kind.startswith('orderportal') and headers.getheader('X-OrderPortal-API-key') != API_KEY:
+                return 401, {'message': "invalid API key"}
+            return getattr(self, "_{}".format(kind))(method, query, body, *m.groups())
+
+    def _supr_person_search(self, method, query, body):
+        email = query.get('email_i', [''])[0].lower()
+        matches = [{'id': self.pi_ids[email], 'email': email}] if email in self.pi_ids else []
+        return 200, {'matches': matches}
+
+    def _supr_project_create(self, method, query, body):
+        if method != 'POST':
+            return 405, {'message': "method not allowed"}
+        try:
+            data = json.loads(body or "{}")
+        except ValueError:
+            return 400, {'message': "invalid JSON"}
+        if data.get('pi_id') not in self.pi_ids.values():
+            return 400, {'message': "no such PI {}".format(data.get('pi_id'))}
+        data.update({
+            'id': len(self.delivery_projects) + 1,
+            'name': "delivery{:05d}".format(len(self.delivery_projects) + 1)})
+        self.delivery_projects.append(data)
+        return 200, data
+
+    def _orderportal_order(self, method, query, body, portal_id):
+        if portal_id not in self.pi_emails:
+            return 404, {'message': "no such order"}
+        return 200, {'identifier': portal_id, 'fields': {'project_pi_email': self.pi_emails[portal_id]}}
+
+    def _statusdb_projects(self, method, query, body):
+        return 200, {'db_name': "projects", 'doc_count': len(self.portal_ids)}
+
+    def _statusdb_portal_id(self, method, query, body):
+        rows = []
+        if 'key' in query:
+            projectid = json.loads(query['key'][0])
+            if projectid in self.portal_ids:
+                rows.append({'id': projectid, 'key': projectid, 'value': self.portal_ids[projectid]})
+        return 200, {'total_rows': len(self.portal_ids), 'offset': 0, 'rows': rows}
@@ -0,0 +1,52 @@
+""" Unit tests for the local Charon stand-in used by the benchmarks """
+
+import json
+import requests
+import time
+import unittest
+
+from charon_server import CharonStandIn
+
+
+class TestCharonStandIn(unittest.TestCase):
+    def setUp(self):
+        self.charon = CharonStandIn(api_token="token")
+        self.baseurl = "{}/api/v1".format(self.charon.start())
+        self.charon.add_project("P1", uppnex_id="a2099999")
+        self.charon.add_sample("P1", "P1_101", analysis_status="ANALYZED")
+        self.session = requests.Session()
+        self.session.headers['X-Charon-API-token'] = "token"
+
+    def tearDown(self):
+        self.session.close()
+        self.charon.stop()
+
+    def test_get_and_put(self):
+        response = self.session.get("{}/project/P1".format(self.baseurl))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("a2099999", response.json()['uppnex_id'])
+        response = self.session.put(
+            "{}/sample/P1/P1_101".format(self.baseurl), data=json.dumps({'delivery_status': 'STAGED'}))
+        self.assertEqual(204, response.status_code)
+        samples = self.session.get("{}/samples/P1".format(self.baseurl)).json()['samples']
+        self.assertEqual(["STAGED"], [s['delivery_status'] for s in samples])
+        self.assertEqual(404, self.session.get("{}/sample/P1/P1_102".format(self.baseurl)).status_code)
+        self.assertEqual(
+            {('GET', 'project'): 1, ('PUT', 'sample'): 1, ('GET', 'samples'): 1, ('GET', 'sample'): 1},
+            dict(self.charon.calls))
+        self.assertEqual(4, self.charon.total_calls())
+
+    def test_api_token(self):
+        self.assertEqual(401, requests.get("{}/project/P1".format(self.baseurl)).status_code)
+
+    def test_injected_errors(self):
+        self.charon.fail_next(2)
+        statuses = [self.session.get("{}/project/P1".format(self.baseurl)).status_code for _ in range(3)]
+        self.assertEqual([500, 500, 200], statuses)
+        self.assertEqual(2, self.charon.errors)
+
+    def test_latency(self):
+        self.charon.latency = 0.1
+        started = time.time()
+        self.session.get("{}/project/P1".format(self.baseurl))
+        self.assertGreaterEqual(time.time() - started, 0.1)
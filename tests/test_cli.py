@@ -0,0 +1,158 @@
+""" Tests for the deliver CLI """
+import glob
+import json
+import logging
+import mock
+import os
+import pstats
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from StringIO import StringIO
+
+from taca_ngi_pipeline import cli
+
+# modules which should only be imported when the cluster needing them is selected
+BACKEND_MODULES = [
+    'taca_ngi_pipeline.deliver.deliver',
+    'taca_ngi_pipeline.deliver.deliver_castor',
+    'taca_ngi_pipeline.deliver.deliver_grus',
+    'taca_ngi_pipeline.deliver.deliver_mosler',
+    'ngi_pipeline',
+    'couchdb',
+    'paramiko',
+    'requests']
+
+
+def _import_cli(args=None):
+    """ Import the CLI in a fresh interpreter
+        :param list args: if given, the deliver command is also run with these arguments,
+            with its output discarded
+        :returns: the names of the imported modules
+    """
+    code = "import json, sys, StringIO; " \
+           "import taca_ngi_pipeline.cli; " \
+           "args = json.loads(sys.argv[1]); " \
+           "stdout, sys.stdout = sys.stdout, StringIO.StringIO(); " \
+           "args is None or taca_ngi_pipeline.cli.deliver.main(args, prog_name='deliver', standalone_mode=False); " \
+           "sys.stdout = stdout; " \
+           "print(json.dumps(sorted(sys.modules.keys())))"
+    return json.loads(subprocess.check_output([sys.executable, "-c", code, json.dumps(args)]))
+
+
+class TestCli(unittest.TestCase):
+    def test_lazy_backends(self):
+        """ Importing the CLI should not import any cluster backend """
+        modules = _import_cli()
+        for module in BACKEND_MODULES:
+            self.assertNotIn(module, modules)
+
+    def test_lazy_backends_help(self):
+        """ Showing the help of the deliver commands should not import any cluster backend """
+        for args in [['--help'], ['project', '--help'], ['sample', '--help']]:
+            modules = _import_cli(args)
+            for module in BACKEND_MODULES:
+                self.assertNotIn(module, modules, "{} imported by deliver {}".format(module, " ".join(args)))
+
+
+class TestConcurrentDelivery(unittest.TestCase):
+    def setUp(self):
+        self.log = StringIO()
+        self.handler = logging.StreamHandler(self.log)
+        logging.getLogger().addHandler(self.handler)
+
+    def tearDown(self):
+        logging.getLogger().removeHandler(self.handler)
+
+    def _deliverer(self, projectid, succeed=True):
+        def _deliver_project():
+            cli.logger.info("delivering in {}".format(threading.current_thread().name))
+            if not succeed:
+                raise RuntimeError("mocked error")
+            return True
+        return mock.Mock(projectid=projectid, deliver_project=_deliver_project)
+
+    @mock.patch.object(cli, '_backend')
+    @mock.patch.object(cli.taca.utils.misc, 'send_mail')
+    def test_exec_concurrently(self, send_mail, backend):
+        """ Projects should be delivered in separate threads, with tagged log messages and their own error reports """
+        deliverers = [self._deliverer("P{}".format(i), succeed=(i != 2)) for i in xrange(5)]
+        cli._exec_concurrently(deliverers, 3, 2)
+        backend.return_value.set_io_budget.assert_has_calls([mock.call(2), mock.call(None)])
+        log = self.log.getvalue()
+        for d in deliverers:
+            self.assertIn("[{}] delivering in deliver-project-".format(d.projectid), log)
+        self.assertEqual(send_mail.call_count, 1)
+        self.assertIn("Project: P2", send_mail.call_args[1]["content"])
+        # the log filter should be removed afterwards
+        cli.logger.info("done")
+        self.assertTrue(self.log.getvalue().endswith("done\n"))
+
+    @mock.patch.object(cli, '_backend')
+    def test_exec_concurrently_interrupted(self, backend):
+        """ An interrupted delivery should start no more projects and wait for the running ones to finish """
+        class Interrupted(Exception):
+            pass
+        interrupted = threading.Event()
+
+        def _handler(signum, frame):
+            interrupted.set()
+            raise Interrupted()
+
+        def _deliver_interrupted():
+            os.kill(os.getpid(), signal.SIGUSR1)
+            interrupted.wait(5)
+            # give the main thread some time to stop the workers before this project is done
+            time.sleep(0.2)
+            delivered.append("P0")
+            return True
+
+        delivered = []
+        deliverers = [mock.Mock(projectid="P0", deliver_project=_deliver_interrupted)] + \
+            [mock.Mock(projectid="P{}".format(i), deliver_project=lambda i=i: delivered.append("P{}".format(i)))
+             for i in xrange(1, 4)]
+        previous = signal.signal(signal.SIGUSR1, _handler)
+        try:
+            self.assertRaises(Interrupted, cli._exec_concurrently, deliverers, 1, 2)
+        finally:
+            signal.signal(signal.SIGUSR1, previous)
+        self.assertEqual(["P0"], delivered)
+        self.assertFalse([t for t in threading.enumerate() if t.name.startswith("deliver-project-")])
+        backend.return_value.set_io_budget.assert_has_calls([mock.call(2), mock.call(None)])
+        self.assertIn("3 projects will not be started", self.log.getvalue())
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.logdir = tempfile.mkdtemp(prefix="test_taca_profile_")
+        self.deliverer = mock.Mock(logpath=self.logdir, expand_path=lambda pth: pth)
+        self.deliverer.__str__ = mock.Mock(return_value="P1:S1")
+        patcher = mock.patch.dict(cli._profiling, {'profile': True, 'trace_memory': True, 'trace_memory_top': 5})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.logdir, ignore_errors=True)
+
+    def test_profile(self):
+        """ A profile and a memory summary should be written to the log path for each run """
+        self.assertTrue(cli._exec_fn(self.deliverer, lambda: [str(i) for i in xrange(1000)]))
+        profiles = glob.glob(os.path.join(self.logdir, "P1_S1_*.prof"))
+        self.assertEqual(len(profiles), 1)
+        self.assertGreater(pstats.Stats(profiles[0]).total_calls, 0)
+        summaries = glob.glob(os.path.join(self.logdir, "P1_S1_*_memory.txt"))
+        self.assertEqual(len(summaries), 1)
+        with open(summaries[0]) as fh:
+            self.assertIn("Peak resident memory", fh.read())
+
+    def test_unusable_logpath(self):
+        """ The delivery should run even if the profile can not be written """
+        self.deliverer.logpath = os.path.join(self.logdir, "not-a-folder")
+        open(self.deliverer.logpath, 'w').close()
+        self.assertTrue(cli._exec_fn(self.deliverer, lambda: True))
@@ -1,18 +1,25 @@
 """ Unit tests for the deliver commands """
 
 import __builtin__
+import hashlib
 import json
 # noinspection PyPackageRequirements
 import mock
 import os
 import shutil
 import signal
+import tarfile
 import taca_ngi_pipeline.utils.filesystem
 import tempfile
+import threading
 import unittest
 
 from ngi_pipeline.database import classes as db
+from sftp_server import SFTPStandIn
 from taca_ngi_pipeline.deliver import deliver
+from taca_ngi_pipeline.deliver import deliver_castor
+from taca_ngi_pipeline.deliver import deliver_mosler
+from taca_ngi_pipeline.utils import manifest
 from taca.utils.filesystem import create_folder
 from taca.utils.misc import hashfile
 from taca.utils.transfer import SymlinkError, SymlinkAgent
@@ -344,6 +351,31 @@ class TestDeliverer(unittest.TestCase):
         self.deliverer.files_to_deliver = [pattern[0:2]]
         self.assertListEqual([], list(self.deliverer.gather_files()), "empty result expected for missing file")
 
+    def test_staged_size(self):
+        """ Size and number of entries should be summarized following symlinks """
+        srcdir = os.path.join(
+            self.deliverer.expand_path(self.deliverer.analysispath), "level1_folder0", "level2_folder0")
+        with open(os.path.join(srcdir, "level2_folder0_file0"), 'w') as fh:
+            fh.write("0123456789")
+        stagedir = self.deliverer.expand_path(self.deliverer.stagingpath)
+        create_folder(stagedir)
+        os.symlink(srcdir, os.path.join(stagedir, "staged_folder"))
+        os.symlink(os.path.join(srcdir, "level2_folder0_file0"), os.path.join(stagedir, "staged_file"))
+        # the folder itself, its nfiles files and nfolders subfolders with nfiles files each
+        expected_entries = 1 + self.nfiles + self.nfolders * (1 + self.nfiles)
+        self.assertEqual(
+            deliver.fs.staged_size([os.path.join(stagedir, "staged_folder")]),
+            (10, expected_entries))
+        self.assertEqual(
+            deliver.fs.staged_size([os.path.join(stagedir, "staged_file")])[1], 1)
+
+    def test_available_space(self):
+        """ Free space should be reported for the closest existing parent """
+        missing = os.path.join(self.casedir, "this", "does", "not", "exist")
+        free_bytes, free_inodes = deliver.fs.available_space(missing)
+        self.assertGreater(free_bytes, 0)
+        self.assertTrue(free_inodes is None or free_inodes > 0)
+
     def test_stage_delivery1(self):
         """ The correct folder structure should be created and exceptions 
             handled gracefully
@@ -460,6 +492,134 @@ class TestDeliverer(unittest.TestCase):
                 self.assertEquals(t, fh.read().strip(),
                                   "delivery acknowledgement did not match expectation")
             os.unlink(ackfile)
+        # the statistics of the transfer should follow the timestamp
+        self.deliverer.transfer_stats = {'bytes_sent': 1024, 'files': 3}
+        self.deliverer.acknowledge_delivery(tstamp="this-is-a-timestamp")
+        with open(ackfile, 'r') as fh:
+            self.assertEquals("this-is-a-timestamp", fh.next().strip())
+            self.assertDictEqual(self.deliverer.transfer_stats, json.loads(fh.next()))
+        os.unlink(ackfile)
+
+    def test_parse_rsync_stats(self):
+        """ The transfer statistics should be parsed from the output of both old and new rsync versions """
+        expected = {'files': 21, 'files_transferred': 16, 'total_file_size': 1234567,
+                    'transferred_file_size': 1234567, 'literal_data': 1234000, 'matched_data': 567,
+                    'bytes_sent': 1235012, 'bytes_received': 327}
+        new_output = [
+            "sending incremental file list", "level0_folder0_file0", "",
+            "Number of files: 21 (reg: 16, dir: 5)", "Number of created files: 21 (reg: 16, dir: 5)",
+            "Number of deleted files: 0", "Number of regular files transferred: 16",
+            "Total file size: 1,234,567 bytes", "Total transferred file size: 1,234,567 bytes",
+            "Literal data: 1,234,000 bytes", "Matched data: 567 bytes", "File list size: 0",
+            "File list generation time: 0.001 seconds", "File list transfer time: 0.000 seconds",
+            "Total bytes sent: 1,235,012", "Total bytes received: 327", "",
+            "sent 1,235,012 bytes  received 327 bytes  2,470,678.00 bytes/sec",
+            "total size is 1,234,567  speedup is 1.00"]
+        old_output = [
+            "Number of files: 21", "Number of files transferred: 16", "Total file size: 1234567 bytes",
+            "Total transferred file size: 1234567 bytes", "Literal data: 1234000 bytes",
+            "Matched data: 567 bytes", "File list size: 413", "Total bytes sent: 1235012",
+            "Total bytes received: 327"]
+        for output in [new_output, old_output]:
+            self.assertDictEqual(deliver.parse_rsync_stats(output), expected)
+
+    def test_verify_delivered_files(self):
+        """ The delivered files should be hashed again and mismatches should fail the delivery """
+        deliverypath = self.deliverer.expand_path(self.deliverer.deliverypath)
+        os.makedirs(deliverypath)
+        with open(os.path.join(deliverypath, "delivered_file"), 'w') as fh:
+            fh.write("delivered content\n")
+        with open(self.deliverer.delivered_digestfile(), 'w') as fh:
+            fh.write("{}  delivered_file\n".format(hashlib.md5("delivered content\n").hexdigest()))
+        self.deliverer.transfer_stats = {}
+        result = self.deliverer.verify_delivered_files()
+        self.assertEqual((1, 18), (result.files, result.bytes))
+        self.assertEqual(18, self.deliverer.transfer_stats['verified_bytes'])
+        with open(os.path.join(deliverypath, "delivered_file"), 'w') as fh:
+            fh.write("corrupted content\n")
+        with self.assertRaises(deliver.DelivererVerificationError):
+            self.deliverer.verify_delivered_files()
+        mismatchfile = self.deliverer.expand_path(
+            os.path.join(self.deliverer.logpath, "{}_mismatches.txt".format(self.sampleid)))
+        with open(mismatchfile) as fh:
+            self.assertEqual("delivered_file", fh.read().split("\t")[0])
+
+    def test_stage_delivery_manifest(self):
+        """ A manifest of the staged files should be written and only the changed files redelivered """
+        self.deliverer.files_to_deliver = [SAMPLECFG['deliver']['files_to_deliver'][5]]
+        self.deliverer.stage_delivery()
+        staged = manifest.read(self.deliverer.staging_manifestfile())
+        self.assertEqual(["level0_folder0_file0"], [fpath for fpath, _ in manifest.iter_files(staged)])
+        with open(self.deliverer.staging_filelist()) as fh:
+            self.assertEqual(os.path.basename(self.deliverer.staging_manifestfile()), fh.read().split()[-1])
+        # without a recorded delivery, there is nothing to compare with
+        self.assertIsNone(self.deliverer.changed_filelist())
+        self.deliverer.record_delivered_manifest()
+        with open(self.deliverer.changed_filelist()) as fh:
+            self.assertEqual(
+                [os.path.basename(self.deliverer.staging_digestfile()),
+                 os.path.basename(self.deliverer.staging_manifestfile())], fh.read().split())
+        with open(os.path.join(self.deliverer.expand_path(self.deliverer.analysispath),
+                               "level0_folder0_file0"), 'w') as fh:
+            fh.write("changed content\n")
+        self.deliverer.stage_delivery()
+        with open(self.deliverer.changed_filelist()) as fh:
+            self.assertEqual("level0_folder0_file0", fh.read().split()[0])
+
+    def test_stage_delivery_manifest_no_digest(self):
+        """ Files which are not hashed should be compared by their modification time and size in the manifest """
+        self.deliverer.files_to_deliver = [SAMPLECFG['deliver']['files_to_deliver'][5] + [{'no_digest': True}]]
+        with mock.patch.object(taca_ngi_pipeline.utils.filesystem, 'hashfile') as hashfile, \
+                mock.patch.object(deliver.verify, 'hash_file') as hash_file:
+            self.deliverer.stage_delivery()
+        self.assertFalse(hashfile.called)
+        self.assertFalse(hash_file.called)
+        staged = dict(manifest.iter_files(manifest.read(self.deliverer.staging_manifestfile())))
+        source = os.path.join(self.deliverer.expand_path(self.deliverer.analysispath), "level0_folder0_file0")
+        self.assertEqual(
+            {'hash': manifest.mtime_digest(os.stat(source).st_mtime), 'size': os.path.getsize(source)},
+            staged["level0_folder0_file0"])
+        self.deliverer.record_delivered_manifest()
+        with open(self.deliverer.changed_filelist()) as fh:
+            self.assertNotIn("level0_folder0_file0", fh.read().split())
+        # a file which is touched is delivered again
+        os.utime(source, (os.stat(source).st_atime, os.stat(source).st_mtime + 10))
+        self.deliverer.stage_delivery()
+        with open(self.deliverer.changed_filelist()) as fh:
+            self.assertEqual("level0_folder0_file0", fh.read().split()[0])
+
+    def test_changed_filelist_non_ascii(self):
+        """ Changed files with non-ASCII names should be listed as they are named on disk """
+        name = "r\xc3\xa4ttelse.txt"
+        source = os.path.join(self.deliverer.expand_path(self.deliverer.analysispath), name)
+        with open(source, 'w') as fh:
+            fh.write("content\n")
+        self.deliverer.files_to_deliver = [[source, '<STAGINGPATH>']]
+        self.deliverer.stage_delivery()
+        self.deliverer.record_delivered_manifest()
+        with open(source, 'w') as fh:
+            fh.write("changed content\n")
+        self.deliverer.stage_delivery()
+        with open(self.deliverer.changed_filelist()) as fh:
+            self.assertEqual(name, fh.read().split("\n")[0])
+
+    @mock.patch.object(deliver.transfer, 'RsyncAgent')
+    def test_redeliver_changed_only(self, rsync_agent):
+        """ A forced redelivery should only send the changed files when configured to """
+        self.deliverer.files_to_deliver = [SAMPLECFG['deliver']['files_to_deliver'][5]]
+        self.deliverer.stage_delivery()
+        self.deliverer.record_delivered_manifest()
+        self.deliverer.force = True
+        for redeliver_changed_only, filelist in [
+                (None, self.deliverer.staging_filelist()),
+                (False, self.deliverer.staging_filelist()),
+                (True, "{}.changed.lst".format(os.path.splitext(self.deliverer.staging_filelist())[0]))]:
+            if redeliver_changed_only is not None:
+                self.deliverer.redeliver_changed_only = redeliver_changed_only
+            else:
+                self.assertFalse(self.deliverer.redeliver_changed_only)
+            self.deliverer.do_delivery()
+            self.assertEqual([filelist], rsync_agent.call_args[1]['opts']['--files-from'])
 
 
 class TestProjectDeliverer(unittest.TestCase):
@@ -489,6 +649,21 @@ class TestProjectDeliverer(unittest.TestCase):
             getattr(self, 'deliverer'),
             deliver.ProjectDeliverer)
 
+    def test_write_project_manifest(self):
+        """ The sample manifests should be merged into a manifest of the project """
+        self.assertIsNone(self.deliverer.write_project_manifest())
+        stagingpath = self.deliverer.expand_path(self.deliverer.stagingpath)
+        os.makedirs(stagingpath)
+        for sampleid in ["NGIU-S001", "NGIU-S002"]:
+            manifest.write(
+                manifest.build([("{}/reads.fastq.gz".format(sampleid), sampleid, 10)], 'sha1'),
+                os.path.join(stagingpath, "{}.manifest.json".format(sampleid)))
+        projectmanifest = manifest.read(self.deliverer.write_project_manifest())
+        self.assertEqual(
+            ["NGIU-S001/reads.fastq.gz", "NGIU-S002/reads.fastq.gz"],
+            [fpath for fpath, _ in manifest.iter_files(projectmanifest)])
+        self.assertEqual(projectmanifest, manifest.read(self.deliverer.write_project_manifest()))
+
     @mock.patch.object(
         deliver.db.db.CharonSession,
         'project_update',
@@ -639,8 +814,8 @@ class TestSampleDeliverer(unittest.TestCase):
             rootdir=self.casedir,
             **SAMPLECFG['deliver'])
         self.assertEquals(deliverer.uppnexid, PROJECTENTRY['uppnex_id'])
-        #two calls, one for projectname one for uppnexid
-        self.assertEquals(dbmock.call_count, 2)
+        #one call, the entry is used for both the projectname and the uppnexid
+        self.assertEquals(dbmock.call_count, 1)
 
     @mock.patch.object(
         deliver.db.db.CharonSession,
@@ -748,3 +923,292 @@ class TestSampleDeliverer(unittest.TestCase):
                 " ".join(syscall.call_args_list[1][0][0][:-1]),
                 "{} --samples_extra".format(
                     SAMPLECFG['deliver']['report_aggregate']))
+
+
+class TestSFTPDelivery(unittest.TestCase):
+    """ Uploads with MySFTPClient and the Castor and Mosler sample deliverers,
+        against an in-process SFTP server
+    """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_sftp_")
+        self.remotedir = os.path.join(self.rootdir, "remote")
+        self.stagingpath = os.path.join(self.rootdir, "STAGING")
+        self.sampleid = 'NGIU-S001'
+        self.sampledir = os.path.join(self.stagingpath, self.sampleid)
+        for subdir in ["01-QC", os.path.join("02-FASTQ", "FC01")]:
+            os.makedirs(os.path.join(self.sampledir, subdir))
+        self.files = {
+            "01-QC/qc.txt": "quality\n",
+            "02-FASTQ/FC01/reads_R1.fastq.gz": os.urandom(200000),
+            "02-FASTQ/FC01/reads_R2.fastq.gz": os.urandom(100000)}
+        for name, content in self.files.items():
+            with open(os.path.join(self.sampledir, name), 'wb') as fh:
+                fh.write(content)
+        with open(os.path.join(self.stagingpath, "{}.md5".format(self.sampleid)), 'w') as fh:
+            fh.write("checksums\n")
+        os.makedirs(os.path.join(self.remotedir, "wharf"))
+        self.server = SFTPStandIn(self.remotedir)
+        self.server.start()
+        self.transport = self.server.connect()
+        self.client = deliver_castor.MySFTPClient.from_transport(self.transport)
+        self.client.chdir("/wharf")
+
+    def tearDown(self):
+        self.client.close()
+        self.transport.close()
+        self.server.stop()
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def _remote_content(self, name):
+        with open(os.path.join(self.remotedir, "wharf", name), 'rb') as fh:
+            return fh.read()
+
+    def _sample_deliverer(self, deliverer_class, **kwargs):
+        config = dict(SAMPLECFG['deliver'], stagingpath=self.stagingpath, **kwargs)
+        with mock.patch.object(deliver.db, 'dbcon', autospec=db.CharonSession):
+            return deliverer_class('NGIU-P001', self.sampleid, self.client, rootdir=self.rootdir, **config)
+
+    def test_put_dir(self):
+        """ Upload a folder, and skip the files already uploaded when uploading it again """
+        self.client.mkdir(self.sampleid)
+        totals = self.client.put_dir(self.sampledir, self.sampleid)
+        self.assertEqual((3, 0, 300008), (totals['files'], totals['skipped'], totals['bytes']))
+        for name, content in self.files.items():
+            self.assertEqual(content, self._remote_content(os.path.join(self.sampleid, name)))
+        self.server.requests.clear()
+        totals = self.client.put_dir(self.sampledir, self.sampleid)
+        self.assertEqual((0, 3), (totals['files'], totals['skipped']))
+        self.assertEqual(0, self.server.requests['open'])
+
+    def test_put_dir_parallel(self):
+        """ Upload a folder over several sftp channels and resume a partial file """
+        self.client.makedirs("{}/02-FASTQ/FC01".format(self.sampleid))
+        partial = os.path.join(self.sampleid, "02-FASTQ", "FC01", "reads_R1.fastq.gz")
+        with open(os.path.join(self.remotedir, "wharf", partial), 'wb') as fh:
+            fh.write(self.files["02-FASTQ/FC01/reads_R1.fastq.gz"][:50000])
+        totals = self.client.put_dir(self.sampledir, self.sampleid, channels=3)
+        self.assertEqual((3, 250008), (totals['files'], totals['bytes']))
+        for name, content in self.files.items():
+            self.assertEqual(content, self._remote_content(os.path.join(self.sampleid, name)))
+
+    def test_makedirs(self):
+        """ Create the missing parents of a folder, without asking again for folders known to exist """
+        self.client.makedirs("{}/02-FASTQ/FC01".format(self.sampleid))
+        self.assertTrue(os.path.isdir(os.path.join(self.remotedir, "wharf", self.sampleid, "02-FASTQ", "FC01")))
+        self.server.requests.clear()
+        self.client.makedirs("{}/02-FASTQ".format(self.sampleid))
+        self.client.mkdir("{}/02-FASTQ/FC01".format(self.sampleid), ignore_existing=True)
+        self.assertEqual(0, self.server.total_requests())
+        # a folder created by someone else is found with a stat
+        os.makedirs(os.path.join(self.remotedir, "wharf", self.sampleid, "01-QC"))
+        self.client.makedirs("{}/01-QC".format(self.sampleid))
+        self.assertTrue(self.client.is_known_dir("{}/01-QC".format(self.sampleid)))
+        # removed folders are forgotten
+        self.client.rmdir("{}/02-FASTQ/FC01".format(self.sampleid))
+        self.assertFalse(self.client.is_known_dir("{}/02-FASTQ/FC01".format(self.sampleid)))
+        self.assertTrue(self.client.is_known_dir("{}/02-FASTQ".format(self.sampleid)))
+
+    def test_mkdir_ignore_existing(self):
+        """ Only an existing folder should be ignored, and only created or existing folders remembered """
+        self.client.mkdir(self.sampleid)
+        self.client.mkdir(self.sampleid, ignore_existing=True)
+        self.assertTrue(self.client.is_known_dir(self.sampleid))
+        # a missing parent is not an existing folder
+        missing = "{}/01-QC/plots".format(self.sampleid)
+        self.assertRaises(IOError, self.client.mkdir, missing, ignore_existing=True)
+        self.assertFalse(self.client.is_known_dir(missing))
+        # neither is a file
+        with open(os.path.join(self.remotedir, "wharf", self.sampleid, "qc.txt"), 'w') as fh:
+            fh.write("quality\n")
+        inaway = "{}/qc.txt".format(self.sampleid)
+        self.assertRaises(IOError, self.client.mkdir, inaway, ignore_existing=True)
+        self.assertFalse(self.client.is_known_dir(inaway))
+        # a folder created by someone else is
+        os.makedirs(os.path.join(self.remotedir, "wharf", self.sampleid, "02-FASTQ"))
+        self.client.mkdir("{}/02-FASTQ".format(self.sampleid), ignore_existing=True)
+        self.assertTrue(self.client.is_known_dir("{}/02-FASTQ".format(self.sampleid)))
+
+    def test_castor_do_delivery(self):
+        """ Deliver a staged sample to castor """
+        deliverer = self._sample_deliverer(deliver_castor.CastorSampleDeliverer)
+        self.assertTrue(deliverer.do_delivery())
+        for name, content in self.files.items():
+            self.assertEqual(content, self._remote_content(os.path.join(self.sampleid, name)))
+        self.assertEqual("checksums\n", self._remote_content("{}.md5".format(self.sampleid)))
+
+    def test_mosler_do_delivery(self):
+        """ Stream a staged sample to mosler as a tar archive, with its digest """
+        deliverer = self._sample_deliverer(deliver_mosler.MoslerSampleDeliverer)
+        self.assertTrue(deliverer.do_delivery())
+        archive = os.path.join(self.remotedir, "wharf", "{}.tar".format(self.sampleid))
+        with tarfile.open(archive) as tar:
+            for name, content in self.files.items():
+                self.assertEqual(content, tar.extractfile(os.path.join(self.sampleid, name)).read())
+        with open(os.path.join(self.stagingpath, "{}.tar.md5".format(self.sampleid))) as fh:
+            self.assertEqual(
+                "{}  {}.tar\n".format(hashfile(archive, hasher='md5'), self.sampleid), fh.read())
+
+    def test_sftp_deliver_sample_verify_delivery(self):
+        """ A castor or mosler delivery should not be verified, nor marked as failed, with verify_delivery set """
+        for deliverer_class in [deliver_castor.CastorSampleDeliverer, deliver_mosler.MoslerSampleDeliverer]:
+            deliverer = self._sample_deliverer(deliverer_class, verify_delivery=True)
+            self.assertFalse(deliverer.verify_delivery)
+            sampleentry = {'analysis_status': 'ANALYZED', 'delivery_status': 'NOT_DELIVERED', 'status': 'STALE'}
+            with mock.patch.object(deliverer, 'stage_delivery', return_value=True), \
+                    mock.patch.object(deliverer, 'update_delivery_status') as update_delivery_status, \
+                    mock.patch.object(deliverer, 'verify_delivered_files') as verify_delivered_files, \
+                    mock.patch.object(deliverer, 'acknowledge_delivery'):
+                self.assertTrue(deliverer.deliver_sample(sampleentry))
+            self.assertFalse(verify_delivered_files.called)
+            self.assertEqual(
+                [mock.call(status="IN_PROGRESS"), mock.call()], update_delivery_status.call_args_list,
+                "unexpected delivery status updates for {}".format(deliverer_class.__name__))
+
+    def test_mosler_do_delivery_compressed(self):
+        """ Stream a staged sample to mosler as a compressed tar archive, with its digest """
+        deliverer = self._sample_deliverer(
+            deliver_mosler.MoslerSampleDeliverer, moslercompress=True, moslercompress_threads=2)
+        self.assertTrue(deliverer.do_delivery())
+        archive = os.path.join(self.remotedir, "wharf", "{}.tar.gz".format(self.sampleid))
+        with tarfile.open(archive, "r:gz") as tar:
+            for name, content in self.files.items():
+                self.assertEqual(content, tar.extractfile(os.path.join(self.sampleid, name)).read())
+        with open(os.path.join(self.stagingpath, "{}.tar.gz.md5".format(self.sampleid))) as fh:
+            self.assertEqual(
+                "{}  {}.tar.gz\n".format(hashfile(archive, hasher='md5'), self.sampleid), fh.read())
+
+
+class _FakeMoslerSample(object):
+    """ Stands in for a MoslerSampleDeliverer, with a delivery that runs until it is finished by the test
+        or its sftp client is closed
+    """
+
+    def __init__(self, projectid, sampleid, sftp_client):
+        self.sampleid = sampleid
+        self.sftp_client = sftp_client
+        self.sftp_client.close.side_effect = lambda: self.finish(IOError("sftp client closed"))
+        self.update_delivery_status = mock.Mock()
+        self.error = None
+        self._finished = threading.Event()
+
+    def __str__(self):
+        return self.sampleid
+
+    def remote_archive_name(self):
+        return "{}.tar".format(self.sampleid)
+
+    def finish(self, error=None):
+        self.error = error
+        self._finished.set()
+
+    def deliver_sample(self):
+        self._finished.wait()
+        if self.error is not None:
+            raise self.error
+        return True
+
+
+class TestMoslerDeliverSamples(unittest.TestCase):
+    """ Schedules the sample deliveries of MoslerProjectDeliverer against a fake transport, where
+        the listing of the remote folder is controlled by the test and each wait for a free slot
+        runs the next step of the test
+    """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_mosler_")
+        with mock.patch.object(deliver.db, 'dbcon', autospec=db.CharonSession):
+            self.deliverer = deliver_mosler.MoslerProjectDeliverer(
+                'NGIU-P001', rootdir=self.rootdir, moslerdeliverypath='/wharf', moslersftpmaxfiles=2,
+                moslerpoll_min_interval=1, moslerpoll_max_interval=4, **SAMPLECFG['deliver'])
+        self.listing = []
+        self.listing_client = mock.Mock()
+        self.listing_client.listdir.side_effect = lambda path: list(self.listing)
+        self.transport = mock.Mock()
+        self.transport.open_sftp_client.side_effect = [self.listing_client] + [mock.Mock() for _ in xrange(10)]
+        self.samples = {}
+        self.started = []
+        self.concurrency = []
+        self.waits = []
+        self.steps = []
+        for patcher in [
+                mock.patch.object(deliver_mosler, 'MoslerSampleDeliverer', side_effect=self._sample),
+                mock.patch.object(deliver_mosler.MoslerProjectDeliverer, '_wait_for_deliveries',
+                                  side_effect=self._wait)]:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        for sample in self.samples.values():
+            sample.finish()
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def _sample(self, projectid, sampleid, sftp_client):
+        sample = _FakeMoslerSample(projectid, sampleid, sftp_client)
+        self.samples[sampleid] = sample
+        self.started.append(sampleid)
+        self.concurrency.append(len([s for s in self.samples.values() if not s._finished.is_set()]))
+        return sample
+
+    def _wait(self, running, seconds):
+        self.waits.append(seconds)
+        step = self.steps.pop(0) if self.steps else self._finish
+        step(running)
+
+    def _finish(self, running, sampleids=None, error=None):
+        """ Finishes the running deliveries of the given samples, or all of them, and waits for them to stop """
+        for sampleid, (sample, delivery) in running.items():
+            if sampleids is None or sampleid in sampleids:
+                sample.finish(error)
+                delivery.join()
+
+    def test_slots_and_backoff(self):
+        """ Samples should be started in order when there are free slots, with the polls backing off while
+            there are none, and the interval reset when a slot is free again
+        """
+        self.listing = ["other.tar"]
+
+        def upload_started(running):
+            # the archive of S2 shows up in the listing, and the other file is removed
+            self.listing = ["NGIU-S002.tar"]
+        self.steps = [
+            lambda running: None,
+            lambda running: None,
+            lambda running: None,
+            lambda running: self._finish(running, ["NGIU-S001"]),
+            upload_started]
+        self.assertTrue(self.deliverer.deliver_samples(self.transport, ["NGIU-S001", "NGIU-S002", "NGIU-S003"]))
+        self.assertEqual(["NGIU-S001", "NGIU-S002", "NGIU-S003"], self.started)
+        # one free slot while S1 was uploading, and a second one when S2 was uploading
+        self.assertEqual([1, 1, 2], self.concurrency)
+        # full quota: 1, 2, 4, 4 (max), a free slot resets to 1, and the wait for the last sample uses the max
+        self.assertEqual([1, 2, 4, 4, 1, 4], self.waits)
+        self.listing_client.close.assert_called_once_with()
+        for sample in self.samples.values():
+            sample.sftp_client.close.assert_called_once_with()
+            self.assertFalse(sample.update_delivery_status.called)
+
+    def test_sample_failure(self):
+        """ A failed sample delivery should stop the starting of samples and be raised """
+        self.deliverer.moslersftpmaxfiles = 1
+        error = deliver.DelivererError("upload failed")
+        self.steps = [lambda running: self._finish(running, error=error)]
+        with self.assertRaises(deliver.DelivererError) as raised:
+            self.deliverer.deliver_samples(self.transport, ["NGIU-S001", "NGIU-S002"])
+        self.assertIs(error, raised.exception)
+        self.assertEqual(["NGIU-S001"], self.started)
+        self.listing_client.close.assert_called_once_with()
+
+    def test_interrupted(self):
+        """ An interrupted delivery should cancel the running uploads and reset their samples """
+        def interrupt(running):
+            raise deliver.DelivererInterruptedError("interrupted")
+        self.steps = [interrupt]
+        self.assertRaises(deliver.DelivererInterruptedError,
+                          self.deliverer.deliver_samples, self.transport, ["NGIU-S001", "NGIU-S002", "NGIU-S003"])
+        self.assertEqual(["NGIU-S001", "NGIU-S002"], self.started)
+        for sample in self.samples.values():
+            sample.sftp_client.close.assert_called_once_with()
+            self.assertIsInstance(sample.error, IOError)
+            sample.update_delivery_status.assert_called_once_with(status="NOT_DELIVERED")
+        self.listing_client.close.assert_called_once_with()
@@ -0,0 +1,461 @@
+""" Unit tests for the GRUS deliveries with mover """
+
+import datetime
+import json
+# noinspection PyPackageRequirements
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import yaml
+
+from click.testing import CliRunner
+from dateutil.relativedelta import relativedelta
+from ngi_pipeline.database import classes as db
+from taca_ngi_pipeline import cli
+from taca_ngi_pipeline.deliver import deliver
+from taca_ngi_pipeline.deliver import deliver_grus
+
+from mover_stubs import MoverToolchain
+
+GRUSCFG = {
+    'deliver': {
+        'stagingpath': '<ROOTDIR>/DELIVERY_SOFT/<PROJECTID>',
+        'stagingpathhard': '<ROOTDIR>/DELIVERY_HARD/<PROJECTID>',
+        'deliverypath': '<ROOTDIR>/DELIVERY_DESTINATION',
+        'logpath': '<ROOTDIR>/logs',
+        'deliverystatuspath': '<ROOTDIR>/ACK',
+        'hash_algorithm': 'md5'},
+    'snic': {
+        'snic_api_url': 'http://localhost/supr',
+        'snic_api_user': 'user',
+        'snic_api_password': 'password'},
+    'statusdb': {
+        'url': 'localhost',
+        'username': 'user',
+        'password': 'password',
+        'port': 5984},
+    'order_portal': {
+        'orderportal_api_url': 'http://localhost/orderportal',
+        'orderportal_api_token': 'token'}}
+
+
+_sleep = time.sleep
+
+
+def _short_sleep(seconds):
+    """ Keeps the waits between the polls of the MoverMonitor short in the tests """
+    _sleep(min(seconds, 0.01))
+
+
+def _prefetched(**results):
+    """ :returns: stand-ins for the BackgroundCalls started by GrusProjectDeliverer.prefetch """
+    return dict([(key, mock.Mock(**{'result.return_value': value})) for key, value in results.items()])
+
+
+class TestGrusProjectDeliverer(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_grus_")
+        self.projectid = 'NGIU-P001'
+        patcher = mock.patch.dict(deliver_grus.CONFIG, dict(
+            [(key, dict(value)) for key, value in GRUSCFG.items() if key != 'deliver']))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.deliverer = self._deliverer()
+        self.soft_stagepath = self.deliverer.expand_path(self.deliverer.stagingpath)
+        self.hard_stagepath = self.deliverer.expand_path(self.deliverer.stagingpathhard)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def _deliverer(self, **kwargs):
+        config = dict(GRUSCFG['deliver'], rootdir=self.rootdir)
+        config.update(kwargs)
+        with mock.patch.object(deliver.db, 'dbcon', autospec=db.CharonSession):
+            return deliver_grus.GrusProjectDeliverer(self.projectid, **config)
+
+    def test_check_hard_stage_capacity(self):
+        """ The copy should only be allowed if it fits within the margin of the free space and inodes """
+        self.deliverer.stagingpathhard_margin = 0.1
+        with mock.patch.object(deliver_grus.fs, 'staged_size', return_value=(900, 90)), \
+                mock.patch.object(deliver_grus.fs, 'available_space') as available_space:
+            for free, expected in [
+                    ((1000, 100), True),
+                    ((999, 100), False),
+                    ((1000, 99), False),
+                    # the inodes are not checked on filesystems which do not report them
+                    ((1000, None), True)]:
+                available_space.return_value = free
+                self.assertEqual(expected, self.deliverer.check_hard_stage_capacity(["staged"], "hard"),
+                                 "unexpected outcome with {} free bytes and inodes".format(free))
+
+    def test_check_hard_stage_capacity_on_disk(self):
+        """ A small soft staged sample should fit on the filesystem it is staged on """
+        sampledir = os.path.join(self.soft_stagepath, "NGIU-S001")
+        os.makedirs(sampledir)
+        with open(os.path.join(sampledir, "reads.fastq.gz"), 'w') as fh:
+            fh.write("reads\n")
+        self.assertTrue(self.deliverer.check_hard_stage_capacity([sampledir], self.rootdir))
+
+    @mock.patch.object(deliver_grus, 'proceed_or_not', return_value=True)
+    def test_hard_stage_capacity_releases_lock(self, proceed_or_not):
+        """ If the hard staged copy will not fit, the hard staging folder locking the delivery should be removed """
+        sampledir = os.path.join(self.soft_stagepath, "NGIU-S001")
+        os.makedirs(sampledir)
+        self.deliverer.pi_email = "pi@example.com"
+        self.deliverer._prefetched = _prefetched(
+            mover_version=True, pi_email=None, pi_id=7, staged_samples=["NGIU-S001"])
+        with mock.patch.object(self.deliverer, 'get_delivery_status', return_value='NOT_DELIVERED'), \
+                mock.patch.object(self.deliverer, 'check_hard_stage_capacity', return_value=False) as check:
+            self.assertFalse(self.deliverer.deliver_project())
+        check.assert_called_once_with([sampledir], self.hard_stagepath)
+        self.assertFalse(os.path.exists(self.hard_stagepath))
+        self.assertTrue(os.path.exists(os.path.dirname(self.hard_stagepath)))
+
+    def _patch_lookups(self, pi_email="pi@example.com", staged_samples=None):
+        """ Patches the lookups in external services started by prefetch """
+        lookups = {
+            'mover_version': mock.patch.object(deliver_grus, 'check_mover_version', return_value=True),
+            'pi_email': mock.patch.object(self.deliverer, '_get_pi_email', return_value=pi_email),
+            'pi_id': mock.patch.object(self.deliverer, '_get_pi_id_from_supr', return_value=7),
+            'staged_samples': mock.patch.object(
+                self.deliverer, 'get_samples_from_charon', return_value=staged_samples or ["NGIU-S001"])}
+        mocks = {}
+        for key, patcher in lookups.items():
+            mocks[key] = patcher.start()
+            self.addCleanup(patcher.stop)
+        return mocks
+
+    def test_prefetch(self):
+        """ The lookups should be started once and their results kept until they are asked for """
+        lookups = self._patch_lookups()
+        self.deliverer.prefetch()
+        prefetched = self.deliverer._prefetched
+        self.deliverer.prefetch()
+        self.assertIs(prefetched, self.deliverer._prefetched)
+        self.assertEqual(True, prefetched['mover_version'].result())
+        self.assertEqual("pi@example.com", prefetched['pi_email'].result())
+        self.assertEqual(7, prefetched['pi_id'].result())
+        self.assertEqual(["NGIU-S001"], prefetched['staged_samples'].result())
+        for lookup in lookups.values():
+            self.assertEqual(1, lookup.call_count)
+        lookups['pi_id'].assert_called_once_with("pi@example.com")
+        lookups['staged_samples'].assert_called_once_with(delivery_status="STAGED")
+
+    def test_prefetch_pi_email_given(self):
+        """ A PI e-mail given by the user should not be looked up but used for the PI id """
+        lookups = self._patch_lookups()
+        self.deliverer.pi_email = "user@example.com"
+        self.deliverer.prefetch()
+        self.assertIsNone(self.deliverer._prefetched['pi_email'])
+        self.assertEqual(7, self.deliverer._prefetched['pi_id'].result())
+        self.assertFalse(lookups['pi_email'].called)
+        lookups['pi_id'].assert_called_once_with("user@example.com")
+
+    def test_prefetch_no_pi_email(self):
+        """ A missing PI e-mail should fail the PI id lookup with an error naming the project """
+        lookups = self._patch_lookups(pi_email=None)
+        self.deliverer.prefetch()
+        with self.assertRaises(AssertionError) as raised:
+            self.deliverer._prefetched['pi_id'].result()
+        self.assertIn(self.projectid, str(raised.exception))
+        self.assertFalse(lookups['pi_id'].called)
+        # an order without a PI e-mail is not cached as one
+        response = mock.Mock(status_code=200, content=json.dumps({'fields': {'project_pi_email': None}}))
+        with mock.patch.object(deliver_grus.requests, 'get', return_value=response):
+            with self.assertRaises(AssertionError) as raised:
+                self.deliverer._get_pi_email_from_portal("NGI0001")
+        self.assertIn(self.projectid, str(raised.exception))
+
+    @mock.patch.object(deliver_grus, 'proceed_or_not', return_value=True)
+    def test_prefetched_values_used(self, proceed_or_not):
+        """ deliver_project should use the prefetched values instead of looking them up again """
+        sampledir = os.path.join(self.soft_stagepath, "NGIU-S002")
+        os.makedirs(sampledir)
+        os.makedirs(os.path.join(self.soft_stagepath, "NGIU-S001"))
+        lookups = self._patch_lookups(pi_email="prefetched@example.com", staged_samples=["NGIU-S002"])
+        self.deliverer.prefetch()
+        with mock.patch.object(self.deliverer, 'get_delivery_status', return_value='NOT_DELIVERED'), \
+                mock.patch.object(self.deliverer, 'check_hard_stage_capacity', return_value=False) as check:
+            self.assertFalse(self.deliverer.deliver_project())
+        self.assertEqual("prefetched@example.com", self.deliverer.pi_email)
+        # the prefetched staged sample comes first, anything else in the staging folder is treated as other files
+        check.assert_called_once_with(
+            [sampledir, os.path.join(self.soft_stagepath, "NGIU-S001")], self.hard_stagepath)
+        for lookup in lookups.values():
+            self.assertEqual(1, lookup.call_count)
+
+    @mock.patch.object(deliver_grus, 'proceed_or_not', return_value=True)
+    def test_prefetch_errors(self, proceed_or_not):
+        """ An error in a prefetched lookup should surface where its value is used in deliver_project """
+        os.makedirs(self.soft_stagepath)
+        lookups = self._patch_lookups()
+        # a failed PI e-mail lookup stops the delivery, and the PI id which depends on it fails as well
+        lookups['pi_email'].side_effect = AssertionError("order portal says no")
+        self.deliverer.prefetch()
+        with mock.patch.object(self.deliverer, 'get_delivery_status', return_value='NOT_DELIVERED'), \
+                mock.patch.object(deliver_grus.logger, 'error') as error:
+            self.assertFalse(self.deliverer.deliver_project())
+        self.assertIn("order portal says no", error.call_args[0][0])
+        self.assertRaises(AssertionError, self.deliverer._prefetched['pi_id'].result)
+        # a failed lookup of the staged samples is raised
+        shutil.rmtree(self.hard_stagepath)
+        lookups['pi_email'].side_effect = None
+        lookups['staged_samples'].side_effect = db.CharonError("charon says no")
+        self.deliverer._prefetched = None
+        self.deliverer.prefetch()
+        with mock.patch.object(self.deliverer, 'get_delivery_status', return_value='NOT_DELIVERED'):
+            with self.assertRaises(db.CharonError) as raised:
+                self.deliverer.deliver_project()
+        self.assertIs(lookups['staged_samples'].side_effect, raised.exception)
+
+    def test_evaluate_mover_status(self):
+        """ A delivery is over when mover reports it delivered or when it has been going on for too long """
+        now = datetime.datetime.utcnow()
+        for mover_status, started, expected in [
+                ('Delivered', now, 'DELIVERED'),
+                ('Accepted', now, None),
+                ('InProgress', now, None),
+                ('Failed', now, None),
+                ('SomethingNew', now, None),
+                ('InProgress', now - relativedelta(days=8), 'FAILED')]:
+            self.assertEqual(expected, self.deliverer.evaluate_mover_status(mover_status, "token", started),
+                             "unexpected outcome for {} started at {}".format(mover_status, started))
+        # a delivered project must have been moved out of the hard staging path by mover
+        os.makedirs(self.hard_stagepath)
+        self.assertEqual('FAILED', self.deliverer.evaluate_mover_status('Delivered', "token", now))
+
+    @mock.patch.object(deliver_grus, 'CharonSession')
+    def test_finalize_mover_delivery(self, charon_session):
+        """ The samples under delivery should get the outcome and the project only when all samples are delivered """
+        samples = [
+            {'sampleid': 'S1', 'delivery_status': 'IN_PROGRESS'},
+            {'sampleid': 'S2', 'delivery_status': 'DELIVERED'},
+            {'sampleid': 'S3', 'delivery_status': 'NOT_DELIVERED', 'status': 'ABORTED'}]
+        with mock.patch.object(self.deliverer, 'update_delivery_status') as update_delivery_status:
+            self.deliverer.finalize_mover_delivery('DELIVERED', sample_entries=samples)
+            charon_session.return_value.sample_update.assert_called_once_with(
+                self.projectid, 'S1', delivery_status='DELIVERED')
+            charon_session.return_value.project_update.assert_called_once_with(
+                self.projectid, delivery_token='NO-TOKEN')
+            update_delivery_status.assert_called_once_with(status='DELIVERED')
+            # a failed delivery resets the token but leaves the project status alone
+            charon_session.reset_mock()
+            update_delivery_status.reset_mock()
+            samples = [{'sampleid': 'S1', 'delivery_status': 'IN_PROGRESS'}]
+            with mock.patch.object(self.deliverer, 'get_sample_entries_from_charon', return_value=samples):
+                self.deliverer.finalize_mover_delivery('FAILED')
+            charon_session.return_value.sample_update.assert_called_once_with(
+                self.projectid, 'S1', delivery_status='FAILED')
+            charon_session.return_value.project_update.assert_called_once_with(
+                self.projectid, delivery_token='NO-TOKEN')
+            self.assertFalse(update_delivery_status.called)
+            # without an outcome, nothing is changed
+            charon_session.reset_mock()
+            self.deliverer.finalize_mover_delivery(None)
+            self.assertFalse(charon_session.called)
+
+
+class TestDeliveryStarted(unittest.TestCase):
+    def setUp(self):
+        self.default = datetime.datetime(2020, 1, 1)
+
+    def test_timezones(self):
+        """ The start time should be converted to a naive UTC datetime """
+        expected = datetime.datetime(2018, 5, 2, 10, 30)
+        for started in ["2018-05-02T10:30:00Z", "2018-05-02T10:30:00+00:00", "2018-05-02T12:30:00+02:00",
+                        "2018-05-02T05:30:00-05:00", "2018-05-02 10:30:00"]:
+            self.assertEqual(expected, deliver_grus._delivery_started({'delivery_started': started}, self.default),
+                             "unexpected start time parsed from {}".format(started))
+
+    def test_missing(self):
+        """ Without a recorded start time, the default should be used """
+        for dbentry in [{}, {'delivery_started': None}, {'delivery_started': ""}]:
+            self.assertIs(self.default, deliver_grus._delivery_started(dbentry, self.default))
+
+    def test_malformed(self):
+        """ A start time which cannot be parsed should be logged and replaced by the default """
+        for started in ["not a time", "2018-13-45T10:30:00Z", 1525257000]:
+            with mock.patch.object(deliver_grus.logger, 'warning') as warning:
+                self.assertIs(self.default, deliver_grus._delivery_started({'delivery_started': started}, self.default))
+            self.assertTrue(warning.called, "no warning for {}".format(started))
+
+
+@mock.patch.object(deliver_grus.time, 'sleep', side_effect=_short_sleep)
+class TestCheckMoverDeliveryStatus(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_check_mover_")
+        self.mover = MoverToolchain(os.path.join(self.rootdir, "bin"), statuses=['Accepted', 'Delivered'])
+        self.mover.install()
+        self.addCleanup(self.mover.uninstall)
+        patcher = mock.patch.dict(deliver_grus.CONFIG, dict(
+            [(key, dict(value)) for key, value in GRUSCFG.items() if key != 'deliver']))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        with mock.patch.object(deliver.db, 'dbcon', autospec=db.CharonSession):
+            self.deliverer = deliver_grus.GrusProjectDeliverer(
+                'NGIU-P001', rootdir=self.rootdir, mover_poll_interval=0, **GRUSCFG['deliver'])
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def test_db_entry_once_per_cycle(self, sleep):
+        """ Charon should be looked at once to get the token and then once for each poll of mover """
+        self.mover.script("token1", ['Accepted', 'InProgress', 'InProgress', 'Delivered'])
+        dbentry = {'delivery_token': "token1", 'delivery_started': "2099-01-01T00:00:00Z"}
+        with mock.patch.object(self.deliverer, 'get_delivery_status', return_value='IN_PROGRESS'), \
+                mock.patch.object(self.deliverer, 'db_entry', return_value=dbentry) as db_entry, \
+                mock.patch.object(self.deliverer, 'finalize_mover_delivery') as finalize:
+            self.deliverer.check_mover_delivery_status()
+        self.assertEqual({'token1': 4}, self.mover.polls())
+        self.assertEqual(1 + 4, db_entry.call_count)
+        finalize.assert_called_once_with('DELIVERED')
+
+    def test_too_long(self, sleep):
+        """ The start time recorded in Charon should be used to fail a delivery which is going on for too long """
+        self.mover.script("token1", ['InProgress'])
+        dbentry = {'delivery_token': "token1", 'delivery_started': "2016-01-01T00:00:00+01:00"}
+        with mock.patch.object(self.deliverer, 'get_delivery_status', return_value='IN_PROGRESS'), \
+                mock.patch.object(self.deliverer, 'db_entry', return_value=dbentry), \
+                mock.patch.object(self.deliverer, 'finalize_mover_delivery') as finalize:
+            self.deliverer.check_mover_delivery_status()
+        self.assertEqual({'token1': 1}, self.mover.polls())
+        finalize.assert_called_once_with('FAILED')
+
+
+@mock.patch.object(deliver_grus.time, 'sleep', side_effect=_short_sleep)
+class TestMoverMonitor(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_mover_monitor_")
+        self.mover = MoverToolchain(os.path.join(self.rootdir, "bin"), statuses=['Accepted', 'Delivered'])
+        self.mover.install()
+        self.entries = {}
+        self.outcomes = {}
+
+    def tearDown(self):
+        self.mover.uninstall()
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def _deliverer(self, projectid, delivery_token='NO-TOKEN', delivery_started=None):
+        """ :returns: a project deliverer under delivery with a token, with the outcome recorded in self.outcomes """
+        entry = {'delivery_token': delivery_token}
+        if delivery_started is not None:
+            entry['delivery_started'] = delivery_started
+        self.entries[projectid] = entry
+        deliverer = mock.Mock(projectid=projectid, stagingpathhard=os.path.join(self.rootdir, projectid))
+        deliverer.db_entry.side_effect = lambda: self.entries[projectid]
+        deliverer.get_delivery_status.side_effect = \
+            lambda dbentry: 'IN_PROGRESS' if dbentry['delivery_token'] != 'NO-TOKEN' else 'NOT_DELIVERED'
+        deliverer.expand_path.side_effect = lambda path: path
+        # the decision is made by the real method
+        deliverer.evaluate_mover_status.side_effect = \
+            lambda *args, **kwargs: deliver_grus.GrusProjectDeliverer.evaluate_mover_status.im_func(
+                deliverer, *args, **kwargs)
+        deliverer.finalize_mover_delivery.side_effect = lambda status: self.outcomes.update({projectid: status})
+        return deliverer
+
+    def test_run(self, sleep):
+        """ Each delivery should be polled until it is over and then finalized, independently of the others """
+        self.mover.script("token1", ['Accepted', 'InProgress', 'InProgress', 'Delivered'])
+        self.mover.script("token2", ['Accepted', 'Delivered'])
+        monitor = deliver_grus.MoverMonitor(min_interval=0, max_interval=0, timeout=10)
+        self.assertTrue(monitor.add(self._deliverer('P1', "token1")))
+        self.assertTrue(monitor.add(self._deliverer('P2', "token2")))
+        self.assertFalse(monitor.add(self._deliverer('P3')))
+        self.assertEqual({'P1': 'DELIVERED', 'P2': 'DELIVERED'}, monitor.run())
+        self.assertEqual({'P1': 'DELIVERED', 'P2': 'DELIVERED'}, self.outcomes)
+        self.assertEqual({'token1': 4, 'token2': 2}, self.mover.polls())
+
+    def test_too_long(self, sleep):
+        """ A delivery which has been going on for too long should fail """
+        self.mover.script("token1", ['InProgress'])
+        monitor = deliver_grus.MoverMonitor(min_interval=0, max_interval=0, timeout=10)
+        monitor.add(self._deliverer('P1', "token1", delivery_started="2016-01-01T00:00:00+00:00"))
+        self.assertEqual({'P1': 'FAILED'}, monitor.run())
+        self.assertEqual({'token1': 1}, self.mover.polls())
+
+    def test_timeout(self, sleep):
+        """ A moverinfo call which does not finish in time should be killed and the delivery polled again """
+        self.mover.set(moverinfo_delay=5)
+        monitor = deliver_grus.MoverMonitor(min_interval=0, max_interval=0, timeout=0.2)
+        # without a status, a delivery only fails when it has been going on for too long
+        monitor.add(self._deliverer('P1', "token1", delivery_started="2016-01-01T00:00:00+00:00"))
+        started = time.time()
+        self.assertEqual({'P1': 'FAILED'}, monitor.run())
+        self.assertLess(time.time() - started, 5)
+        self.assertEqual({'P1': 'FAILED'}, self.outcomes)
+
+    def test_backoff(self, sleep):
+        """ The poll interval should grow while a delivery is ongoing and be reset when mover accepts it """
+        monitor = deliver_grus.MoverMonitor(min_interval=10, max_interval=40, backoff=2.0)
+        deliverer = self._deliverer('P1', "token1")
+        delivery = deliver_grus._MonitoredDelivery(deliverer, self.entries['P1'], monitor.min_interval)
+        intervals = []
+        for returncode, output in [
+                (0, "InProgress: token1"),
+                (0, "InProgress: token1"),
+                (0, "InProgress: token1"),
+                # a failed poll keeps the interval
+                (1, "moverinfo: error"),
+                (0, "Accepted: token1"),
+                (0, "Accepted: token1")]:
+            monitor._handle_poll(delivery, returncode, output)
+            intervals.append(delivery.interval)
+        self.assertEqual([20, 40, 40, 40, 10, 20], intervals)
+        self.assertEqual(6, len(monitor.pending))
+        self.assertEqual({}, self.outcomes)
+
+
+@mock.patch.object(deliver_grus.time, 'sleep', side_effect=_short_sleep)
+class TestCheckStatus(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_check_status_")
+        self.mover = MoverToolchain(os.path.join(self.rootdir, "bin"), statuses=['Accepted', 'Delivered'])
+        self.mover.install()
+        self.addCleanup(self.mover.uninstall)
+        self.config_files = {}
+        for section in ['statusdb', 'snic']:
+            self.config_files[section] = os.path.join(self.rootdir, "{}.yaml".format(section))
+            with open(self.config_files[section], 'w') as fh:
+                yaml.dump({section: GRUSCFG[section]}, fh)
+        deliver_config = dict(GRUSCFG['deliver'], rootdir=self.rootdir, mover_poll_min_interval=0,
+                              mover_poll_max_interval=0, mover_poll_timeout=10)
+        config = dict([(key, dict(value)) for key, value in GRUSCFG.items() if key != 'deliver'])
+        config['deliver'] = deliver_config
+        patcher = mock.patch.dict(deliver_grus.CONFIG, config)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.entries = {
+            'P1': {'delivery_token': "token1"},
+            'P2': {'delivery_token': "token2"},
+            'P3': {'delivery_token': 'NO-TOKEN'}}
+        self.mover.script("token1", ['Accepted', 'InProgress', 'Delivered'])
+        self.mover.script("token2", ['InProgress', 'Delivered'])
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def test_monitor(self, sleep):
+        """ check_status --monitor should follow all the projects under delivery until they are over """
+        entries = self.entries
+        outcomes = {}
+        # the configuration files are passed on as opened files, which load_yaml_config does not take
+        with mock.patch.object(cli.taca.utils.config, 'load_yaml_config') as load_yaml_config, \
+                mock.patch.object(deliver.db, 'dbcon', autospec=db.CharonSession), \
+                mock.patch.object(deliver_grus.GrusProjectDeliverer, 'db_entry', autospec=True,
+                                  side_effect=lambda d: entries[d.projectid]), \
+                mock.patch.object(deliver_grus.GrusProjectDeliverer, 'finalize_mover_delivery', autospec=True,
+                                  side_effect=lambda d, status: outcomes.update({d.projectid: status})):
+            result = CliRunner().invoke(cli.deliver, [
+                '--cluster', 'grus', cli.check_status.name, '--monitor',
+                '--statusdb-config', self.config_files['statusdb'],
+                '--snic-api-credentials', self.config_files['snic'],
+                'P1', 'P2', 'P3'])
+        self.assertIsNone(result.exception, result.output)
+        self.assertTrue(load_yaml_config.called)
+        self.assertEqual({'P1': 'DELIVERED', 'P2': 'DELIVERED'}, outcomes)
+        self.assertEqual({'token1': 3, 'token2': 2}, self.mover.polls())
+        # besides the polls, moverinfo is only called once to check the mover version
+        self.assertEqual(1, len(self.mover.calls('moverinfo')) - sum(self.mover.polls().values()))
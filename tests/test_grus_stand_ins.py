@@ -0,0 +1,82 @@
+""" Unit tests for the local mover, SUPR and order portal stand-ins used by the benchmarks """
+
+import json
+import os
+import requests
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+from mover_stubs import MoverToolchain
+from supr_server import SuprStandIn
+
+
+class TestMoverToolchain(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_mover_")
+        self.mover = MoverToolchain(os.path.join(self.rootdir, "bin"), statuses=["Accepted", "Delivered"])
+        self.mover.install()
+
+    def tearDown(self):
+        self.mover.uninstall()
+        shutil.rmtree(self.rootdir)
+
+    def test_version(self):
+        self.assertEqual("moverinfo version 1.0.0\n", subprocess.check_output(['moverinfo', '--version']))
+
+    def test_delivery(self):
+        hard_stage = os.path.join(self.rootdir, "P1")
+        os.mkdir(hard_stage)
+        token = subprocess.check_output(['to_outbox', hard_stage, "delivery00001"]).rstrip()
+        self.assertFalse(os.path.exists(hard_stage))
+        self.assertTrue(os.path.isdir(os.path.join(self.mover.outbox, token)))
+        statuses = [subprocess.check_output(['moverinfo', '-i', token]).split(':')[0] for _ in range(3)]
+        self.assertEqual(["Accepted", "Delivered", "Delivered"], statuses)
+        self.assertEqual({token: 3}, self.mover.polls())
+        self.assertEqual([['to_outbox', hard_stage, "delivery00001"]], self.mover.calls('to_outbox'))
+
+    def test_scripted_failure(self):
+        self.mover.script("token", ["Failed"])
+        self.assertEqual("Failed: token\n", subprocess.check_output(['moverinfo', '-i', "token"]))
+        self.mover.set(to_outbox_returncode=3)
+        with self.assertRaises(subprocess.CalledProcessError) as cm:
+            subprocess.check_output(['to_outbox', self.rootdir, "delivery00001"], stderr=subprocess.STDOUT)
+        self.assertEqual(3, cm.exception.returncode)
+
+
+class TestSuprStandIn(unittest.TestCase):
+    def setUp(self):
+        self.supr = SuprStandIn()
+        self.supr.start()
+        self.supr.add_project("P1", pi_email="PI@example.com", portal_id="NGI00001", pi_id=7)
+        self.config = self.supr.config()
+
+    def tearDown(self):
+        self.supr.stop()
+
+    def test_pi_lookup(self):
+        portal = self.config['order_portal']
+        response = requests.get("{}/v1/order/NGI00001".format(portal['orderportal_api_url']),
+                                headers={'X-OrderPortal-API-key': portal['orderportal_api_token']})
+        self.assertEqual("PI@example.com", response.json()['fields']['project_pi_email'])
+        snic = self.config['snic']
+        auth = (snic['snic_api_user'], snic['snic_api_password'])
+        response = requests.get("{}/person/search/".format(snic['snic_api_url']),
+                                params={'email_i': "pi@example.com"}, auth=auth)
+        self.assertEqual([7], [match['id'] for match in response.json()['matches']])
+        self.assertEqual(401, requests.get("{}/person/search/".format(snic['snic_api_url'])).status_code)
+
+    def test_create_delivery_project(self):
+        snic = self.config['snic']
+        response = requests.post("{}/ngi_delivery/project/create/".format(snic['snic_api_url']),
+                                 data=json.dumps({'pi_id': 7, 'ngi_project_name': "P1"}),
+                                 auth=(snic['snic_api_user'], snic['snic_api_password']))
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("delivery00001", response.json()['name'])
+        self.assertEqual(["P1"], [project['ngi_project_name'] for project in self.supr.delivery_projects])
+
+    def test_statusdb_view(self):
+        response = requests.get("{}/projects/_design/order_portal/_view/ProjectID_to_PortalID".format(
+            self.supr.base_url), params={'key': json.dumps("P1")})
+        self.assertEqual(["NGI00001"], [row['value'] for row in response.json()['rows']])
@@ -0,0 +1,449 @@
+""" Unit tests for the utils modules """
+
+# noinspection PyPackageRequirements
+import glob
+import gzip
+import hashlib
+import json
+import mock
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+from taca_ngi_pipeline.utils import cache
+from taca_ngi_pipeline.utils import compression
+from taca_ngi_pipeline.utils import concurrency
+from taca_ngi_pipeline.utils import filesystem
+from taca_ngi_pipeline.utils import fswatch
+from taca_ngi_pipeline.utils import manifest
+from taca_ngi_pipeline.utils import metrics
+from taca_ngi_pipeline.utils import timing
+from taca_ngi_pipeline.utils import verify
+
+
+class TestLookupCache(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_cache_")
+        self.cachefile = os.path.join(self.rootdir, "cache", "lookup_cache.json")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def test_get(self):
+        """ A value should be fetched once and then served from the cache """
+        fetch = mock.Mock(return_value="pi@domain.com")
+        lookup_cache = cache.LookupCache(self.cachefile)
+        for _ in xrange(3):
+            self.assertEqual(lookup_cache.get('pi_email', 'P1', fetch), "pi@domain.com")
+        fetch.assert_called_once_with()
+        self.assertDictEqual(lookup_cache.stats(), {'hits': 2, 'misses': 1})
+
+    def test_persistence(self):
+        """ Cached values should be shared between instances through the cache file """
+        cache.LookupCache(self.cachefile).set('supr_pi_id', 'pi@domain.com', 1234)
+        fetch = mock.Mock(return_value=5678)
+        self.assertEqual(cache.LookupCache(self.cachefile).get('supr_pi_id', 'pi@domain.com', fetch), 1234)
+        self.assertFalse(fetch.called, "a cached value should not have been fetched")
+        # a refresh should ignore, and replace, the cached value
+        self.assertEqual(
+            cache.LookupCache(self.cachefile, refresh=True).get('supr_pi_id', 'pi@domain.com', fetch), 5678)
+        self.assertEqual(cache.LookupCache(self.cachefile).get('supr_pi_id', 'pi@domain.com', fetch), 5678)
+
+    def test_expiry(self):
+        """ Expired values should be fetched again """
+        lookup_cache = cache.LookupCache(self.cachefile, ttl=60)
+        lookup_cache.set('portal_id', 'P1', 'old-portal-id')
+        with mock.patch.object(cache.time, 'time', return_value=cache.time.time() + 61):
+            self.assertEqual(lookup_cache.get('portal_id', 'P1', lambda: 'new-portal-id'), 'new-portal-id')
+        self.assertDictEqual(lookup_cache.stats(), {'hits': 0, 'misses': 1})
+
+    def test_invalidate(self):
+        """ Invalidated values should be fetched again """
+        lookup_cache = cache.LookupCache(self.cachefile)
+        lookup_cache.set('portal_id', 'P1', 'old-portal-id')
+        lookup_cache.invalidate('portal_id', 'P1')
+        self.assertEqual(
+            cache.LookupCache(self.cachefile).get('portal_id', 'P1', lambda: 'new-portal-id'), 'new-portal-id')
+
+    def test_unreadable_cache(self):
+        """ A corrupt cache file should be ignored """
+        os.makedirs(os.path.dirname(self.cachefile))
+        with open(self.cachefile, 'w') as fh:
+            fh.write("this is not json")
+        self.assertEqual(cache.LookupCache(self.cachefile).get('portal_id', 'P1', lambda: 'portal-id'), 'portal-id')
+
+
+class TestBackgroundCall(unittest.TestCase):
+    def test_result(self):
+        """ The result of the call should be returned when asked for """
+        call = concurrency.BackgroundCall(lambda x, y=0: x + y, 1, y=2)
+        self.assertEqual(call.result(), 3)
+        self.assertEqual(call.result(), 3)
+
+    def test_exception(self):
+        """ An exception raised in the background should be raised when the result is asked for """
+        def _fail():
+            raise ValueError("mocked error")
+        call = concurrency.BackgroundCall(_fail)
+        with self.assertRaises(ValueError):
+            call.result()
+
+
+class TestBoundedPipe(unittest.TestCase):
+    def test_write(self):
+        """ Data written to the pipe should reach the sink in order and be hashed """
+        sink = StringIO()
+        pipe = concurrency.BoundedPipe(sink, maxchunks=2, hasher=hashlib.sha1())
+        chunks = ["chunk{}".format(i) for i in xrange(100)]
+        for chunk in chunks:
+            pipe.write(chunk)
+        pipe.close()
+        self.assertEqual(sink.getvalue(), "".join(chunks))
+        self.assertEqual(pipe.bytes_written, len("".join(chunks)))
+        self.assertEqual(pipe.hasher.hexdigest(), hashlib.sha1("".join(chunks)).hexdigest())
+
+    def test_sink_error(self):
+        """ An error when writing to the sink should be raised in the producer """
+        sink = mock.Mock()
+        sink.write.side_effect = IOError("mocked error")
+        pipe = concurrency.BoundedPipe(sink, maxchunks=1)
+        with self.assertRaises(IOError):
+            for _ in xrange(10):
+                pipe.write("data")
+            pipe.close()
+
+
+class TestParallelGzipWriter(unittest.TestCase):
+    def _compress(self, chunks, levels=None, **kwargs):
+        output = StringIO()
+        writer = compression.ParallelGzipWriter(output, **kwargs)
+        for i, chunk in enumerate(chunks):
+            if levels is not None:
+                writer.set_level(levels[i])
+            writer.write(chunk)
+        writer.close()
+        return writer, output.getvalue()
+
+    def test_roundtrip(self):
+        """ The compressed stream should be readable as a gzip file and keep the order of the data """
+        chunks = ["{}\n".format(i) * 100 for i in xrange(200)]
+        writer, compressed = self._compress(chunks, threads=3, blocksize=1000)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), "".join(chunks))
+        self.assertEqual(writer.bytes_in, len("".join(chunks)))
+        self.assertEqual(writer.bytes_out, len(compressed))
+        self.assertLess(writer.bytes_out, writer.bytes_in)
+
+    def test_stored(self):
+        """ Data written with compression level 0 should be stored as is """
+        data = os.urandom(10000)
+        writer, compressed = self._compress(["a" * 10000, data], levels=[9, 0], threads=2)
+        self.assertIn(data, compressed)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), "a" * 10000 + data)
+
+    def test_empty(self):
+        """ Closing a writer without data should still give a valid gzip stream """
+        _, compressed = self._compress([], threads=1)
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO(compressed)).read(), "")
+
+    def test_is_compressed(self):
+        """ Files should be recognized as compressed by their extension """
+        self.assertTrue(compression.is_compressed("/path/to/sample.bam"))
+        self.assertTrue(compression.is_compressed("/path/to/sample.vcf.GZ"))
+        self.assertFalse(compression.is_compressed("/path/to/sample.vcf"))
+
+
+class TestPathIndex(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_fswatch_")
+        for folder in ["A/piper_ngi/01_raw_alignments", "A/piper_ngi/05_processed_alignments", "B/.hidden"]:
+            os.makedirs(os.path.join(self.rootdir, folder))
+        for fpath in ["A/piper_ngi/01_raw_alignments/S1.bam", "A/piper_ngi/01_raw_alignments/S2.bam",
+                      "A/piper_ngi/05_processed_alignments/S1.clean.bam", "A/report.html", "B/.hidden/file"]:
+            open(os.path.join(self.rootdir, fpath), 'w').close()
+        os.symlink(os.path.join(self.rootdir, "A", "piper_ngi"), os.path.join(self.rootdir, "B", "linked"))
+        patcher = mock.patch.object(fswatch, '_MTIME_RESOLUTION', 0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def _patterns(self):
+        return [os.path.join(self.rootdir, pattern) for pattern in [
+            "A/piper_ngi/*/S1*", "*/piper_ngi", "A/*", "B/*/*/*.bam", "B/*", "B/.*/*", "A/report.html",
+            "A/does-not-exist", "C/*"]]
+
+    def _check_glob(self, index):
+        for pattern in self._patterns():
+            self.assertListEqual(index.glob(pattern), sorted(glob.glob(pattern)), pattern)
+
+    def test_glob(self):
+        """ Patterns should be expanded from the index like glob does """
+        for use_inotify in [True, False]:
+            self._check_glob(fswatch.PathIndex(use_inotify=use_inotify))
+
+    def test_walk(self):
+        """ Folders should be walked from the index like os.walk does """
+        index = fswatch.PathIndex()
+        top = os.path.join(self.rootdir, "B")
+        expected = [(d, sorted(dirs), sorted(files)) for d, dirs, files in os.walk(top, followlinks=True)]
+        self.assertListEqual(sorted(index.walk(top)), sorted(expected))
+
+    def test_refresh(self):
+        """ Changes should be picked up by a refresh, without listing unchanged folders """
+        for use_inotify in [True, False]:
+            index = fswatch.PathIndex(use_inotify=use_inotify)
+            self._check_glob(index)
+            listings = index.listings
+            index.refresh()
+            self.assertEqual(index.listings, listings)
+            open(os.path.join(self.rootdir, "A/piper_ngi/01_raw_alignments/S3.bam"), 'w').close()
+            os.makedirs(os.path.join(self.rootdir, "A/piper_ngi/07_variant_calls"))
+            open(os.path.join(self.rootdir, "A/piper_ngi/07_variant_calls/S1.vcf"), 'w').close()
+            shutil.rmtree(os.path.join(self.rootdir, "A/piper_ngi/05_processed_alignments"))
+            index.refresh()
+            self._check_glob(index)
+            self.assertListEqual(
+                index.glob(os.path.join(self.rootdir, "A/piper_ngi/*/*")),
+                sorted(glob.glob(os.path.join(self.rootdir, "A/piper_ngi/*/*"))))
+            self.setUp()
+
+    def test_gather_files(self):
+        """ Files gathered from the index should be the same as those gathered from the file system """
+        patterns = [[os.path.join(self.rootdir, "A/piper_ngi/*"), "/staging"],
+                    [os.path.join(self.rootdir, "B/linked/*/S1*"), "/staging/linked"]]
+        self.assertListEqual(
+            sorted(filesystem.gather_files(patterns, no_checksum=True, index=fswatch.PathIndex())),
+            sorted(filesystem.gather_files(patterns, no_checksum=True)))
+
+    def test_filesystem_type(self):
+        """ The file system type should be looked up from the closest mount point """
+        mounts = os.path.join(self.rootdir, "mounts")
+        with open(mounts, 'w') as fh:
+            fh.write("rootfs / ext4 rw 0 0\nserver:/proj /proj nfs4 rw 0 0\n")
+        self.assertEqual(fswatch.filesystem_type("/proj/ngi/P1", mounts=mounts), "nfs4")
+        self.assertEqual(fswatch.filesystem_type("/projects", mounts=mounts), "ext4")
+
+
+class TestSpanRecorder(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_timing_")
+        self.spanfile = os.path.join(self.rootdir, "log", "S1_timing.jsonl")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def _spans(self):
+        with open(self.spanfile) as fh:
+            return [json.loads(line) for line in fh]
+
+    def test_span(self):
+        """ Spans should be written as JSON lines with the context, counts and duration """
+        recorder = timing.SpanRecorder(self.spanfile, projectid="P1", sampleid="S1")
+        with recorder.span('hashing', algorithm="md5") as span:
+            span.add(files=1, bytes=100)
+            span.add(files=1, bytes=50)
+        with self.assertRaises(ValueError):
+            with recorder.span('do_delivery'):
+                raise ValueError("mocked error")
+        recorder.record('symlinking', 0.5, files=2)
+        spans = self._spans()
+        self.assertListEqual([s['span'] for s in spans], ['hashing', 'do_delivery', 'symlinking'])
+        self.assertDictContainsSubset(
+            {'projectid': "P1", 'sampleid': "S1", 'algorithm': "md5", 'files': 2, 'bytes': 150}, spans[0])
+        self.assertEqual(spans[1]['error'], "ValueError")
+        self.assertEqual(spans[2]['seconds'], 0.5)
+
+    def test_disabled(self):
+        """ A recorder without a file should record nothing """
+        recorder = timing.SpanRecorder(None, projectid="P1")
+        self.assertFalse(recorder.enabled)
+        with recorder.span('hashing') as span:
+            span.add(files=1)
+        recorder.record('symlinking', 0.5)
+        self.assertFalse(os.path.exists(os.path.dirname(self.spanfile)))
+
+
+class TestMetricsTextfile(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_metrics_")
+        self.promfile = os.path.join(self.rootdir, "textfile", "taca_deliver.prom")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+        metrics.configure(None)
+
+    def _content(self):
+        with open(self.promfile) as fh:
+            return fh.read()
+
+    def test_flush(self):
+        """ Counters and summaries should be written in the textfile format """
+        textfile = metrics.MetricsTextfile(self.promfile)
+        textfile.inc('taca_deliver_staged_bytes_total', 1024, cluster="milou")
+        textfile.inc('taca_deliver_staged_bytes_total', 1024, cluster="milou")
+        textfile.observe('taca_deliver_delivery_seconds', 1.5, cluster="mosler", level="sample", outcome="success")
+        textfile.flush()
+        content = self._content()
+        self.assertIn("# TYPE taca_deliver_staged_bytes_total counter\n", content)
+        self.assertIn('taca_deliver_staged_bytes_total{cluster="milou"} 2048.0\n', content)
+        self.assertIn("# TYPE taca_deliver_delivery_seconds summary\n", content)
+        self.assertIn(
+            'taca_deliver_delivery_seconds_count{cluster="mosler",level="sample",outcome="success"} 1.0\n', content)
+        self.assertIn(
+            'taca_deliver_delivery_seconds_sum{cluster="mosler",level="sample",outcome="success"} 1.5\n', content)
+        self.assertListEqual(os.listdir(os.path.dirname(self.promfile)), ["taca_deliver.prom", "taca_deliver.prom.lock"])
+
+    def test_accumulate(self):
+        """ Values should be added to those already in the file, e.g. by an earlier run """
+        for _ in xrange(3):
+            textfile = metrics.MetricsTextfile(self.promfile)
+            textfile.inc('taca_deliver_transferred_bytes_total', 100, cluster="grus", protocol="sftp")
+            textfile.flush()
+            # nothing new to add
+            textfile.flush()
+        self.assertIn(
+            'taca_deliver_transferred_bytes_total{cluster="grus",protocol="sftp"} 300.0\n', self._content())
+
+    def test_disabled(self):
+        """ Nothing should be recorded until the metrics have been configured """
+        metrics.inc('taca_deliver_staged_files_total', 1)
+        with metrics.timed('taca_deliver_charon_request_seconds', method="sample_get"):
+            pass
+        metrics.flush()
+        self.assertFalse(os.path.exists(self.promfile))
+        metrics.configure(self.promfile)
+        with self.assertRaises(ValueError):
+            with metrics.timed('taca_deliver_charon_request_seconds', method="sample_get"):
+                raise ValueError("mocked error")
+        metrics.flush()
+        self.assertIn(
+            'taca_deliver_charon_request_seconds_count{method="sample_get",outcome="error"} 1.0\n', self._content())
+
+
+class TestVerify(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_verify_")
+        self.digestfile = os.path.join(self.rootdir, "NGIU-S001.sha1")
+        self.files = {"a.txt": "a\n", os.path.join("sub", "b with space.txt"): "b" * 100000, "c.txt": ""}
+        os.mkdir(os.path.join(self.rootdir, "sub"))
+        with open(self.digestfile, 'w') as dh:
+            for name, content in sorted(self.files.items()):
+                with open(os.path.join(self.rootdir, name), 'w') as fh:
+                    fh.write(content)
+                dh.write("{}  {}\n".format(hashlib.sha1(content).hexdigest(), name))
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_verify_digestfile(self):
+        """ All files matching their digests should verify """
+        result = verify.verify_digestfile(self.digestfile, workers=2)
+        self.assertTrue(result.ok)
+        self.assertEqual((3, 100002), (result.files, result.bytes))
+
+    def test_mismatches(self):
+        """ Changed and missing files should be reported as mismatches """
+        with open(os.path.join(self.rootdir, "a.txt"), 'w') as fh:
+            fh.write("corrupted\n")
+        os.unlink(os.path.join(self.rootdir, "c.txt"))
+        result = verify.verify_digestfile(self.digestfile, workers=2, read_size=1024)
+        self.assertFalse(result.ok)
+        self.assertEqual(
+            [("a.txt", hashlib.sha1("a\n").hexdigest(), hashlib.sha1("corrupted\n").hexdigest()),
+             ("c.txt", hashlib.sha1("").hexdigest(), None)],
+            result.mismatches)
+        with self.assertRaises(verify.VerificationError):
+            verify.verify_digestfile(os.path.join(self.rootdir, "missing.sha1"))
+
+    def test_verify_remote(self):
+        """ The helper should be run over ssh and its result parsed """
+        bindir = os.path.join(self.rootdir, "bin")
+        os.mkdir(bindir)
+        # a stand-in for ssh, which runs the command locally
+        with open(os.path.join(bindir, "ssh"), 'w') as fh:
+            fh.write('#!/bin/sh\nshift 3\nexec "$@"\n')
+        os.chmod(os.path.join(bindir, "ssh"), 0o755)
+        with mock.patch.dict(os.environ, {'PATH': os.pathsep.join([bindir, os.environ['PATH']])}):
+            os.unlink(os.path.join(self.rootdir, "c.txt"))
+            result = verify.verify_remote(
+                self.digestfile, "remote-host", remote_user="user", workers=2, python=sys.executable)
+            self.assertEqual([("c.txt", hashlib.sha1("").hexdigest(), None)], result.mismatches)
+            self.assertEqual(2, result.files)
+            with self.assertRaises(verify.VerificationError):
+                verify.verify_remote(os.path.join(self.rootdir, "missing.sha1"), "remote-host",
+                                     python=sys.executable)
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.entries = [
+            ("NGIU-S001/01-RAW/a.fastq.gz", "aaaa", 10),
+            ("NGIU-S001/01-RAW/b.fastq.gz", "bbbb", 20),
+            ("NGIU-S001/02-ANALYSIS/report.html", "cccc", 5),
+            ("NGIU-S001/README", "dddd", 1)]
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_manifest_")
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir)
+
+    def test_build(self):
+        """ The folder digests should depend on the content but not on the order of the files """
+        built = manifest.build(self.entries, 'sha1')
+        self.assertEqual(36, built['root']['size'])
+        self.assertEqual(30, built['root']['children']['NGIU-S001']['children']['01-RAW']['size'])
+        self.assertEqual(built, manifest.build(reversed(self.entries), 'sha1'))
+        changed = manifest.build(self.entries[:-1] + [("NGIU-S001/README", "eeee", 1)], 'sha1')
+        self.assertNotEqual(built['root']['hash'], changed['root']['hash'])
+        self.assertEqual(
+            built['root']['children']['NGIU-S001']['children']['01-RAW']['hash'],
+            changed['root']['children']['NGIU-S001']['children']['01-RAW']['hash'])
+        path = os.path.join(self.rootdir, "NGIU-S001.manifest.json")
+        manifest.write(built, path)
+        self.assertEqual(built, manifest.read(path))
+        with open(path, 'w') as fh:
+            fh.write("{}")
+        with self.assertRaises(ValueError):
+            manifest.read(path)
+
+    def test_diff(self):
+        """ Only the changed subtrees should be compared """
+        old = manifest.build(self.entries, 'sha1')
+        new = manifest.build(
+            self.entries[:1] + [("NGIU-S001/01-RAW/b.fastq.gz", "ffff", 20)] + self.entries[2:3] +
+            [("NGIU-S001/03-QC/qc.html", "gggg", 2)], 'sha1')
+        # the unchanged folder is never descended into
+        for m in [old, new]:
+            m['root']['children']['NGIU-S001']['children']['02-ANALYSIS']['children'] = None
+        self.assertEqual(
+            (["NGIU-S001/01-RAW/b.fastq.gz", "NGIU-S001/03-QC/qc.html"], ["NGIU-S001/README"]),
+            manifest.diff(old, new))
+        self.assertEqual(([], []), manifest.diff(new, new))
+        self.assertEqual(
+            (sorted([e[0] for e in self.entries]), []),
+            manifest.diff(manifest.build(self.entries, 'md5'), manifest.build(self.entries, 'sha1')))
+
+    def test_non_ascii_names(self):
+        """ Names with non-ASCII characters should give the same digests as bytes and as unicode """
+        entries = self.entries + [("NGIU-S001/r\xc3\xa4ttelse/\xc3\xa5terl\xc3\xa4mning.txt", "eeee", 4)]
+        built = manifest.build(entries, 'sha1')
+        path = os.path.join(self.rootdir, "NGIU-S001.manifest.json")
+        manifest.write(built, path)
+        read = manifest.read(path)
+        self.assertIn(u"NGIU-S001/r\xe4ttelse/\xe5terl\xe4mning.txt", [fpath for fpath, _ in manifest.iter_files(read)])
+        self.assertEqual(built['root']['hash'], manifest.merge([read])['root']['hash'])
+        self.assertEqual(built['root']['hash'], manifest.build(
+            [(fpath.decode('utf-8'), digest, size) for fpath, digest, size in entries], 'sha1')['root']['hash'])
+        self.assertEqual(([], []), manifest.diff(built, read))
+
+    def test_merge(self):
+        """ The merged manifest should be the manifest of all the files """
+        other = [("NGIU-S002/a.fastq.gz", "hhhh", 3)]
+        merged = manifest.merge([manifest.build(self.entries, 'sha1'), manifest.build(other, 'sha1')])
+        self.assertEqual(manifest.build(self.entries + other, 'sha1'), merged)
+        with self.assertRaises(ValueError):
+            manifest.merge([manifest.build(self.entries, 'sha1'), manifest.build(other, 'md5')])
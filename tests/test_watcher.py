@@ -0,0 +1,158 @@
+""" Unit tests for the delivery watcher """
+
+import json
+# noinspection PyPackageRequirements
+import mock
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from charon_server import CharonStandIn
+from taca_ngi_pipeline.deliver import watcher
+
+
+def _sampleentry(sampleid, analysis_status='ANALYZED', delivery_status='NOT_DELIVERED', status='STALE'):
+    return {
+        'sampleid': sampleid,
+        'analysis_status': analysis_status,
+        'delivery_status': delivery_status,
+        'status': status}
+
+
+class TestDeliveryWatcher(unittest.TestCase):
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_watcher_")
+        self.statefile = os.path.join(self.rootdir, "state", "watch.json")
+        self.samples = {
+            'P1': [_sampleentry('P1_101'), _sampleentry('P1_102', analysis_status='UNDER_ANALYSIS')],
+            'P2': [_sampleentry('P2_101', delivery_status='DELIVERED'), _sampleentry('P2_102')]}
+        patcher = mock.patch.object(watcher, 'db')
+        self.db = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db.project_sample_entries.side_effect = lambda dbc, pid: {'samples': self.samples[pid]}
+        self.db.project_entries.return_value = {'projects': [
+            {'projectid': 'P1', 'status': 'OPEN'},
+            {'projectid': 'P2', 'status': 'OPEN'},
+            {'projectid': 'P3', 'status': 'CLOSED'}]}
+        self.deliverer = mock.Mock()
+        self.deliverer.deliver_sample.return_value = True
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def _watcher(self, **kwargs):
+        return watcher.DeliveryWatcher(lambda pid, sid: self.deliverer, self.statefile, **kwargs)
+
+    def test_poll(self):
+        """ Samples which have become ready should be queued once """
+        delivery_watcher = self._watcher()
+        delivery_watcher.poll()
+        self.assertListEqual(list(delivery_watcher.queue), [('P1', 'P1_101'), ('P2', 'P2_102')])
+        self.db.project_sample_entries.assert_has_calls(
+            [mock.call(mock.ANY, 'P1'), mock.call(mock.ANY, 'P2')])
+        delivery_watcher.queue.clear()
+        # a sample which finishes analysis between polls should be picked up
+        self.samples['P1'][1]['analysis_status'] = 'ANALYZED'
+        delivery_watcher.poll()
+        self.assertListEqual(list(delivery_watcher.queue), [('P1', 'P1_102')])
+
+    def test_bounded_queue(self):
+        """ Samples which do not fit in the queue should be picked up by a later poll """
+        delivery_watcher = self._watcher(projectids=['P1', 'P2'], queue_size=1)
+        delivery_watcher.poll()
+        self.assertListEqual(list(delivery_watcher.queue), [('P1', 'P1_101')])
+        delivery_watcher.queue.clear()
+        delivery_watcher.poll()
+        self.assertListEqual(list(delivery_watcher.queue), [('P2', 'P2_102')])
+
+    def test_dispatch(self):
+        """ Deliveries should be started within the global and per-project limits """
+        self.samples['P1'][1]['analysis_status'] = 'ANALYZED'
+        delivery_watcher = self._watcher(jobs=2, jobs_per_project=1)
+        with mock.patch.object(watcher, 'BackgroundCall') as background_call:
+            delivery_watcher.poll()
+            delivery_watcher._dispatch()
+        self.assertListEqual(sorted(delivery_watcher.running.keys()), [('P1', 'P1_101'), ('P2', 'P2_102')])
+        self.assertListEqual(list(delivery_watcher.queue), [('P1', 'P1_102')])
+        self.assertEqual(background_call.call_count, 2)
+
+    @mock.patch.object(watcher.time, 'sleep')
+    @mock.patch.object(watcher.signal, 'signal')
+    def test_run_once(self, *args):
+        """ A single run should deliver the ready samples and keep the cursor in the state file """
+        results = self._watcher().run(once=True)
+        self.assertDictEqual(results, {('P1', 'P1_101'): True, ('P2', 'P2_102'): True})
+        with open(self.statefile) as fh:
+            state = json.load(fh)
+        self.assertListEqual(state['queue'], [])
+        self.assertEqual(state['cursor']['P1']['P1_102']['analysis_status'], 'UNDER_ANALYSIS')
+        # a restarted watcher should not deliver the samples again
+        self.assertDictEqual(self._watcher().run(once=True), {})
+
+    @mock.patch.object(watcher.signal, 'signal')
+    def test_run_interrupted(self, *args):
+        """ An interrupted watcher should wait for the running deliveries, and reset their
+            delivery status if interrupted again
+        """
+        delivered = threading.Event()
+        self.addCleanup(delivered.set)
+        self.deliverer.deliver_sample.side_effect = lambda: delivered.wait() or True
+        # the running deliveries finish after the first interrupt
+        with mock.patch.object(watcher.time, 'sleep') as sleep:
+            sleep.side_effect = lambda seconds: delivered.set() if sleep.call_count > 1 else self._interrupt()
+            with self.assertRaises(watcher.DelivererInterruptedError):
+                self._watcher().run()
+        self.deliverer.update_delivery_status.assert_not_called()
+        with open(self.statefile) as fh:
+            self.assertListEqual(json.load(fh)['queue'], [])
+        # the running deliveries are cancelled by a second interrupt and queued again
+        delivered.clear()
+        self.samples['P1'][1]['analysis_status'] = 'ANALYZED'
+        with mock.patch.object(watcher.time, 'sleep', side_effect=lambda seconds: self._interrupt()):
+            with self.assertRaises(watcher.DelivererInterruptedError):
+                self._watcher().run()
+        self.deliverer.update_delivery_status.assert_called_once_with(status="NOT_DELIVERED")
+        with open(self.statefile) as fh:
+            self.assertListEqual(json.load(fh)['queue'], [['P1', 'P1_102']])
+
+    @staticmethod
+    def _interrupt():
+        raise watcher.DelivererInterruptedError("interrupted")
+
+    def test_resume(self):
+        """ Samples queued when the watcher stopped should be queued again on restart """
+        delivery_watcher = self._watcher()
+        delivery_watcher.poll()
+        delivery_watcher._save_state()
+        self.assertListEqual(list(self._watcher().queue), [('P1', 'P1_101'), ('P2', 'P2_102')])
+
+
+class TestDeliveryWatcherCharon(unittest.TestCase):
+    """ Polls the local Charon stand-in through CharonSession """
+
+    def setUp(self):
+        self.rootdir = tempfile.mkdtemp(prefix="test_taca_watcher_")
+        self.charon = CharonStandIn(api_token="token")
+        self.charon.start()
+        self.addCleanup(self.charon.stop)
+        patcher = mock.patch.dict(os.environ, {'CHARON_BASE_URL': self.charon.base_url, 'CHARON_API_TOKEN': "token"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        for projectid, status in [('P1', 'OPEN'), ('P2', 'OPEN'), ('P3', 'CLOSED')]:
+            self.charon.add_project(projectid, status=status)
+            self.charon.add_sample(projectid, "{}_101".format(projectid), analysis_status='ANALYZED')
+        self.charon.add_sample('P1', 'P1_102', analysis_status='UNDER_ANALYSIS')
+
+    def tearDown(self):
+        shutil.rmtree(self.rootdir, ignore_errors=True)
+
+    def test_poll_open_projects(self):
+        """ Without project ids, the samples of the open projects in Charon should be polled """
+        delivery_watcher = watcher.DeliveryWatcher(
+            lambda pid, sid: mock.Mock(), os.path.join(self.rootdir, "watch.json"))
+        delivery_watcher.poll()
+        self.assertListEqual(list(delivery_watcher.queue), [('P1', 'P1_101'), ('P2', 'P2_101')])
+        self.assertEqual(1, self.charon.calls[('GET', 'projects')])
+        self.assertEqual(2, self.charon.calls[('GET', 'samples')])